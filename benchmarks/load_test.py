@@ -0,0 +1,304 @@
+"""
+リファレンスアプリ(reference_app.py)に対する負荷生成ツール
+
+標準ライブラリのみで動作し、ローカルで完結する
+指定した並列数のワーカーが、重み付きで選んだエンドポイントに
+指定時間リクエストを送り続け、エンドポイント毎のスループットと
+p50/p95/p99のレイテンシを出力する::
+
+    python benchmarks/load_test.py --url http://127.0.0.1:5000 \\
+        --concurrency 16 --duration 60 \\
+        --mix download=5,thumbnails=2,tree=2,upload=1
+"""
+import argparse
+import json
+import math
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+ENDPOINTS = ('download', 'thumbnails', 'tree', 'upload')
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    """
+    最近傍順位法でパーセンタイルを求める
+
+    :param list sorted_values: ソート済みの値
+    :param float p: 0-100
+    :return:
+    :rtype: float
+    """
+    if not sorted_values:
+        return math.nan
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def parse_mix(mix: str) -> dict:
+    """
+    'download=5,tree=1' 形式の重みを読み込む
+
+    :param str mix:
+    :return:
+    :rtype: dict
+    """
+    weights = {}
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise ValueError(f'不明なエンドポイントです {name}')
+        weights[name] = float(weight or 1)
+    if not any(weights.values()):
+        raise ValueError('重みが全て0です')
+    return weights
+
+
+def multipart_body(filename: str, data: bytes) -> tuple[bytes, str]:
+    """
+    アップロード用のmultipart/form-dataを作成する
+
+    :param str filename:
+    :param bytes data:
+    :return: (本文, Content-Type)
+    :rtype: tuple
+    """
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="files"; '
+            f'filename="{filename}"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n').encode() + \
+        data + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+class Recorder:
+    """
+    エンドポイント毎のレイテンシを記録する
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+        self.bytes: dict[str, int] = {}
+
+    def add(self, endpoint: str, seconds: float, nbytes: int,
+            error: bool) -> None:
+        with self._lock:
+            if error:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            else:
+                self.latencies.setdefault(endpoint, []).append(seconds)
+                self.bytes[endpoint] = self.bytes.get(endpoint, 0) + nbytes
+
+    def report(self, elapsed: float) -> dict:
+        """
+        集計結果を作成する
+
+        :param float elapsed: 計測時間(秒)
+        :return: {エンドポイント: {'count', 'errors', 'rps', 'mb_per_s',
+            'p50', 'p95', 'p99', 'max'}} レイテンシはミリ秒
+        :rtype: dict
+        """
+        result = {}
+        names = sorted(set(self.latencies) | set(self.errors))
+        all_latencies = []
+        for name in names:
+            values = sorted(self.latencies.get(name, []))
+            all_latencies.extend(values)
+            result[name] = self._summary(values, self.errors.get(name, 0),
+                                         self.bytes.get(name, 0), elapsed)
+        result['total'] = self._summary(
+            sorted(all_latencies), sum(self.errors.values()),
+            sum(self.bytes.values()), elapsed)
+        return result
+
+    @staticmethod
+    def _summary(values: list, errors: int, nbytes: int,
+                 elapsed: float) -> dict:
+        return {
+            'count': len(values),
+            'errors': errors,
+            'rps': len(values) / elapsed if elapsed else 0.0,
+            'mb_per_s': nbytes / elapsed / 1e6 if elapsed else 0.0,
+            'p50': percentile(values, 50) * 1000,
+            'p95': percentile(values, 95) * 1000,
+            'p99': percentile(values, 99) * 1000,
+            'max': (values[-1] if values else math.nan) * 1000,
+        }
+
+
+class LoadTest:
+    """
+    リファレンスアプリに負荷をかける
+    """
+
+    def __init__(self, url: str, weights: dict, timeout=30.0,
+                 upload_size=256 * 1024, thumbnail_cache=False):
+        self.url = url.rstrip('/')
+        self.weights = weights
+        self.timeout = timeout
+        self.upload_data = os.urandom(upload_size)
+        self.thumbnail_cache = thumbnail_cache
+        self.recorder = Recorder()
+        self.dataset: dict = {}
+
+    def request(self, method: str, path: str, body: Optional[bytes] = None,
+                headers: Optional[dict] = None) -> bytes:
+        """
+        HTTPリクエストを送信してレスポンスを全て読み込む
+
+        :param str method:
+        :param str path:
+        :param bytes or None body:
+        :param dict or None headers:
+        :return:
+        :rtype: bytes
+        """
+        req = urllib.request.Request(self.url + path, data=body,
+                                     method=method, headers=headers or {})
+        with urllib.request.urlopen(req, timeout=self.timeout) as res:
+            return res.read()
+
+    def seed(self, children: int, images: int, width: int,
+             height: int) -> None:
+        """
+        試験用のデータを作成する
+        """
+        self.dataset = json.loads(self.request(
+            'POST', f'/seed?children={children}&images={images}'
+                    f'&width={width}&height={height}'))
+
+    def run_one(self, endpoint: str, rng: random.Random) -> None:
+        """
+        エンドポイントに1回リクエストを送り、結果を記録する
+
+        :param str endpoint:
+        :param random.Random rng:
+        """
+        root = self.dataset['root']
+        child = rng.choice(self.dataset['children'])
+        if endpoint == 'download':
+            args = ('GET', f"/download/{rng.choice(self.dataset['files'])}")
+        elif endpoint == 'thumbnails':
+            cache = 1 if self.thumbnail_cache else 0
+            args = ('GET', f"/thumbnails/{child['collection']}/"
+                           f"{child['oid']}?cache={cache}")
+        elif endpoint == 'tree':
+            args = ('GET', f"/tree/{root['collection']}/{root['oid']}")
+        else:
+            body, content_type = multipart_body(
+                f'upload{rng.randrange(1 << 30)}.bin', self.upload_data)
+            args = ('POST', f"/upload/{child['collection']}/{child['oid']}",
+                    body, {'Content-Type': content_type})
+
+        start = time.perf_counter()
+        try:
+            data = self.request(*args)
+        except (urllib.error.URLError, OSError):
+            self.recorder.add(endpoint, time.perf_counter() - start, 0, True)
+        else:
+            self.recorder.add(endpoint, time.perf_counter() - start,
+                              len(data), False)
+
+    def worker(self, seed: int, deadline: float) -> None:
+        rng = random.Random(seed)
+        names = list(self.weights)
+        weights = [self.weights[i] for i in names]
+        while time.perf_counter() < deadline:
+            self.run_one(rng.choices(names, weights)[0], rng)
+
+    def run(self, concurrency: int, duration: float, warmup=0.0) -> dict:
+        """
+        並列数concurrencyでduration秒間負荷をかける
+
+        :param int concurrency:
+        :param float duration:
+        :param float warmup: 計測前に負荷をかける秒数
+        :return: Recorder.reportの結果
+        :rtype: dict
+        """
+        if warmup > 0:
+            self._run_workers(concurrency, warmup)
+            self.recorder = Recorder()
+        elapsed = self._run_workers(concurrency, duration)
+        return self.recorder.report(elapsed)
+
+    def _run_workers(self, concurrency: int, duration: float) -> float:
+        start = time.perf_counter()
+        deadline = start + duration
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(self.worker, i, deadline)
+                       for i in range(concurrency)]
+            for future in futures:
+                future.result()
+        return time.perf_counter() - start
+
+
+def format_report(report: dict) -> str:
+    """
+    集計結果を表形式の文字列にする
+
+    :param dict report:
+    :return:
+    :rtype: str
+    """
+    header = (f"{'endpoint':<12}{'count':>8}{'errors':>8}{'req/s':>10}"
+              f"{'MB/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+              f"{'max ms':>10}")
+    lines = [header, '-' * len(header)]
+    for name, data in report.items():
+        lines.append(
+            f"{name:<12}{data['count']:>8}{data['errors']:>8}"
+            f"{data['rps']:>10.1f}{data['mb_per_s']:>9.2f}"
+            f"{data['p50']:>10.1f}{data['p95']:>10.1f}{data['p99']:>10.1f}"
+            f"{data['max']:>10.1f}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='リファレンスアプリの負荷試験')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help='計測する秒数')
+    parser.add_argument('--warmup', type=float, default=5.0,
+                        help='計測前に負荷をかける秒数')
+    parser.add_argument('--mix',
+                        default='download=5,thumbnails=2,tree=2,upload=1',
+                        help='エンドポイント毎の重み')
+    parser.add_argument('--children', type=int, default=20,
+                        help='作成する子ドキュメント数')
+    parser.add_argument('--images', type=int, default=3,
+                        help='子ドキュメント毎の画像数')
+    parser.add_argument('--image-size', default='1024x768')
+    parser.add_argument('--upload-size', type=int, default=256 * 1024)
+    parser.add_argument('--thumbnail-cache', action='store_true',
+                        help='サムネイルのキャッシュを利用する')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--json', default=None,
+                        help='集計結果をJSONで保存するファイル')
+    args = parser.parse_args()
+
+    width, height = (int(i) for i in args.image_size.split('x'))
+    load_test = LoadTest(args.url, parse_mix(args.mix), args.timeout,
+                         args.upload_size, args.thumbnail_cache)
+    load_test.seed(args.children, args.images, width, height)
+    report = load_test.run(args.concurrency, args.duration, args.warmup)
+    print(format_report(report))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'report': report}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
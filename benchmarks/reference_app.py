@@ -0,0 +1,237 @@
+"""
+負荷試験用のリファレンスFlaskアプリ
+
+FileManager, SearchManagerを典型的なエンドポイントに組み込んだもの
+ローカルのmongodに接続して起動する::
+
+    python benchmarks/reference_app.py --database edman_bench \\
+        --user bench --password bench --listen-port 5000
+
+マルチプロセスで試験する場合はgunicorn等から create_app() を利用する
+(接続情報は環境変数 EDMAN_BENCH_HOST, EDMAN_BENCH_PORT, EDMAN_BENCH_DB,
+EDMAN_BENCH_USER, EDMAN_BENCH_PASSWORD, EDMAN_BENCH_DISK_CACHE)::
+
+    gunicorn -w 4 --chdir benchmarks 'reference_app:create_app()'
+"""
+import argparse
+import json
+import os
+from io import BytesIO
+from typing import Optional
+
+from bson import DBRef, ObjectId
+from edman import Config
+from edman.json_manager import GetJsonStructure
+from flask import Flask, Response, jsonify, request, send_file
+
+from edman_web import DiskCache, metrics
+from edman_web.manager_factory import ManagerFactory
+
+# 負荷試験用のデータを作成するコレクション
+ROOT_COLLECTION = 'bench_root'
+CHILD_COLLECTION = 'bench_child'
+THUMBNAIL_SUFFIX = ['jpg', 'jpeg', 'png']
+
+
+def connection_from_env() -> dict:
+    """
+    環境変数からedman.DBの接続情報を作成する
+    edman.DBは認証付きで接続するので、EDMAN_BENCH_USERと
+    EDMAN_BENCH_PASSWORDは必須
+
+    :return:
+    :rtype: dict
+    """
+    user = os.environ.get('EDMAN_BENCH_USER')
+    password = os.environ.get('EDMAN_BENCH_PASSWORD')
+    if not user or not password:
+        raise ValueError(
+            'EDMAN_BENCH_USER, EDMAN_BENCH_PASSWORDを指定してください')
+    return {
+        'host': os.environ.get('EDMAN_BENCH_HOST', 'localhost'),
+        'port': int(os.environ.get('EDMAN_BENCH_PORT', 27017)),
+        'database': os.environ.get('EDMAN_BENCH_DB', 'edman_bench'),
+        'user': user,
+        'password': password,
+        'options': [],
+    }
+
+
+def generate_image(width: int, height: int, seed: int) -> bytes:
+    """
+    試験用のJPEG画像を作成する
+
+    :param int width:
+    :param int height:
+    :param int seed:
+    :return:
+    :rtype: bytes
+    """
+    import numpy as np
+    from PIL import Image as PILImage
+
+    rng = np.random.default_rng(seed)
+    # ノイズだけだとJPEGが極端に大きくなるのでグラデーションに重ねる
+    gradient = np.linspace(0, 200, width, dtype=np.float32)
+    arr = gradient[None, :, None] + rng.normal(0, 20, (height, width, 3))
+    img = PILImage.fromarray(arr.clip(0, 255).astype(np.uint8))
+    f = BytesIO()
+    img.save(f, 'jpeg', quality=85)
+    return f.getvalue()
+
+
+def create_app(con: Optional[dict] = None,
+               disk_cache: Optional[str] = None, **pool_options) -> Flask:
+    """
+    リファレンスアプリを作成する
+
+    :param dict or None con: edman.DBの接続情報 Noneの時は環境変数から作成
+    :param str or None disk_cache: ディスクキャッシュのディレクトリ
+    :param pool_options: ManagerFactoryのプール設定
+    :return:
+    :rtype: Flask
+    """
+    if con is None:
+        con = connection_from_env()
+    if disk_cache is None:
+        disk_cache = os.environ.get('EDMAN_BENCH_DISK_CACHE')
+
+    factory = ManagerFactory(con, **pool_options)
+    sink = metrics.InMemoryMetrics()
+    metrics.set_sink(sink)
+    if disk_cache:
+        factory.get_file_manager().disk_cache = DiskCache(disk_cache)
+
+    app = Flask(__name__)
+
+    @app.post('/seed')
+    def seed():
+        """
+        ルートドキュメントと子ドキュメントを作成し、子に画像を添付する
+        """
+        children = request.args.get('children', 10, type=int)
+        images = request.args.get('images', 3, type=int)
+        width = request.args.get('width', 1024, type=int)
+        height = request.args.get('height', 768, type=int)
+
+        db = factory.get_db().get_db
+        file_manager = factory.get_file_manager()
+        root_id = ObjectId()
+        child_ids = [ObjectId() for _ in range(children)]
+        db[ROOT_COLLECTION].insert_one({
+            '_id': root_id, 'name': 'bench',
+            Config.child: [DBRef(CHILD_COLLECTION, i) for i in child_ids]})
+        if child_ids:
+            db[CHILD_COLLECTION].insert_many([
+                {'_id': i, 'name': f'child{n}', 'value': n,
+                 Config.parent: DBRef(ROOT_COLLECTION, root_id)}
+                for n, i in enumerate(child_ids)])
+
+        file_oids = []
+        for n, child_id in enumerate(child_ids):
+            oids = [file_manager.fs.put(
+                generate_image(width, height, n * images + i),
+                filename=f'image{n}_{i}.jpg') for i in range(images)]
+            doc = db[CHILD_COLLECTION].find_one({'_id': child_id})
+            file_manager.attach_files(CHILD_COLLECTION, doc, oids)
+            file_oids.extend(oids)
+
+        return jsonify({
+            'root': {'collection': ROOT_COLLECTION, 'oid': str(root_id)},
+            'children': [{'collection': CHILD_COLLECTION, 'oid': str(i)}
+                         for i in child_ids],
+            'files': [str(i) for i in file_oids]})
+
+    @app.post('/upload/<collection>/<oid>')
+    def upload(collection: str, oid: str):
+        file_manager = factory.get_file_manager()
+        for up_file in request.files.getlist('files'):
+            file_manager.web_upload(collection, oid, up_file)
+        return jsonify({'status': 'ok'})
+
+    @app.get('/download/<oid>')
+    def download(oid: str):
+        try:
+            f, file_name, mimetype = factory.get_file_manager().file_open(oid)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 404
+        return send_file(f, mimetype=mimetype or 'application/octet-stream',
+                         as_attachment=True, download_name=file_name)
+
+    @app.get('/thumbnails/<collection>/<oid>')
+    def thumbnails(collection: str, oid: str):
+        db = factory.get_db().get_db
+        if (doc := db[collection].find_one({'_id': ObjectId(oid)})) is None:
+            return jsonify({'error': 'not found'}), 404
+        files = [(i['_id'], i['filename']) for i in db['fs.files'].find(
+            {'_id': {'$in': doc.get(Config.file, [])}}, {'filename': 1})]
+        result = factory.get_file_manager().get_thumbnails_procedure(
+            files, THUMBNAIL_SUFFIX,
+            thumbnail_size=(request.args.get('size', 100, type=int),) * 2,
+            accept=request.headers.get('Accept'),
+            use_cache=request.args.get('cache', 0, type=int) == 1)
+        return jsonify({str(k): v for k, v in result.items()})
+
+    @app.get('/tree/<collection>/<oid>')
+    def tree(collection: str, oid: str):
+        try:
+            result = factory.get_search_manager().get_documents(
+                GetJsonStructure.manual_select.value, collection, oid,
+                parent_depth=request.args.get('parent_depth', 1, type=int),
+                child_depth=request.args.get('child_depth', 2, type=int),
+                child_limit=request.args.get('child_limit', None, type=int))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        # ObjectId, DBRef, datetimeは文字列にする
+        return Response(json.dumps(result, ensure_ascii=False, default=str),
+                        mimetype='application/json')
+
+    @app.get('/children')
+    def children():
+        """
+        /treeのchild_limitで省略された子ドキュメントの続きを取得する
+        """
+        try:
+            result = factory.get_search_manager().get_children_page(
+                request.args.get('cursor'),
+                limit=request.args.get('limit', None, type=int))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return Response(json.dumps(result, ensure_ascii=False, default=str),
+                        mimetype='application/json')
+
+    @app.get('/metrics')
+    def prometheus():
+        return Response(sink.prometheus_text(),
+                        mimetype='text/plain; version=0.0.4')
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='負荷試験用のリファレンスアプリ')
+    parser.add_argument('--host', default='localhost', help='mongodのホスト')
+    parser.add_argument('--port', type=int, default=27017,
+                        help='mongodのポート')
+    parser.add_argument('--database', default='edman_bench')
+    # edman.DBは認証付きで接続するので必須
+    parser.add_argument('--user', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--listen', default='127.0.0.1',
+                        help='アプリの待ち受けアドレス')
+    parser.add_argument('--listen-port', type=int, default=5000)
+    parser.add_argument('--disk-cache', default=None,
+                        help='ディスクキャッシュのディレクトリ')
+    parser.add_argument('--max-pool-size', type=int, default=100)
+    args = parser.parse_args()
+
+    con = {'host': args.host, 'port': args.port, 'database': args.database,
+           'user': args.user, 'password': args.password, 'options': []}
+    app = create_app(con, disk_cache=args.disk_cache,
+                     max_pool_size=args.max_pool_size)
+    app.run(host=args.listen, port=args.listen_port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,8 @@
+from .bulk_ingest import BulkIngest
+from .decode_policy import DecodePolicy
+from .disk_cache import DiskCache
 from .file_manager import FileManager
+from .manager_factory import ManagerFactory
+from .read_routing import ReadRouting
 from .search_manager import SearchManager
+from .tile_manager import TileManager
@@ -0,0 +1,428 @@
+import argparse
+import json
+import os
+import sys
+import tarfile
+import time
+import zipfile
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+                                wait)
+from typing import BinaryIO, Callable, Iterator, Optional, Union
+
+from bson import ObjectId
+from edman import DB, Config
+from edman.exceptions import EdmanDbProcessError, EdmanInternalError
+from edman.utils import Utils
+
+from .file_manager import FileManager
+
+
+class BulkIngest:
+    """
+    大量のファイルをまとめてGridFSに登録し、既存のドキュメントに添付する
+    アップロードはスレッドプールで並列に行い、ドキュメントの更新は
+    batch_size件毎にまとめて行う
+    添付が完了したファイルはチェックポイントファイルに記録し、
+    中断した場合は続きから再開する
+    """
+
+    def __init__(self, file_manager: FileManager, collection: str,
+                 workers=4, batch_size=100,
+                 checkpoint: Optional[str] = None,
+                 progress: Optional[Callable[[dict], None]] = None,
+                 progress_interval=5.0):
+        """
+        :param FileManager file_manager:
+        :param str collection: 添付先ドキュメントのコレクション
+        :param int workers: アップロードの並列数 default 4
+        :param int batch_size: 1回のドキュメント更新で添付する数 default 100
+        :param str or None checkpoint: チェックポイントファイルのパス
+        :param Callable or None progress: 進捗を受け取る関数
+        :param float progress_interval: 進捗を通知する間隔(秒) default 5.0
+        """
+        if workers < 1 or batch_size < 1:
+            raise EdmanInternalError(
+                'workersとbatch_sizeは1以上を指定してください')
+        self.file_manager = file_manager
+        self.collection = collection
+        self.workers = workers
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self._done: set[tuple[str, str]] = set()
+        self._stats: dict = {}
+        self._start = 0.0
+        self._last_progress = 0.0
+
+    @staticmethod
+    def load_manifest(path: str) -> dict:
+        """
+        マニフェスト(JSON)を読み込む
+        形式は {ドキュメントのoid: [ファイルパス, ...]}
+        相対パスはマニフェストのディレクトリを基準とする
+
+        :param str path:
+        :return: {ドキュメントのoid: [ファイルパス, ...]}
+        :rtype: dict
+        """
+        with open(path, encoding='utf-8') as f:
+            manifest = json.load(f)
+        if not isinstance(manifest, dict):
+            raise EdmanInternalError('マニフェストの形式が不正です')
+        base = os.path.dirname(os.path.abspath(path))
+        return {str(doc_oid): [os.path.join(base, p) for p in paths]
+                for doc_oid, paths in manifest.items()}
+
+    @staticmethod
+    def _check_oid(doc_oid: str) -> str:
+        if not ObjectId.is_valid(doc_oid):
+            raise EdmanInternalError(f'ObjectIdに合致しません {doc_oid}')
+        return doc_oid
+
+    def _load_checkpoint(self) -> None:
+        """
+        チェックポイントファイルから添付済みのファイルを読み込む
+        """
+        self._done = set()
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return
+        with open(self.checkpoint, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中で中断した行は無視する
+                    continue
+                self._done.add((record['doc'], record['source']))
+
+    def _write_checkpoint(self, doc_oid: str, attached: list) -> None:
+        """
+        添付済みのファイルをチェックポイントファイルに追記する
+
+        :param str doc_oid:
+        :param list attached: [(元ファイル, ファイルのoid), ...]
+        """
+        for source, _ in attached:
+            self._done.add((doc_oid, source))
+        if self.checkpoint is None:
+            return
+        with open(self.checkpoint, 'a', encoding='utf-8') as f:
+            for source, file_oid in attached:
+                f.write(json.dumps({'doc': doc_oid, 'source': source,
+                                    'file': str(file_oid)}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _report(self, force=False) -> None:
+        """
+        進捗を通知する
+
+        :param bool force: 間隔に関わらず通知する
+        """
+        now = time.perf_counter()
+        if self.progress is None or (
+                not force and now - self._last_progress <
+                self.progress_interval):
+            return
+        self._last_progress = now
+        self.progress(self.summary())
+
+    def summary(self) -> dict:
+        """
+        処理結果(スループットを含む)を取得する
+
+        :return:
+        :rtype: dict
+        """
+        elapsed = time.perf_counter() - self._start if self._start else 0.0
+        stats = dict(self._stats)
+        stats['elapsed'] = elapsed
+        stats['files_per_s'] = stats.get('files', 0) / elapsed \
+            if elapsed else 0.0
+        stats['mb_per_s'] = stats.get('bytes', 0) / elapsed / 1e6 \
+            if elapsed else 0.0
+        return stats
+
+    def _recover_uploaded(self, doc_oid: str) -> dict:
+        """
+        前回の実行でGridFSに登録済みのファイルを取得する
+        登録後、添付前に中断したファイルを再アップロードしないために利用する
+
+        :param str doc_oid:
+        :return: {元ファイル: ファイルのoid}
+        :rtype: dict
+        """
+        files = self.file_manager.db[
+            f'{self.file_manager.gridfs_collection}.files']
+        return {f['metadata']['ingest_source']: f['_id'] for f in files.find(
+            {'metadata.ingest_doc': ObjectId(doc_oid)}, {'metadata': 1})}
+
+    def _put(self, doc_oid: str, source: str, filename: str,
+             data: Union[bytes, Callable[[], BinaryIO]]) -> tuple:
+        """
+        ワーカーでGridFSにファイルを登録する
+
+        :param str doc_oid:
+        :param str source: 元ファイル(チェックポイントのキー)
+        :param str filename:
+        :param bytes or Callable data: データ、またはファイルを開く関数
+        :return: (元ファイル, ファイルのoid, バイト数)
+        :rtype: tuple
+        """
+        metadata = {'ingest_doc': ObjectId(doc_oid), 'ingest_source': source}
+        if isinstance(data, bytes):
+            file_oid = self.file_manager.fs.put(data, filename=filename,
+                                                metadata=metadata)
+            return source, file_oid, len(data)
+        with data() as f:
+            file_oid = self.file_manager.fs.put(f, filename=filename,
+                                                metadata=metadata)
+            return source, file_oid, f.tell()
+
+    def _attach(self, doc_oid: str, attached: list) -> None:
+        """
+        GridFSに登録したファイルをドキュメントにまとめて添付する
+
+        :param str doc_oid:
+        :param list attached: [(元ファイル, ファイルのoid), ...]
+        """
+        oid = Utils.conv_objectid(doc_oid)
+        if (doc := self.file_manager.db[self.collection].find_one(
+                {'_id': oid})) is None:
+            raise EdmanDbProcessError(
+                f'対象のドキュメントが存在しません {doc_oid}')
+        # 前回の実行で添付済みのファイルは除く
+        existing = set(doc.get(Config.file, []))
+        file_oids = [file_oid for _, file_oid in attached
+                     if file_oid not in existing]
+        if file_oids:
+            self.file_manager.attach_files(self.collection, doc, file_oids)
+        self._write_checkpoint(doc_oid, attached)
+        self._stats['documents_updated'] += 1
+
+    def run(self, entries: Iterator[tuple]) -> dict:
+        """
+        ファイルを登録して添付する
+
+        :param Iterator entries: (ドキュメントのoid, 元ファイル, ファイル名,
+            データまたはファイルを開く関数)
+            ドキュメント毎にまとめて並べるとドキュメントの更新回数が最小になる
+        :return: 処理結果
+        :rtype: dict
+        """
+        self._load_checkpoint()
+        self._stats = {'files': 0, 'bytes': 0, 'skipped': 0, 'recovered': 0,
+                       'documents_updated': 0, 'errors': []}
+        self._start = time.perf_counter()
+        self._last_progress = self._start
+        self.file_manager.db[
+            f'{self.file_manager.gridfs_collection}.files'].create_index(
+            'metadata.ingest_doc', sparse=True)
+
+        # ドキュメント毎の未添付のファイルと残りのアップロード数
+        ready: dict[str, list] = {}
+        remaining: dict[str, int] = {}
+        in_flight: dict[Future, str] = {}
+        recovered: dict[str, Optional[dict]] = {}
+        # 全てのファイルを投入済みのドキュメント
+        closed: set[str] = set()
+
+        def flush(doc_oid: str):
+            batch = ready[doc_oid]
+            force = doc_oid in closed and remaining[doc_oid] == 0
+            while batch and (force or len(batch) >= self.batch_size):
+                try:
+                    self._attach(doc_oid, batch[:self.batch_size])
+                except EdmanDbProcessError as e:
+                    # 添付に失敗したファイルはattach_filesで削除されるので、
+                    # 再実行時に再度アップロードする
+                    self._stats['errors'].append(
+                        {'doc': doc_oid, 'error': str(e)})
+                del batch[:self.batch_size]
+
+        def close(doc_oid: Optional[str]):
+            if doc_oid is not None and recovered[doc_oid] is not None:
+                closed.add(doc_oid)
+                flush(doc_oid)
+
+        def collect(futures):
+            for future in futures:
+                doc_oid = in_flight.pop(future)
+                remaining[doc_oid] -= 1
+                try:
+                    source, file_oid, nbytes = future.result()
+                except Exception as e:
+                    self._stats['errors'].append(
+                        {'doc': doc_oid, 'error': str(e)})
+                else:
+                    ready[doc_oid].append((source, file_oid))
+                    self._stats['files'] += 1
+                    self._stats['bytes'] += nbytes
+                flush(doc_oid)
+            self._report()
+
+        current = None
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for doc_oid, source, filename, data in entries:
+                if (doc_oid, source) in self._done:
+                    self._stats['skipped'] += 1
+                    continue
+                if doc_oid != current:
+                    close(current)
+                    current = doc_oid
+                    closed.discard(doc_oid)
+                if doc_oid not in recovered:
+                    # ドキュメントの最初のファイルで存在と前回の登録分を確認する
+                    if self.file_manager.db[self.collection].count_documents(
+                            {'_id': ObjectId(doc_oid)}, limit=1) == 0:
+                        recovered[doc_oid] = None
+                        self._stats['errors'].append(
+                            {'doc': doc_oid,
+                             'error': '対象のドキュメントが存在しません'})
+                    else:
+                        recovered[doc_oid] = self._recover_uploaded(doc_oid)
+                        ready[doc_oid] = []
+                        remaining[doc_oid] = 0
+                if (uploaded := recovered[doc_oid]) is None:
+                    continue
+                # 前回の実行で登録済みのファイルはアップロードしない
+                if (file_oid := uploaded.get(source)) is not None:
+                    ready[doc_oid].append((source, file_oid))
+                    self._stats['recovered'] += 1
+                    flush(doc_oid)
+                    continue
+
+                # 同時に保持するデータ量を抑えるため、投入数を制限する
+                while len(in_flight) >= self.workers * 2:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                remaining[doc_oid] += 1
+                in_flight[executor.submit(self._put, doc_oid, source,
+                                          filename, data)] = doc_oid
+            closed.update(ready)
+            for doc_oid in ready:
+                flush(doc_oid)
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+        self._report(force=True)
+        return self.summary()
+
+    def iter_manifest(self, manifest: dict) -> Iterator[tuple]:
+        """
+        マニフェストから登録するファイルの一覧を作成する
+
+        :param dict manifest: {ドキュメントのoid: [ファイルパス, ...]}
+        :return:
+        :rtype: Iterator
+        """
+        for doc_oid, paths in manifest.items():
+            self._check_oid(doc_oid)
+            for path in paths:
+                yield (doc_oid, os.path.abspath(path),
+                       os.path.basename(path),
+                       lambda p=path: open(p, 'rb'))
+
+    def iter_archive(self, path: str) -> Iterator[tuple]:
+        """
+        tarまたはzipから登録するファイルの一覧を作成する
+        アーカイブ内は <ドキュメントのoid>/<ファイル名> の構成とする
+        zipはメンバを読み込み側で開き、ワーカーが展開しながらGridFSに書き込む
+        (アーカイブを閉じた後もワーカーに渡したメンバは読める)
+        tarは先頭から順に読む必要があるので、読み込み側で展開してデータを渡す
+
+        :param str path:
+        :return:
+        :rtype: Iterator
+        """
+        if zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as zf:
+                infos = sorted((i for i in zf.infolist() if not i.is_dir()),
+                               key=lambda i: i.filename)
+                for info in infos:
+                    doc_oid, filename = self._split_member(info.filename)
+                    yield (doc_oid, info.filename, filename,
+                           lambda f=zf.open(info): f)
+        elif tarfile.is_tarfile(path):
+            # 圧縮されたtarはシークが遅いので先頭から順に読む
+            with tarfile.open(path, mode='r|*') as tf:
+                for member in tf:
+                    if not member.isfile():
+                        continue
+                    doc_oid, filename = self._split_member(member.name)
+                    if (f := tf.extractfile(member)) is None:
+                        continue
+                    with f:
+                        yield doc_oid, member.name, filename, f.read()
+        else:
+            raise EdmanInternalError(f'対応していない形式です {path}')
+
+    def _split_member(self, name: str) -> tuple[str, str]:
+        """
+        アーカイブ内のパスからドキュメントのoidとファイル名を取得する
+
+        :param str name:
+        :return: (ドキュメントのoid, ファイル名)
+        :rtype: tuple
+        """
+        parts = [p for p in name.replace('\\', '/').split('/')
+                 if p and p != '.']
+        if len(parts) < 2:
+            raise EdmanInternalError(
+                f'<ドキュメントのoid>/<ファイル名> の構成ではありません {name}')
+        return self._check_oid(parts[0]), parts[-1]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='ファイルをまとめてドキュメントに添付する')
+    parser.add_argument('source',
+                        help='マニフェスト(JSON)またはtar/zipのパス')
+    parser.add_argument('--collection', required=True,
+                        help='添付先ドキュメントのコレクション')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=27017)
+    parser.add_argument('--database', required=True)
+    # edman.DBは認証付きで接続するので必須
+    parser.add_argument('--user', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--auth-source', default=None)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--checkpoint', default=None,
+                        help='default <source>.checkpoint')
+    parser.add_argument('--progress-interval', type=float, default=5.0)
+    args = parser.parse_args(argv)
+
+    con = {'host': args.host, 'port': args.port, 'database': args.database,
+           'user': args.user, 'password': args.password,
+           'options': [f'authSource={args.auth_source}']
+           if args.auth_source else []}
+    file_manager = FileManager(DB(con).get_db)
+
+    def progress(stats: dict):
+        print(f"{stats['files']} files {stats['bytes'] / 1e6:.1f} MB "
+              f"{stats['files_per_s']:.1f} files/s "
+              f"{stats['mb_per_s']:.2f} MB/s "
+              f"skipped {stats['skipped']} errors {len(stats['errors'])}",
+              file=sys.stderr)
+
+    ingest = BulkIngest(file_manager, args.collection, workers=args.workers,
+                        batch_size=args.batch_size,
+                        checkpoint=args.checkpoint or
+                        args.source + '.checkpoint',
+                        progress=progress,
+                        progress_interval=args.progress_interval)
+    if args.source.lower().endswith('.json'):
+        entries = ingest.iter_manifest(ingest.load_manifest(args.source))
+    else:
+        entries = ingest.iter_archive(args.source)
+    summary = ingest.run(entries)
+    for error in summary['errors']:
+        print(f"error: {error['doc']} {error['error']}", file=sys.stderr)
+    return 1 if summary['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+import threading
+from contextlib import contextmanager
+from io import BytesIO
+from typing import TYPE_CHECKING, Iterator, Optional
+
+from .exceptions import EdmanImageTooLargeError
+
+if TYPE_CHECKING:
+    from PIL import Image as PILImage
+
+# JPEGで縮小デコードできる倍率
+JPEG_REDUCE_FACTORS = (1, 2, 4, 8)
+
+
+class DecodePolicy:
+    """
+    サムネイル作成時の画像デコードの上限
+    デコード前にヘッダから画像サイズを確認し、上限を超える場合は
+    縮小デコード(JPEGのみ)を行い、できない場合は例外を送出する
+    """
+
+    def __init__(self, max_pixels=50_000_000, max_bytes=256 * 1024 * 1024,
+                 max_concurrent: Optional[int] = None):
+        """
+        :param int max_pixels: デコード後の最大ピクセル数
+        :param int max_bytes: デコード前のデータの最大バイト数
+        :param int or None max_concurrent: 同時にデコードできる数
+            Noneの時は制限しない
+        """
+        self.max_pixels = max_pixels
+        self.max_bytes = max_bytes
+        self._semaphore = threading.BoundedSemaphore(max_concurrent) \
+            if max_concurrent else None
+
+    def reduce_factor(self, width: int, height: int,
+                      image_format: Optional[str]) -> int:
+        """
+        上限に収めるための縮小倍率を取得する
+
+        :param int width:
+        :param int height:
+        :param str or None image_format: PILのフォーマット名
+        :return: 1, 2, 4, 8のいずれか
+        :rtype: int
+        """
+        factors = JPEG_REDUCE_FACTORS if image_format == 'JPEG' else (1,)
+        for factor in factors:
+            if (width // factor) * (height // factor) <= self.max_pixels:
+                return factor
+        self.check_pixels(width, height)
+        return 1
+
+    def check_pixels(self, width: int, height: int) -> None:
+        """
+        縮小せずにデコードする場合のピクセル数を確認する
+
+        :param int width:
+        :param int height:
+        :return:
+        """
+        if width * height > self.max_pixels:
+            raise EdmanImageTooLargeError(
+                f'画像が大きすぎます {width}x{height} '
+                f'(上限 {self.max_pixels} ピクセル)')
+
+    def check_bytes(self, content: bytes) -> None:
+        """
+        データのバイト数を確認する
+
+        :param bytes content:
+        :return:
+        """
+        if len(content) > self.max_bytes:
+            raise EdmanImageTooLargeError(
+                f'画像が大きすぎます {len(content)} バイト '
+                f'(上限 {self.max_bytes} バイト)')
+
+    def inspect(self, content: bytes) -> tuple[int, int, int]:
+        """
+        ヘッダのみを読み込み、画像サイズと縮小倍率を取得する
+
+        :param bytes content:
+        :return: (幅, 高さ, 縮小倍率)
+        :rtype: tuple
+        """
+        img = self.open(content, reduce=False)
+        width, height = img.size
+        return width, height, self.reduce_factor(width, height, img.format)
+
+    def open(self, content: bytes, target_size=None, reduce=True
+             ) -> 'PILImage.Image':
+        """
+        上限を確認してPILで画像を開く
+        必要な場合は縮小デコードを設定する(デコードはまだ行わない)
+
+        :param bytes content:
+        :param tuple or None target_size: サムネイルのサイズ
+            指定時は上限に関わらずこのサイズの2倍まで縮小デコードする
+        :param bool reduce: 縮小デコードの設定を行うか否か
+        :return:
+        :rtype: PILImage.Image
+        """
+        from PIL import Image as PILImage
+
+        self.check_bytes(content)
+        try:
+            img = PILImage.open(BytesIO(content))
+        except PILImage.DecompressionBombError as e:
+            raise EdmanImageTooLargeError(f'画像が大きすぎます {e}')
+        if not reduce:
+            return img
+
+        width, height = img.size
+        factor = self.reduce_factor(width, height, img.format)
+        requested = (max(1, width // factor), max(1, height // factor))
+        if target_size is not None:
+            # PILImage.thumbnailと同様に、サムネイルの2倍のサイズを下限とする
+            requested = (min(requested[0], target_size[0] * 2),
+                         min(requested[1], target_size[1] * 2))
+        if requested != (width, height):
+            img.draft(img.mode, requested)
+        return img
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """
+        同時にデコードできる数を制限する
+
+        :return:
+        :rtype: Iterator
+        """
+        if self._semaphore is None:
+            yield
+            return
+        with self._semaphore:
+            yield
@@ -0,0 +1,302 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import BinaryIO, Iterable, Optional
+
+from edman.exceptions import EdmanInternalError
+
+
+class DiskCache:
+    """
+    GridFSのファイルをローカルディスクにキャッシュする
+    容量の上限を超えた場合は最終アクセスが古いものから削除する(LRU)
+    書き込みは一時ファイルからのrenameで行うため、読み込み中に不完全な
+    ファイルが見えることはない
+    最終アクセス日時はファイルのmtimeに記録するので、再起動後も順序を引き継ぐ
+    ファイル名等のメタデータは別ファイル(JSON)に保存する
+    """
+    # 書き込み中の一時ファイルの接頭辞
+    temp_prefix = '.tmp-'
+    # メタデータのファイルの接頭辞(キーは.で始められないので衝突しない)
+    meta_prefix = '.meta-'
+    # 書き込み中とみなす一時ファイルの経過時間(秒)
+    temp_max_age = 3600
+    # 他のプロセスの書き込み、削除を反映するためにディレクトリを読み直す間隔(秒)
+    scan_interval = 60.0
+
+    def __init__(self, directory: str, max_bytes=1024 * 1024 * 1024):
+        """
+        :param str directory: キャッシュを保存するディレクトリ
+        :param int max_bytes: 容量の上限 default 1GiB
+        """
+        if max_bytes <= 0:
+            raise EdmanInternalError('容量の上限は1以上を指定してください')
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # キー: サイズ 古い順
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._total = 0
+        self._scanned = 0.0
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _scan(self) -> None:
+        """
+        ディレクトリからキャッシュの一覧を読み込む
+        他のプロセスが書き込んだファイルも対象になる
+        """
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.startswith(self.temp_prefix):
+                    # 異常終了で残った一時ファイルを削除する
+                    if time.time() - stat.st_mtime > self.temp_max_age:
+                        try:
+                            os.unlink(entry.path)
+                        except FileNotFoundError:
+                            pass
+                    continue
+                if entry.name.startswith(self.meta_prefix):
+                    continue
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        entries.sort()
+        self._entries = OrderedDict((name, size) for _, name, size in entries)
+        self._total = sum(self._entries.values())
+        self._scanned = time.monotonic()
+
+    def path(self, key: str) -> str:
+        """
+        キャッシュファイルのパス
+
+        :param str key:
+        :return:
+        :rtype: str
+        """
+        key = str(key)
+        if not key or key.startswith('.') or os.sep in key or \
+                (os.altsep and os.altsep in key):
+            raise EdmanInternalError(f'キャッシュのキーが不正です {key}')
+        return os.path.join(self.directory, key)
+
+    def _meta_path(self, key: str) -> str:
+        """
+        メタデータのファイルのパス
+
+        :param str key:
+        :return:
+        :rtype: str
+        """
+        self.path(key)
+        return os.path.join(self.directory, self.meta_prefix + str(key))
+
+    def _unlink(self, key: str) -> bool:
+        """
+        キャッシュファイルとメタデータを削除する
+
+        :param str key:
+        :return: キャッシュファイルが存在した場合はTrue
+        :rtype: bool
+        """
+        try:
+            os.unlink(self._meta_path(key))
+        except FileNotFoundError:
+            pass
+        try:
+            os.unlink(self.path(key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def __contains__(self, key) -> bool:
+        return os.path.isfile(self.path(key))
+
+    def _touch(self, key: str) -> None:
+        """
+        最終アクセス日時を更新する
+
+        :param str key:
+        """
+        try:
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+
+    def open(self, key) -> Optional[BinaryIO]:
+        """
+        キャッシュファイルを開く
+        実ファイルのハンドルなので、sendfile(wsgi.file_wrapper)でそのまま送信できる
+
+        :param key:
+        :return: キャッシュが無い場合はNone
+        :rtype: BinaryIO or None
+        """
+        key = str(key)
+        try:
+            f = open(self.path(key), 'rb')
+        except FileNotFoundError:
+            return None
+        self._touch(key)
+        return f
+
+    def read(self, key) -> Optional[bytes]:
+        """
+        キャッシュを読み込む
+        メモリマップを経由せずにファイルから直接読み込む
+
+        :param key:
+        :return: キャッシュが無い場合はNone
+        :rtype: bytes or None
+        """
+        if (f := self.open(key)) is None:
+            return None
+        with f:
+            return f.read()
+
+    def read_meta(self, key) -> Optional[dict]:
+        """
+        put()で保存したメタデータを読み込む
+
+        :param key:
+        :return: メタデータが無い場合はNone
+        :rtype: dict or None
+        """
+        try:
+            with open(self._meta_path(str(key)), encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_meta(self, key: str, meta: dict) -> None:
+        """
+        メタデータを一時ファイルからのrenameで書き込む
+
+        :param str key:
+        :param dict meta:
+        """
+        fd, temp_path = tempfile.mkstemp(prefix=self.temp_prefix,
+                                         dir=self.directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(temp_path, self._meta_path(key))
+        except BaseException:
+            try:
+                os.unlink(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def put(self, key, chunks: Iterable[bytes], meta: Optional[dict] = None
+            ) -> Optional[str]:
+        """
+        キャッシュに書き込む
+        容量の上限より大きい場合は他のキャッシュを削除しないように書き込まない
+        メタデータはキャッシュファイルより先に書き込むので、キャッシュが
+        見えた時にはメタデータも読める
+
+        :param key:
+        :param Iterable chunks: ファイルの中身
+        :param dict or None meta: JSONにできるメタデータ
+        :return: キャッシュファイルのパス 書き込まなかった場合はNone
+        :rtype: str or None
+        """
+        key = str(key)
+        path = self.path(key)
+        fd, temp_path = tempfile.mkstemp(prefix=self.temp_prefix,
+                                         dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                size = 0
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        break
+                    f.write(chunk)
+            if size > self.max_bytes:
+                os.unlink(temp_path)
+                return None
+            if meta is not None:
+                self._write_meta(key, meta)
+            else:
+                try:
+                    os.unlink(self._meta_path(key))
+                except FileNotFoundError:
+                    pass
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.unlink(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+        with self._lock:
+            self._total += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+        if self._total > self.max_bytes:
+            self.evict()
+        return path
+
+    def delete(self, key) -> None:
+        """
+        キャッシュを削除する
+
+        :param key:
+        """
+        key = str(key)
+        self._unlink(key)
+        with self._lock:
+            self._total -= self._entries.pop(key, 0)
+
+    def evict(self) -> None:
+        """
+        容量の上限以下になるまで古いキャッシュを削除する
+        ディレクトリはscan_interval毎、または一覧と実ファイルが食い違った
+        場合にのみ読み直す
+        """
+        with self._lock:
+            if time.monotonic() - self._scanned > self.scan_interval:
+                # 他のプロセスの書き込み、削除を反映する
+                self._scan()
+            if not self._evict_entries():
+                # 他のプロセスに削除されていたので一覧を読み直す
+                self._scan()
+                self._evict_entries()
+
+    def _evict_entries(self) -> bool:
+        """
+        一覧の古い順にキャッシュを削除する ロックを取得して呼び出す
+
+        :return: 一覧と実ファイルが一致していればTrue
+        :rtype: bool
+        """
+        consistent = True
+        while self._total > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._total -= size
+            if not self._unlink(key):
+                consistent = False
+        return consistent
+
+    def clear(self) -> None:
+        """
+        全てのキャッシュを削除する
+        """
+        with self._lock:
+            self._scan()
+            keys = list(self._entries)
+        for key in keys:
+            self.delete(key)
@@ -0,0 +1,8 @@
+from edman.exceptions import EdmanInternalError
+
+
+class EdmanImageTooLargeError(EdmanInternalError):
+    """
+    画像がデコードの上限(ピクセル数、バイト数)を超えている
+    """
+    pass
@@ -1,27 +1,83 @@
 import base64
 import binascii
 import gzip
+import hashlib
+import json
 import mimetypes
 import os
+import tempfile
+import zlib
+from contextlib import AbstractContextManager, nullcontext
+from datetime import datetime, timedelta, timezone
 from io import BytesIO
-from typing import Any, List, Optional, Tuple, Union
+from typing import (TYPE_CHECKING, Any, BinaryIO, Iterator, List, Optional,
+                    Tuple, Union)
 
-import cv2
 import gridfs
-import imutils
-import numpy as np
 from bson import ObjectId
 from edman import Config, File
 from edman.exceptions import EdmanDbProcessError, EdmanInternalError
 from edman.utils import Utils
 from gridfs.errors import GridFSError
-from PIL import Image as PILImage
+from pymongo import ASCENDING, ReplaceOne, ReturnDocument
 from werkzeug.datastructures import FileStorage
 
+from . import metrics
+from .decode_policy import DecodePolicy
+from .disk_cache import DiskCache
+from .read_routing import ReadRouting, causal_session, current_session
+from .zip_stream import ZIP64_THRESHOLD, ZipStream
+
+if TYPE_CHECKING:
+    import numpy as np
+    from PIL import Image as PILImage
+
+# 画像処理ライブラリ(PIL, numpy, cv2, imutils)は起動時間とメモリ使用量を
+# 抑えるため、利用するメソッド内でインポートする
+
+# サムネイルの出力フォーマット毎の保存オプション
+THUMBNAIL_SAVE_OPTIONS: dict[str, dict] = {
+    'jpeg': {'quality': 80},
+    'webp': {'quality': 75, 'method': 4},
+    'avif': {'quality': 60, 'speed': 8},
+}
+# Acceptヘッダで優先するサムネイルの出力フォーマット(優先度順)
+THUMBNAIL_NEGOTIABLE_FORMATS = ('avif', 'webp')
+# コントラスト調整してサムネイルを作成する科学データの拡張子
+SCIENTIFIC_SUFFIXES = ('npy', 'tif', 'tiff')
+# 8bitで表示できるPILのモード(これ以外はコントラスト調整する)
+DISPLAYABLE_MODES = ('1', 'L', 'LA', 'P', 'RGB', 'RGBA', 'CMYK', 'YCbCr')
+# 通常のサムネイル作成でそのまま扱えるTIFFのモード
+DIRECT_THUMBNAIL_MODES = ('1', 'L', 'LA', 'P', 'RGB', 'RGBA')
+# 代表フレームからサムネイルを作成する動画の拡張子
+VIDEO_SUFFIXES = ('mp4', 'm4v', 'mov', 'avi', 'mkv', 'webm')
+
 
 class FileManager(File):
+    # GridFSのコレクション名(edmanの既定)
+    gridfs_collection = 'fs'
+    # 再開可能アップロードの途中状態を保存するコレクション
+    pending_upload_collection = 'fs.pending'
+    # 再開可能アップロードでまとめて書き込むチャンク数
+    upload_write_batch = 16
+    # 追記中の書き込み権を失効させるまでの時間
+    # (書き込み毎に延長するので、upload_write_batch分の書き込み時間より長くする)
+    upload_claim_timeout = timedelta(minutes=5)
+    # サムネイル作成時のデコードの上限 Noneの時は制限しない
+    decode_policy: Optional[DecodePolicy] = None
+    # サムネイルのキャッシュを保存するGridFSのバケット
+    thumbnail_bucket = 'thumbnails'
+    # 動画のサムネイル作成時に先に読み込むバイト数
+    video_head_bytes = 8 * 1024 * 1024
+    # ダウンロードしたファイルのローカルディスクのキャッシュ Noneの時は無効
+    disk_cache: Optional[DiskCache] = None
+    # 読み込み専用の処理の送り先 Noneの時はプライマリから読み込む
+    read_routing: Optional[ReadRouting] = None
+
     def __init__(self, db=None):
         super().__init__(db)
+        self._thumbnail_fs = None
+        self._read_fs: dict[tuple, gridfs.GridFS] = {}
 
     def web_upload(self, collection: str, oid: Union[str, ObjectId],
                    up_file: FileStorage) -> None:
@@ -36,7 +92,8 @@ class FileManager(File):
         oid = Utils.conv_objectid(oid)
 
         # ドキュメント存在確認&対象ドキュメント取得
-        if (doc := self.db[collection].find_one({'_id': oid})) is None:
+        if (doc := self.db[collection].find_one(
+                {'_id': oid}, session=current_session())) is None:
             raise EdmanDbProcessError('対象のドキュメントが存在しません')
 
         try:
@@ -45,19 +102,32 @@ class FileManager(File):
         except EdmanDbProcessError as e:
             raise e
         else:  # ドキュメントの更新
-            try:
-                new_doc = self.file_list_attachment(doc, inserted_file_oids)
-                replace_result = self.db[collection].replace_one({'_id': oid},
-                                                                 new_doc)
-                if replace_result.modified_count != 1:
-                    # ドキュメントが更新されていない場合はgridfsからデータを削除する
-                    self.fs_delete(inserted_file_oids)
-                    raise EdmanDbProcessError(
-                        'ドキュメントの更新ができませんでした.')
-            except Exception as e:
-                # 途中で例外が起きた場合、gridfsからデータを削除する
-                self.fs_delete(inserted_file_oids)
-                raise EdmanDbProcessError(str(e))
+            self.attach_files(collection, doc, inserted_file_oids)
+
+    def attach_files(self, collection: str, doc: dict,
+                     file_oids: list) -> None:
+        """
+        GridFSに登録済みのファイルをドキュメントに添付する
+        失敗した場合はGridFSからファイルを削除する
+
+        :param str collection:
+        :param dict doc: 対象ドキュメント
+        :param list file_oids:
+        :return:
+        """
+        try:
+            new_doc = self.file_list_attachment(doc, file_oids)
+            replace_result = self.db[collection].replace_one(
+                {'_id': doc['_id']}, new_doc, session=current_session())
+            if replace_result.modified_count != 1:
+                # ドキュメントが更新されていない場合はgridfsからデータを削除する
+                self.fs_delete(file_oids)
+                raise EdmanDbProcessError(
+                    'ドキュメントの更新ができませんでした.')
+        except Exception as e:
+            # 途中で例外が起きた場合、gridfsからデータを削除する
+            self.fs_delete(file_oids)
+            raise EdmanDbProcessError(str(e))
 
     def web_grid_in(self, file: FileStorage) -> list[Any]:
         """
@@ -69,7 +139,9 @@ class FileManager(File):
         """
         inserted = []
         try:
-            f = file.stream.read()
+            with metrics.stage('web_grid_in.read') as st:
+                f = file.stream.read()
+                st.add_bytes(len(f))
             metadata = {'filename': file.filename}
         except OSError:
             raise EdmanDbProcessError(
@@ -77,17 +149,334 @@ class FileManager(File):
         except Exception:
             raise
         try:
-            inserted.append(self.fs.put(f, **metadata))
+            with metrics.stage('web_grid_in.put') as st:
+                inserted.append(self.fs.put(f, session=current_session(),
+                                            **metadata))
+                st.add_bytes(len(f))
         except GridFSError as e:
             raise EdmanDbProcessError(e)
         return inserted
 
-    def file_download(self, oid: Union[ObjectId, str]
+    def upload_init(self, collection: str, oid: Union[str, ObjectId],
+                    filename: str, chunk_size: Optional[int] = None
+                    ) -> ObjectId:
+        """
+        再開可能なアップロードを開始する
+
+        :param str collection: 添付先ドキュメントのコレクション
+        :param str or ObjectId oid: 添付先ドキュメントのoid
+        :param str filename:
+        :param int or None chunk_size: Noneの時はGridFSの既定値
+        :return: アップロード中のファイルのoid
+        :rtype: ObjectId
+        """
+        oid = Utils.conv_objectid(oid)
+        if self.db[collection].count_documents({'_id': oid}, limit=1) == 0:
+            raise EdmanDbProcessError('対象のドキュメントが存在しません')
+
+        # チャンクはGridFSを経由せずに書き込むので、GridFSが作成する
+        # {files_id, n}の一意インデックスをここで作成する
+        self.db[f'{self.gridfs_collection}.chunks'].create_index(
+            [('files_id', ASCENDING), ('n', ASCENDING)], unique=True)
+
+        now = datetime.now(timezone.utc)
+        file_oid = ObjectId()
+        self.db[self.pending_upload_collection].insert_one({
+            '_id': file_oid,
+            'collection': collection,
+            'doc_oid': oid,
+            'filename': filename,
+            'chunk_size': chunk_size or gridfs.DEFAULT_CHUNK_SIZE,
+            'length': 0,
+            'tail': b'',
+            'created': now,
+            'updated': now,
+        })
+        return file_oid
+
+    def _get_pending_upload(self, file_oid: Union[str, ObjectId]) -> dict:
+        """
+        アップロード中のファイルの状態を取得する
+
+        :param str or ObjectId file_oid:
+        :return:
+        :rtype: dict
+        """
+        file_oid = Utils.conv_objectid(file_oid)
+        if (pending := self.db[self.pending_upload_collection].find_one(
+                {'_id': file_oid})) is None:
+            raise EdmanDbProcessError('アップロード中のファイルが存在しません')
+        return pending
+
+    def upload_offset(self, file_oid: Union[str, ObjectId]) -> int:
+        """
+        アップロード済みのバイト数を取得する
+        クライアントはこの位置からアップロードを再開する
+
+        :param str or ObjectId file_oid:
+        :return:
+        :rtype: int
+        """
+        return self._get_pending_upload(file_oid)['length']
+
+    def _claim_upload(self, file_oid: ObjectId, length: int,
+                      writer: ObjectId) -> None:
+        """
+        アップロード中のファイルへの書き込み権を取得する
+        lengthが変わっていない時だけ取得でき、他のリクエストが書き込み中の
+        間は取得できない(書き込み権の失効後は取得できる)
+
+        :param ObjectId file_oid:
+        :param int length: 追記前のアップロード済みバイト数
+        :param ObjectId writer: 書き込み権の識別子
+        :return:
+        """
+        now = datetime.now(timezone.utc)
+        claimed = self.db[self.pending_upload_collection].find_one_and_update(
+            {'_id': file_oid, 'length': length,
+             '$or': [{'writer': None},
+                     {'claimed': {'$lt': now - self.upload_claim_timeout}}]},
+            {'$set': {'writer': writer, 'claimed': now}},
+            projection={'_id': 1}, return_document=ReturnDocument.AFTER)
+        if claimed is None:
+            raise EdmanDbProcessError(
+                '他のリクエストで追記されたため更新できませんでした')
+
+    def _renew_upload_claim(self, file_oid: ObjectId,
+                            writer: ObjectId) -> None:
+        """
+        書き込み権を延長する 失効して他のリクエストに取得されていればエラー
+
+        :param ObjectId file_oid:
+        :param ObjectId writer:
+        :return:
+        """
+        result = self.db[self.pending_upload_collection].update_one(
+            {'_id': file_oid, 'writer': writer},
+            {'$set': {'claimed': datetime.now(timezone.utc)}})
+        if result.matched_count != 1:
+            raise EdmanDbProcessError(
+                '他のリクエストで追記されたため更新できませんでした')
+
+    def upload_append(self, file_oid: Union[str, ObjectId], offset: int,
+                      data: Union[bytes, BinaryIO]) -> int:
+        """
+        アップロード中のファイルにデータを追記する
+        データはGridFSのチャンクとして直接書き込み、チャンクサイズに
+        満たない末尾のみを途中状態に保存する
+        既に受信済みの範囲を含む場合(再送)はその範囲を読み飛ばす
+        チャンクは書き込み権を取得してから書き込むので、同じオフセットへの
+        同時の追記は一方だけが成功する
+
+        :param str or ObjectId file_oid:
+        :param int offset: dataの先頭位置
+        :param bytes or BinaryIO data:
+        :return: 追記後のアップロード済みバイト数
+        :rtype: int
+        """
+        pending = self._get_pending_upload(file_oid)
+        length = pending['length']
+        chunk_size = pending['chunk_size']
+        if offset < 0 or offset > length:
+            raise EdmanInternalError(
+                f'オフセットが不正です. 次のオフセットは{length}です')
+
+        stream = BytesIO(data) if isinstance(data, bytes) else data
+        # 受信済みの範囲を読み飛ばす
+        skip = length - offset
+        while skip > 0:
+            if not (skipped := stream.read(min(skip, chunk_size))):
+                return length
+            skip -= len(skipped)
+
+        tail = bytes(pending['tail'])
+        if not (block := stream.read(chunk_size - len(tail))):
+            return length
+
+        writer = ObjectId()
+        self._claim_upload(pending['_id'], length, writer)
+        chunks = self.db[f'{self.gridfs_collection}.chunks']
+        n = (length - len(tail)) // chunk_size
+        received = 0
+        requests = []
+        try:
+            with metrics.stage('upload_append') as st:
+                while block:
+                    received += len(block)
+                    tail += block
+                    if len(tail) == chunk_size:
+                        # 再送時に重複しないよう、files_idとnで置き換える
+                        requests.append(ReplaceOne(
+                            {'files_id': pending['_id'], 'n': n},
+                            {'files_id': pending['_id'], 'n': n,
+                             'data': tail},
+                            upsert=True))
+                        n += 1
+                        tail = b''
+                    if len(requests) >= self.upload_write_batch:
+                        self._renew_upload_claim(pending['_id'], writer)
+                        chunks.bulk_write(requests, ordered=False)
+                        requests = []
+                    block = stream.read(chunk_size - len(tail))
+                if requests:
+                    self._renew_upload_claim(pending['_id'], writer)
+                    chunks.bulk_write(requests, ordered=False)
+                st.add_bytes(received)
+        except BaseException:
+            # 書き込んだチャンクはlengthより後ろなので、再送で上書きされる
+            self.db[self.pending_upload_collection].update_one(
+                {'_id': pending['_id'], 'writer': writer},
+                {'$unset': {'writer': '', 'claimed': ''}})
+            raise
+
+        result = self.db[self.pending_upload_collection].update_one(
+            {'_id': pending['_id'], 'writer': writer},
+            {'$set': {'length': length + received, 'tail': tail,
+                      'updated': datetime.now(timezone.utc)},
+             '$unset': {'writer': '', 'claimed': ''}})
+        if result.modified_count != 1:
+            raise EdmanDbProcessError(
+                '他のリクエストで追記されたため更新できませんでした')
+        return length + received
+
+    def upload_finalize(self, file_oid: Union[str, ObjectId]) -> ObjectId:
+        """
+        アップロードを完了し、ファイルをドキュメントに添付する
+        途中状態は追記中でない時だけ取り出して削除するので、完了後に
+        同時の追記がチャンクを書き込むことはない
+
+        :param str or ObjectId file_oid:
+        :return: 添付したファイルのoid
+        :rtype: ObjectId
+        """
+        pending = self._get_pending_upload(file_oid)
+        collection = pending['collection']
+        if (doc := self.db[collection].find_one(
+                {'_id': pending['doc_oid']})) is None:
+            self.upload_abort(pending['_id'])
+            raise EdmanDbProcessError('対象のドキュメントが存在しません')
+
+        # _claim_upload()と同じ条件で取得する
+        now = datetime.now(timezone.utc)
+        claimed = self.db[self.pending_upload_collection].find_one_and_delete(
+            {'_id': pending['_id'], 'length': pending['length'],
+             '$or': [{'writer': None},
+                     {'claimed': {'$lt': now - self.upload_claim_timeout}}]})
+        if claimed is None:
+            raise EdmanDbProcessError('追記中のため完了できません')
+
+        try:
+            self._write_upload_file(claimed)
+        except BaseException:
+            # 再度完了できるように途中状態を戻す
+            claimed.pop('writer', None)
+            claimed.pop('claimed', None)
+            self.db[self.pending_upload_collection].insert_one(claimed)
+            raise
+        self.attach_files(collection, doc, [pending['_id']])
+        return pending['_id']
+
+    def _write_upload_file(self, pending: dict) -> None:
+        """
+        アップロードの末尾のチャンクとGridFSのファイル情報を書き込む
+
+        :param dict pending: 取り出したアップロードの途中状態
+        :return:
+        """
+        chunk_size = pending['chunk_size']
+        tail = bytes(pending['tail'])
+        chunks = self.db[f'{self.gridfs_collection}.chunks']
+        n = (pending['length'] - len(tail)) // chunk_size
+        if tail:
+            chunks.replace_one(
+                {'files_id': pending['_id'], 'n': n},
+                {'files_id': pending['_id'], 'n': n, 'data': tail},
+                upsert=True)
+            n += 1
+        # 失敗した追記で書き込まれた、ファイルの末尾より後ろのチャンクを削除する
+        chunks.delete_many({'files_id': pending['_id'], 'n': {'$gte': n}})
+        try:
+            self.db[f'{self.gridfs_collection}.files'].insert_one({
+                '_id': pending['_id'],
+                'filename': pending['filename'],
+                'chunkSize': chunk_size,
+                'length': pending['length'],
+                'uploadDate': datetime.now(timezone.utc),
+            })
+        except Exception as e:
+            raise EdmanDbProcessError(
+                f'DBにファイルをアップロード出来ませんでした {e}')
+
+    def upload_abort(self, file_oid: Union[str, ObjectId]) -> None:
+        """
+        アップロードを中止し、書き込み済みのチャンクを削除する
+
+        :param str or ObjectId file_oid:
+        :return:
+        """
+        file_oid = Utils.conv_objectid(file_oid)
+        self.db[f'{self.gridfs_collection}.chunks'].delete_many(
+            {'files_id': file_oid})
+        self.db[self.pending_upload_collection].delete_one({'_id': file_oid})
+
+    def sweep_pending_uploads(self, max_age=timedelta(hours=24)) -> int:
+        """
+        一定時間更新されていないアップロードを削除する
+        定期的に実行することを想定
+
+        :param timedelta max_age: default 24時間
+        :return: 削除したアップロードの数
+        :rtype: int
+        """
+        expired = datetime.now(timezone.utc) - max_age
+        file_oids = [pending['_id'] for pending in
+                     self.db[self.pending_upload_collection].find(
+                         {'updated': {'$lt': expired}}, {'_id': 1})]
+        for file_oid in file_oids:
+            self.upload_abort(file_oid)
+        return len(file_oids)
+
+    def read_fs(self, read_routing: Optional[ReadRouting] = None
+                ) -> gridfs.GridFS:
+        """
+        読み込み専用の処理に使うGridFSを取得する
+
+        :param ReadRouting or None read_routing: 読み込み先
+            Noneの時はself.read_routingを利用する
+        :return:
+        :rtype: gridfs.GridFS
+        """
+        if read_routing is None:
+            read_routing = self.read_routing
+        if read_routing is None or read_routing.is_primary:
+            return self.fs
+        if (fs := self._read_fs.get(read_routing.key)) is None:
+            fs = gridfs.GridFS(read_routing.apply(self.db),
+                               self.gridfs_collection)
+            self._read_fs[read_routing.key] = fs
+        return fs
+
+    def causal_session(self, after: Optional[dict] = None):
+        """
+        因果一貫性のあるセッションを開始するコンテキストマネージャを取得する
+        ブロック内でweb_uploadした後は、セカンダリから読み込む場合も
+        アップロードしたファイルを読み込める
+
+        :param dict or None after: 前のセッションの時刻
+            read_routing.session_tokenの結果
+        :return:
+        """
+        return causal_session(self.db, after)
+
+    def file_download(self, oid: Union[ObjectId, str],
+                      read_routing: Optional[ReadRouting] = None
                       ) -> tuple[bytes, str, Optional[str]]:
         """
         GridFsからファイルをダウンロードする
 
         :param str or ObjectId oid:
+        :param ReadRouting or None read_routing: 読み込み先
+            Noneの時はself.read_routingを利用する
         :rtype: tuple
         :return:
         """
@@ -97,25 +486,212 @@ class FileManager(File):
             else:
                 raise ValueError('ObjectIdに合致しません')
 
+        # キャッシュにある場合はDBに問い合わせない
+        if self.disk_cache is not None:
+            with metrics.stage('file_download.disk_cache') as st:
+                if (meta := self.disk_cache.read_meta(oid)) is not None and \
+                        (content_data := self.disk_cache.read(oid)) \
+                        is not None:
+                    st.add_bytes(len(content_data))
+                    return (content_data, meta['filename'],
+                            mimetypes.guess_type(meta['filename'])[0])
+
         # ファイル情報を取得
         try:
-            content = self.fs.get(oid)
+            content = self.read_fs(read_routing).get(
+                oid, session=current_session())
         except gridfs.errors.NoFile:
             raise ValueError('ファイルが存在しません')
         except gridfs.errors.GridFSError:
             raise
 
+        file_name = content.filename
+        mimetype = mimetypes.guess_type(file_name)[0]
+
         try:
-            content_data = content.read()
+            with metrics.stage('file_download.fetch') as st:
+                content_data = content.read()
+                st.add_bytes(len(content_data))
             # gzip圧縮されている場合は解凍する
             if binascii.hexlify(content_data[:2]) == b'1f8b':
-                content_data = gzip.decompress(content_data)
+                with metrics.stage('file_download.inflate') as st:
+                    content_data = gzip.decompress(content_data)
+                    st.add_bytes(len(content_data))
         except Exception:
             raise
 
+        # 容量の上限より大きいファイルは他のキャッシュを削除しないように
+        # キャッシュしない
+        if self.disk_cache is not None and \
+                len(content_data) <= self.disk_cache.max_bytes:
+            self.disk_cache.put(oid, (content_data,),
+                                meta={'filename': file_name})
+        return content_data, file_name, mimetype
+
+    def file_open(self, oid: Union[ObjectId, str],
+                  read_routing: Optional[ReadRouting] = None
+                  ) -> tuple[BinaryIO, str, Optional[str]]:
+        """
+        ファイルを読み込み用のハンドルとして取得する
+        ディスクキャッシュが有効な場合はキャッシュファイルのハンドルを返すので、
+        send_file等でsendfileによる送信ができる
+        キャッシュに無い場合はGridFSからキャッシュに書き込んでから開く
+
+        :param str or ObjectId oid:
+        :param ReadRouting or None read_routing: 読み込み先
+            Noneの時はself.read_routingを利用する
+        :return: (ファイルハンドル, ファイル名, mimetype)
+        :rtype: tuple
+        """
+        if self.disk_cache is None:
+            content_data, file_name, mimetype = self.file_download(
+                oid, read_routing)
+            return BytesIO(content_data), file_name, mimetype
+
+        oid = Utils.conv_objectid(oid)
+        # キャッシュにある場合はDBに問い合わせない
+        if (meta := self.disk_cache.read_meta(oid)) is not None and \
+                (f := self.disk_cache.open(oid)) is not None:
+            return (f, meta['filename'],
+                    mimetypes.guess_type(meta['filename'])[0])
+
+        try:
+            content = self.read_fs(read_routing).get(
+                oid, session=current_session())
+        except gridfs.errors.NoFile:
+            raise ValueError('ファイルが存在しません')
         file_name = content.filename
         mimetype = mimetypes.guess_type(file_name)[0]
-        return content_data, file_name, mimetype
+
+        f = None
+        if self.stored_file_size(content) <= self.disk_cache.max_bytes:
+            with metrics.stage('file_open.fetch'):
+                self.disk_cache.put(oid, self.iter_file_chunks(
+                    oid, read_routing), meta={'filename': file_name})
+            f = self.disk_cache.open(oid)
+        if f is None:
+            # 容量の上限より大きいファイルはキャッシュに残らない
+            f = BytesIO(b''.join(self.iter_file_chunks(oid, read_routing)))
+        return f, file_name, mimetype
+
+    @staticmethod
+    def stored_file_size(grid_out: gridfs.GridOut) -> int:
+        """
+        GridFSのファイルの解凍後のサイズ
+        gzip圧縮されている場合はgzipの末尾に記録されたサイズを用いる
+        (4GiB以上のファイルは2^32の剰余になるので目安とする)
+
+        :param gridfs.GridOut grid_out:
+        :return:
+        :rtype: int
+        """
+        position = grid_out.tell()
+        try:
+            grid_out.seek(0)
+            if grid_out.length < 18 or \
+                    binascii.hexlify(grid_out.read(2)) != b'1f8b':
+                return grid_out.length
+            grid_out.seek(-4, os.SEEK_END)
+            return int.from_bytes(grid_out.read(4), 'little')
+        finally:
+            grid_out.seek(position)
+
+    def iter_file_chunks(self, oid: Union[ObjectId, str],
+                         read_routing: Optional[ReadRouting] = None
+                         ) -> Iterator[bytes]:
+        """
+        GridFSからファイルをチャンク単位で読み出す
+
+        :param str or ObjectId oid:
+        :param ReadRouting or None read_routing: 読み込み先
+            Noneの時はself.read_routingを利用する
+        :return:
+        :rtype: Iterator
+        """
+        oid = Utils.conv_objectid(oid)
+        try:
+            content = self.read_fs(read_routing).get(
+                oid, session=current_session())
+        except gridfs.errors.NoFile:
+            raise ValueError('ファイルが存在しません')
+
+        chunk = content.readchunk()
+        if binascii.hexlify(chunk[:2]) != b'1f8b':
+            while chunk:
+                yield chunk
+                chunk = content.readchunk()
+            return
+
+        # gzip圧縮されている場合は逐次解凍する
+        decompressor = zlib.decompressobj(wbits=31)
+        while chunk:
+            while chunk:
+                if data := decompressor.decompress(chunk):
+                    yield data
+                if not decompressor.eof:
+                    break
+                # 連結されたgzipメンバーに対応
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(wbits=31)
+            chunk = content.readchunk()
+        if data := decompressor.flush():
+            yield data
+
+    def zip_stream(self, collection: Optional[str] = None,
+                   oid: Union[str, ObjectId, None] = None,
+                   file_oids: Optional[list] = None) -> Iterator[bytes]:
+        """
+        ドキュメントの添付ファイルをZIPとしてストリームで出力する
+        collectionとoidを指定した場合はドキュメントの添付ファイル全て、
+        file_oidsを指定した場合はそのファイルのみを対象とする
+
+        :param str or None collection:
+        :param str or ObjectId or None oid:
+        :param list or None file_oids:
+        :return:
+        :rtype: Iterator
+        """
+        if file_oids is None:
+            if collection is None or oid is None:
+                raise EdmanInternalError(
+                    'collectionとoid、またはfile_oidsを指定してください')
+            oid = Utils.conv_objectid(oid)
+            if (doc := self.db[collection].find_one(
+                    {'_id': oid}, {Config.file: 1})) is None:
+                raise EdmanDbProcessError('対象のドキュメントが存在しません')
+            file_oids = doc.get(Config.file, [])
+
+        zip_stream = ZipStream()
+        for file_oid in file_oids:
+            yield from self.write_zip_entry(zip_stream, file_oid)
+        yield from zip_stream.close()
+
+    def write_zip_entry(self, zip_stream: ZipStream,
+                        oid: Union[ObjectId, str],
+                        prefix='') -> Iterator[bytes]:
+        """
+        GridFSのファイルをZipStreamのエントリとして書き込む
+
+        :param ZipStream zip_stream:
+        :param str or ObjectId oid:
+        :param str prefix: アーカイブ内のパスの接頭辞
+        :return:
+        :rtype: Iterator
+        """
+        oid = Utils.conv_objectid(oid)
+        try:
+            grid_out = self.read_fs().get(oid, session=current_session())
+        except gridfs.errors.NoFile:
+            raise ValueError('ファイルが存在しません')
+        # gzip格納時は解凍後のサイズが分からないのでZIP64にする
+        head = grid_out.read(2)
+        size_hint = ZIP64_THRESHOLD if binascii.hexlify(
+            head) == b'1f8b' else grid_out.length
+        yield from zip_stream.write_entry(
+            prefix + (grid_out.filename or str(oid)),
+            self.iter_file_chunks(oid),
+            size_hint=size_hint,
+            date_time=grid_out.upload_date)
 
     def file_delete(self, collection: str, oid: Union[str, ObjectId],
                     delete_list: List[str]):
@@ -155,6 +731,10 @@ class FileManager(File):
                 self.fs_delete(list(delete_items))
             except Exception:
                 raise
+            self.delete_cached_thumbnails(list(delete_items))
+            if self.disk_cache is not None:
+                for item in delete_items:
+                    self.disk_cache.delete(item)
 
     @staticmethod
     def extract_thumb_list(files: list, thumbnail_suffix: list
@@ -174,7 +754,10 @@ class FileManager(File):
     @staticmethod
     def generate_thumbnail(content: bytes, ext: str,
                            thumbnail_size: tuple[int, int],
-                           file_decode='utf-8') -> str:
+                           file_decode='utf-8', output_format=None,
+                           quality=None,
+                           decode_policy: Optional[DecodePolicy] = None
+                           ) -> str:
         """
         サムネイル画像をbase64で作成
 
@@ -182,21 +765,42 @@ class FileManager(File):
         :param str ext:
         :param tuple thumbnail_size:
         :param str file_decode: default 'utf-8'
+        :param str or None output_format: Noneの時は元の拡張子で出力
+        :param int or None quality: Noneの時はフォーマット毎の既定値
+        :param DecodePolicy or None decode_policy: デコードの上限
         :return:
         :rtype: str
         """
+        from PIL import Image as PILImage
+
         try:
-            img = PILImage.open(BytesIO(content))
-            # img.thumbnail(size=thumbnail_size, resample=PILImage.LANCZOS)
-            img.thumbnail(size=thumbnail_size, resample=PILImage.NEAREST)
+            img = FileManager.open_image(content, thumbnail_size,
+                                         decode_policy)
+            # PILはデコードと縮小を同時に行うため、まとめて計測する
+            with FileManager.decode_slot(decode_policy), metrics.stage(
+                    'generate_thumbnail.decode_resize') as st:
+                # img.thumbnail(size=thumbnail_size,
+                #               resample=PILImage.LANCZOS)
+                img.thumbnail(size=thumbnail_size, resample=PILImage.NEAREST)
+                st.add_bytes(len(content))
             thumbnail = BytesIO()
-            # jpgという拡張子は利用できないので変換する
-            img.save(thumbnail, 'jpeg' if ext == 'jpg' else ext)
+            with metrics.stage('generate_thumbnail.encode') as st:
+                if output_format is None:
+                    # jpgという拡張子は利用できないので変換する
+                    img.save(thumbnail, 'jpeg' if ext == 'jpg' else ext)
+                else:
+                    thumbnail.write(FileManager.encode_thumbnail(
+                        img, output_format,
+                        **FileManager.thumbnail_save_options(output_format,
+                                                             quality)))
+                st.add_bytes(thumbnail.tell())
         except (IOError, KeyError) as e:
             raise EdmanInternalError(f'サムネイルが生成できませんでした {e}')
         try:
-            outputfile = base64.b64encode(thumbnail.getvalue()).decode(
-                file_decode)
+            with metrics.stage('generate_thumbnail.base64') as st:
+                outputfile = base64.b64encode(thumbnail.getvalue()).decode(
+                    file_decode)
+                st.add_bytes(len(outputfile))
         except Exception:
             raise
         return outputfile
@@ -204,7 +808,9 @@ class FileManager(File):
     @staticmethod
     def generate_thumbnail2(content: bytes, ext: str,
                             thumbnail_size: tuple[int, int],
-                            file_decode='utf-8', quality=70) -> str:
+                            file_decode='utf-8', quality=70,
+                            decode_policy: Optional[DecodePolicy] = None
+                            ) -> str:
         """
         サムネイル画像をbase64で作成
         ndとopen cvを利用
@@ -213,24 +819,48 @@ class FileManager(File):
         :param str ext:
         :param tuple thumbnail_size:
         :param str file_decode: default 'utf-8'
-        :param int quality: default 70, jpeg quality
+        :param int quality: default 70, jpeg(webp) quality
+        :param DecodePolicy or None decode_policy: デコードの上限
         :return:
         :rtype: str
         """
+        import cv2
+        import imutils
+        import numpy as np
+
+        flags = cv2.IMREAD_COLOR
         try:
-            arr = np.frombuffer(content, dtype=np.uint8)
-            img = cv2.imdecode(arr, flags=cv2.IMREAD_COLOR)
-            resize_result = imutils.resize(img, thumbnail_size[1])
+            if decode_policy is not None:
+                # ヘッダのみで確認し、必要ならJPEGを縮小デコードする
+                _, _, factor = decode_policy.inspect(content)
+                flags = {2: cv2.IMREAD_REDUCED_COLOR_2,
+                         4: cv2.IMREAD_REDUCED_COLOR_4,
+                         8: cv2.IMREAD_REDUCED_COLOR_8}.get(factor, flags)
+            with FileManager.decode_slot(decode_policy):
+                with metrics.stage('generate_thumbnail2.decode') as st:
+                    arr = np.frombuffer(content, dtype=np.uint8)
+                    img = cv2.imdecode(arr, flags=flags)
+                    st.add_bytes(len(content))
+                if img is None:
+                    raise IOError('画像を読み込めませんでした')
+                with metrics.stage('generate_thumbnail2.resize'):
+                    resize_result = imutils.resize(img, thumbnail_size[1])
             if not ext.startswith('.'):
                 ext = '.' + ext
-            ret, encoded_img = cv2.imencode(
-                ext,
-                resize_result,
-                (cv2.IMWRITE_JPEG_QUALITY, quality))
+            quality_flag = cv2.IMWRITE_WEBP_QUALITY if ext == '.webp' \
+                else cv2.IMWRITE_JPEG_QUALITY
+            with metrics.stage('generate_thumbnail2.encode') as st:
+                ret, encoded_img = cv2.imencode(
+                    ext,
+                    resize_result,
+                    (quality_flag, quality))
+                st.add_bytes(len(encoded_img))
         except (IOError, KeyError) as e:
             raise EdmanInternalError(f'サムネイルが生成できませんでした {e}')
         try:
-            outputfile = base64.b64encode(encoded_img).decode(file_decode)
+            with metrics.stage('generate_thumbnail2.base64') as st:
+                outputfile = base64.b64encode(encoded_img).decode(file_decode)
+                st.add_bytes(len(outputfile))
         except Exception:
             raise
         return outputfile
@@ -238,7 +868,9 @@ class FileManager(File):
     @staticmethod
     def generate_thumbnail3(content: bytes, ext: str,
                             thumbnail_size: tuple[int, int],
-                            file_decode='utf-8', quality=70) -> str:
+                            file_decode='utf-8', quality=70,
+                            decode_policy: Optional[DecodePolicy] = None
+                            ) -> str:
         """
         サムネイル画像をbase64で作成
         ndとopen cvとimutilsを利用
@@ -248,70 +880,938 @@ class FileManager(File):
         :param tuple thumbnail_size:
         :param str file_decode: default 'utf-8'
         :param int quality: default 70, jpeg quality
+        :param DecodePolicy or None decode_policy: デコードの上限
         :return:
         :rtype: str
         """
+        import cv2
+        import imutils
+        import numpy as np
 
         try:
-            c = PILImage.open(BytesIO(content))
-            arr = np.array(c)
-            resize_result = imutils.resize(arr, thumbnail_size[1])
+            with FileManager.decode_slot(decode_policy):
+                with metrics.stage('generate_thumbnail3.decode') as st:
+                    c = FileManager.open_image(content, thumbnail_size,
+                                               decode_policy)
+                    arr = np.array(c)
+                    st.add_bytes(len(content))
+                with metrics.stage('generate_thumbnail3.resize'):
+                    resize_result = imutils.resize(arr, thumbnail_size[1])
             if not ext.startswith('.'):
                 ext = '.' + ext
-            ret, encoded_img = cv2.imencode(
-                ext,
-                resize_result,
-                (cv2.IMWRITE_JPEG_QUALITY, quality))
+            with metrics.stage('generate_thumbnail3.encode') as st:
+                ret, encoded_img = cv2.imencode(
+                    ext,
+                    resize_result,
+                    (cv2.IMWRITE_JPEG_QUALITY, quality))
+                st.add_bytes(len(encoded_img))
         except (IOError, KeyError) as e:
             raise EdmanInternalError(f'サムネイルが生成できませんでした {e}')
         try:
-            outputfile = base64.b64encode(encoded_img).decode(file_decode)
+            with metrics.stage('generate_thumbnail3.base64') as st:
+                outputfile = base64.b64encode(encoded_img).decode(file_decode)
+                st.add_bytes(len(outputfile))
         except Exception:
             raise
         return outputfile
 
+    @staticmethod
+    def open_image(content: bytes, thumbnail_size=None,
+                   decode_policy: Optional[DecodePolicy] = None
+                   ) -> 'PILImage.Image':
+        """
+        PILで画像を開く(デコードはまだ行わない)
+        decode_policy指定時は上限を確認し、必要なら縮小デコードを設定する
+
+        :param bytes content:
+        :param tuple or None thumbnail_size:
+        :param DecodePolicy or None decode_policy:
+        :return:
+        :rtype: PILImage.Image
+        """
+        from PIL import Image as PILImage
+
+        if decode_policy is None:
+            return PILImage.open(BytesIO(content))
+        return decode_policy.open(content, thumbnail_size)
+
+    @staticmethod
+    def decode_slot(decode_policy: Optional[DecodePolicy]
+                    ) -> AbstractContextManager[None]:
+        """
+        デコード処理の同時実行数を制限するコンテキストマネージャを取得する
+
+        :param DecodePolicy or None decode_policy:
+        :return:
+        """
+        return decode_policy.slot() if decode_policy is not None \
+            else nullcontext()
+
+    @staticmethod
+    def encode_thumbnail(img: 'PILImage.Image', output_format: str,
+                         **save_options) -> bytes:
+        """
+        PILの画像を指定フォーマットでエンコードする
+
+        :param PILImage.Image img:
+        :param str output_format:
+        :param save_options: PILImage.saveに渡すオプション
+        :return:
+        :rtype: bytes
+        """
+        # jpgという拡張子は利用できないので変換する
+        output_format = 'jpeg' if output_format == 'jpg' else output_format
+        if output_format == 'jpeg' and img.mode not in ('RGB', 'L', 'CMYK'):
+            img = img.convert('RGB')
+        elif output_format in ('webp', 'avif') and img.mode not in (
+                'RGB', 'RGBA'):
+            has_alpha = 'A' in img.mode or 'transparency' in img.info
+            img = img.convert('RGBA' if has_alpha else 'RGB')
+        thumbnail = BytesIO()
+        img.save(thumbnail, output_format, **save_options)
+        return thumbnail.getvalue()
+
+    @staticmethod
+    def thumbnail_save_options(output_format: str, quality=None) -> dict:
+        """
+        出力フォーマットの保存オプションを取得する
+
+        :param str output_format:
+        :param int or None quality: 指定時は既定のqualityを上書きする
+        :return:
+        :rtype: dict
+        """
+        output_format = 'jpeg' if output_format == 'jpg' else output_format
+        options = dict(THUMBNAIL_SAVE_OPTIONS.get(output_format, {}))
+        if quality is not None:
+            options['quality'] = quality
+        return options
+
+    @staticmethod
+    def supported_thumbnail_formats() -> set[str]:
+        """
+        PILで保存可能な画像フォーマットを取得する
+        AVIFはPillowのバージョン(またはプラグイン)によって利用できない
+
+        :return:
+        :rtype: set
+        """
+        from PIL import Image as PILImage
+
+        PILImage.init()
+        return {f.lower() for f in PILImage.SAVE}
+
+    @staticmethod
+    def negotiate_thumbnail_format(accept: Optional[str],
+                                   fallback='jpeg') -> str:
+        """
+        Acceptヘッダからサムネイルの出力フォーマットを決定する
+        THUMBNAIL_NEGOTIABLE_FORMATSのうち、クライアントが受け付けて
+        PILで保存可能なものを優先度順に選び、無ければfallbackを返す
+
+        :param str or None accept: Acceptヘッダの値
+        :param str fallback: default 'jpeg'
+        :return:
+        :rtype: str
+        """
+        if not accept:
+            return fallback
+        accepted = set()
+        for item in accept.split(','):
+            media_type, *params = [i.strip() for i in item.split(';')]
+            q = 1.0
+            for param in params:
+                key, _, value = param.partition('=')
+                if key.strip() == 'q':
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            if q > 0 and media_type.lower().startswith('image/'):
+                accepted.add(media_type.lower()[len('image/'):])
+
+        supported = FileManager.supported_thumbnail_formats()
+        for output_format in THUMBNAIL_NEGOTIABLE_FORMATS:
+            if output_format in accepted and output_format in supported:
+                return output_format
+        return fallback
+
+    @staticmethod
+    def generate_thumbnails(content: bytes, ext: str,
+                            thumbnail_sizes: List[tuple[int, int]],
+                            output_formats: Optional[list] = None,
+                            file_decode='utf-8',
+                            resample: Optional['PILImage.Resampling'] = None,
+                            decode_policy: Optional[DecodePolicy] = None
+                            ) -> dict:
+        """
+        複数サイズのサムネイル画像をbase64で作成
+        デコードは1回のみで、大きいサイズから順に前の結果を縮小して作成する
+
+        :param bytes content:
+        :param str ext:
+        :param list thumbnail_sizes: [(幅, 高さ), ...]
+        :param list or None output_formats: サイズ毎の出力フォーマット
+            Noneの要素は元の拡張子で出力する
+        :param str file_decode: default 'utf-8'
+        :param PILImage.Resampling or None resample:
+            Noneの時はPILImage.NEAREST
+        :param DecodePolicy or None decode_policy: デコードの上限
+        :return: {(幅, 高さ): {'data': str, 'suffix': str}}
+        :rtype: dict
+        """
+        if output_formats is None:
+            output_formats = [None] * len(thumbnail_sizes)
+        if len(output_formats) != len(thumbnail_sizes):
+            raise EdmanInternalError(
+                'thumbnail_sizesとoutput_formatsの数が一致しません')
+
+        from PIL import Image as PILImage
+
+        if resample is None:
+            resample = PILImage.Resampling.NEAREST
+        # リストで指定された場合もあるので(幅, 高さ)のタプルに揃える
+        sizes = [(int(w), int(h)) for w, h in thumbnail_sizes]
+        result = {}
+        try:
+            if decode_policy is None:
+                img = PILImage.open(BytesIO(content))
+            else:
+                img = decode_policy.open(content, reduce=False)
+            width, height = img.size
+            # 縮小率が大きい順(出力サイズが大きい順)に並べる
+            order = sorted(
+                range(len(sizes)),
+                key=lambda i: min(sizes[i][0] / width, sizes[i][1] / height),
+                reverse=True)
+            # JPEGは最大サイズに合わせて縮小デコードする
+            draft_size = sizes[order[0]]
+            if decode_policy is not None:
+                factor = decode_policy.reduce_factor(width, height,
+                                                     img.format)
+                draft_size = (min(draft_size[0], width // factor),
+                              min(draft_size[1], height // factor))
+            # デコードから最初の縮小までが最もメモリを使う
+            with FileManager.decode_slot(decode_policy):
+                with metrics.stage('generate_thumbnails.decode') as st:
+                    img.draft(img.mode, draft_size)
+                    img.load()
+                    st.add_bytes(len(content))
+                with metrics.stage('generate_thumbnails.resize'):
+                    img.thumbnail(size=sizes[order[0]], resample=resample)
+            for i in order:
+                size = sizes[i]
+                with metrics.stage('generate_thumbnails.resize'):
+                    # 前のサイズの結果をそのまま縮小していく
+                    # (最初のサイズは縮小済みなので何もしない)
+                    img.thumbnail(size=size, resample=resample)
+                suffix = output_formats[i] or ext
+                with metrics.stage('generate_thumbnails.encode') as st:
+                    encoded = FileManager.encode_thumbnail(
+                        img, suffix,
+                        **FileManager.thumbnail_save_options(suffix))
+                    st.add_bytes(len(encoded))
+                with metrics.stage('generate_thumbnails.base64') as st:
+                    data = base64.b64encode(encoded).decode(file_decode)
+                    st.add_bytes(len(data))
+                result[size] = {'data': data, 'suffix': suffix}
+        except (IOError, KeyError) as e:
+            raise EdmanInternalError(f'サムネイルが生成できませんでした {e}')
+        return result
+
+    @staticmethod
+    def load_scientific_array(content: Union[bytes, str, os.PathLike],
+                              ext: str,
+                              decode_policy: Optional[DecodePolicy] = None
+                              ) -> 'np.ndarray':
+        """
+        科学データ(.npy, 16bit/浮動小数点TIFF)を配列として読み込む
+        .npyはコピーせずにデータを参照する(パス指定時はメモリマップ)
+
+        :param bytes or str or os.PathLike content: データまたはファイルパス
+        :param str ext:
+        :param DecodePolicy or None decode_policy: TIFFのデコードの上限
+        :return:
+        :rtype: np.ndarray
+        """
+        import numpy as np
+        from PIL import Image as PILImage
+
+        if ext == 'npy':
+            if not isinstance(content, bytes):
+                return np.load(content, mmap_mode='r')
+            f = BytesIO(content)
+            if np.lib.format.read_magic(f) == (1, 0):
+                header = np.lib.format.read_array_header_1_0(f)
+            else:
+                header = np.lib.format.read_array_header_2_0(f)
+            shape, fortran_order, dtype = header
+            if dtype.hasobject:
+                raise EdmanInternalError('オブジェクト配列は読み込めません')
+            arr = np.frombuffer(content, dtype=dtype,
+                                count=int(np.prod(shape)), offset=f.tell())
+            return arr.reshape(shape, order='F' if fortran_order else 'C')
+
+        if decode_policy is not None:
+            if not isinstance(content, bytes):
+                with open(content, 'rb') as fp:
+                    content = fp.read()
+            decode_policy.inspect(content)
+        img = PILImage.open(BytesIO(content) if isinstance(content, bytes)
+                            else os.fspath(content))
+        if getattr(img, 'n_frames', 1) > 1:
+            # マルチページTIFFは中央のページを代表とする
+            img.seek(img.n_frames // 2)
+        if img.mode in DISPLAYABLE_MODES and img.mode not in (
+                'L', 'RGB', 'RGBA'):
+            has_alpha = 'A' in img.mode or 'transparency' in img.info
+            img = img.convert('RGBA' if has_alpha else 'RGB')
+        return np.asarray(img)
+
+    @staticmethod
+    def is_scientific_image(
+            content: Union[bytes, BinaryIO, gzip.GzipFile], ext: str) -> bool:
+        """
+        科学データとして(コントラストを調整して)サムネイルを作成するか否か
+        .npyと、通常のサムネイル作成で扱えないモード(16bit、浮動小数点等)の
+        TIFFが対象 マルチページTIFFは代表のページを選ぶため対象とする
+        TIFFはヘッダのみを読み込む
+
+        :param bytes or file object content: データまたはファイルオブジェクト
+        :param str ext:
+        :return:
+        :rtype: bool
+        """
+        ext = ext.lower()
+        if ext not in SCIENTIFIC_SUFFIXES:
+            return False
+        if ext == 'npy':
+            return True
+
+        from PIL import Image as PILImage
+
+        try:
+            img = PILImage.open(BytesIO(content)
+                                if isinstance(content, bytes) else content)
+        except (IOError, ValueError):
+            # 判別できない場合は科学データとして読み込みを試みる
+            return True
+        with img:
+            return img.mode not in DIRECT_THUMBNAIL_MODES or \
+                getattr(img, 'is_animated', False)
+
+    def is_scientific_file(self, oid: ObjectId, ext: str,
+                           read_routing: Optional[ReadRouting] = None
+                           ) -> bool:
+        """
+        GridFSのファイルを科学データとしてサムネイルにするか否か
+        TIFFはファイル全体を取得せずにヘッダのみを読み込む
+
+        :param ObjectId oid:
+        :param str ext:
+        :param ReadRouting or None read_routing: 読み込み先
+            Noneの時はself.read_routingを利用する
+        :return:
+        :rtype: bool
+        """
+        if ext.lower() not in SCIENTIFIC_SUFFIXES or ext.lower() == 'npy':
+            return ext.lower() == 'npy'
+        try:
+            grid_out = self.read_fs(read_routing).get(
+                oid, session=current_session())
+        except gridfs.errors.NoFile:
+            raise ValueError('ファイルが存在しません')
+        try:
+            # gzip圧縮されている場合は解凍しながら読む
+            if binascii.hexlify(grid_out.read(2)) == b'1f8b':
+                grid_out.seek(0)
+                with gzip.GzipFile(fileobj=grid_out) as f:
+                    return self.is_scientific_image(f, ext)
+            grid_out.seek(0)
+            return self.is_scientific_image(grid_out, ext)
+        finally:
+            grid_out.close()
+
+    @staticmethod
+    def scale_to_uint8(arr: 'np.ndarray', scaling='percentile',
+                       percentiles=(1.0, 99.0), sample_size=65536
+                       ) -> 'np.ndarray':
+        """
+        配列のコントラストを調整して8bitにする
+        表示範囲は間引いたサンプルから求める
+
+        :param np.ndarray arr:
+        :param str scaling: percentile または log
+        :param tuple percentiles: 表示範囲とする下限、上限のパーセンタイル
+        :param int sample_size: 表示範囲を求めるサンプル数の目安
+        :return:
+        :rtype: np.ndarray
+        """
+        import numpy as np
+
+        if scaling not in ('percentile', 'log'):
+            raise EdmanInternalError(f'scalingが不正です {scaling}')
+
+        step = max(1, int(np.sqrt(arr.shape[0] * arr.shape[1] /
+                                  sample_size)))
+        sample = np.asarray(arr[::step, ::step], dtype=np.float32)
+        sample = sample[np.isfinite(sample)]
+        if sample.size == 0:
+            return np.zeros(arr.shape, dtype=np.uint8)
+        lo, hi = np.percentile(sample, percentiles)
+
+        data = np.asarray(arr, dtype=np.float32)
+        if scaling == 'log':
+            # 下限を0とした対数で表示する
+            data = np.log1p(np.clip(data - lo, 0, None))
+            lo, hi = 0.0, float(np.log1p(max(hi - lo, 0)))
+        if hi <= lo:
+            return np.zeros(arr.shape, dtype=np.uint8)
+        data = (data - lo) * (255.0 / (hi - lo))
+        np.clip(data, 0, 255, out=data)
+        return np.nan_to_num(data, nan=0.0).astype(np.uint8)
+
+    @staticmethod
+    def generate_scientific_thumbnail(
+            content: Union[bytes, str, os.PathLike], ext: str,
+            thumbnail_size: tuple[int, int], file_decode='utf-8',
+            output_format='png', scaling='percentile',
+            percentiles=(1.0, 99.0),
+            decode_policy: Optional[DecodePolicy] = None) -> str:
+        """
+        科学データ(.npy, 16bit/浮動小数点TIFF)のサムネイル画像をbase64で作成
+        間引いた配列でコントラストを調整して8bitの画像にする
+        8bitで表示できるTIFFは通常のサムネイルと同様に作成する
+
+        :param bytes or str or os.PathLike content: データまたはファイルパス
+        :param str ext:
+        :param tuple thumbnail_size:
+        :param str file_decode: default 'utf-8'
+        :param str output_format: default 'png'
+        :param str scaling: default 'percentile', または 'log'
+        :param tuple percentiles: default (1.0, 99.0)
+        :param DecodePolicy or None decode_policy: TIFFのデコードの上限
+        :return:
+        :rtype: str
+        """
+        from PIL import Image as PILImage
+
+        try:
+            with FileManager.decode_slot(decode_policy):
+                with metrics.stage(
+                        'generate_scientific_thumbnail.load') as st:
+                    arr = FileManager.load_scientific_array(content, ext,
+                                                            decode_policy)
+                    st.add_bytes(arr.nbytes)
+                # 画像として表示できる形(2次元、またはRGB(A))まで次元を落とす
+                while arr.ndim > 2 and not (arr.ndim == 3 and
+                                            arr.shape[-1] in (3, 4)):
+                    arr = arr[0]
+                if arr.ndim != 2 and arr.ndim != 3:
+                    raise EdmanInternalError(
+                        f'画像として扱えない配列です {arr.shape}')
+
+                # サムネイルの2倍程度まで間引いてから処理する
+                height, width = arr.shape[:2]
+                step = max(1, min(height // (thumbnail_size[1] * 2),
+                                  width // (thumbnail_size[0] * 2)))
+                arr = arr[::step, ::step]
+
+                with metrics.stage('generate_scientific_thumbnail.scale'):
+                    if arr.dtype.kind == 'u' and arr.itemsize == 1:
+                        scaled = arr
+                    else:
+                        scaled = FileManager.scale_to_uint8(
+                            arr, scaling, percentiles)
+                    img = PILImage.fromarray(scaled)
+                    img.thumbnail(size=thumbnail_size,
+                                  resample=PILImage.Resampling.BILINEAR)
+
+            with metrics.stage('generate_scientific_thumbnail.encode') as st:
+                encoded = FileManager.encode_thumbnail(
+                    img, output_format,
+                    **FileManager.thumbnail_save_options(output_format))
+                st.add_bytes(len(encoded))
+        except (IOError, KeyError, ValueError) as e:
+            raise EdmanInternalError(f'サムネイルが生成できませんでした {e}')
+        with metrics.stage('generate_scientific_thumbnail.base64') as st:
+            outputfile = base64.b64encode(encoded).decode(file_decode)
+            st.add_bytes(len(outputfile))
+        return outputfile
+
+    @property
+    def thumbnail_fs(self) -> gridfs.GridFS:
+        """
+        サムネイルのキャッシュ用のGridFS
+
+        :return:
+        :rtype: gridfs.GridFS
+        """
+        if self._thumbnail_fs is None:
+            self._thumbnail_fs = gridfs.GridFS(self.db, self.thumbnail_bucket)
+            # file_delete時に元ファイルから検索するため
+            self.db[f'{self.thumbnail_bucket}.files'].create_index(
+                'metadata.sources')
+        return self._thumbnail_fs
+
+    @staticmethod
+    def thumbnail_cache_key(oid: ObjectId, thumbnail_size: tuple[int, int],
+                            suffix: str, quality: int = 70,
+                            method: str = 'pillow') -> str:
+        """
+        サムネイルのキャッシュのキー(GridFS上のファイル名)
+        作成条件が異なるサムネイルは別のキーになる
+
+        :param ObjectId oid: 元ファイルのoid
+        :param tuple thumbnail_size:
+        :param str suffix: 出力フォーマット
+        :param int quality: default 70
+        :param str method: default 'pillow'
+        :return:
+        :rtype: str
+        """
+        return (f'{oid}/{thumbnail_size[0]}x{thumbnail_size[1]}'
+                f'_{method}_q{quality}.{suffix}')
+
+    def get_cached_thumbnail(self, key: str, file_decode='utf-8'
+                             ) -> Optional[str]:
+        """
+        キャッシュからサムネイルを取得する
+
+        :param str key:
+        :param str file_decode: default 'utf-8'
+        :return: base64のサムネイル 無い場合はNone
+        :rtype: str or None
+        """
+        try:
+            with metrics.stage('thumbnail_cache.get') as st:
+                data = self.thumbnail_fs.get_last_version(key).read()
+                st.add_bytes(len(data))
+        except gridfs.errors.NoFile:
+            return None
+        return data.decode(file_decode)
+
+    def put_cached_thumbnail(self, key: str, sources: list, data: str,
+                             file_decode='utf-8') -> None:
+        """
+        サムネイルをキャッシュに保存する
+
+        :param str key:
+        :param list sources: 元ファイルのoidのリスト(削除時に利用)
+        :param str data: base64のサムネイル
+        :param str file_decode: default 'utf-8'
+        :return:
+        """
+        self.thumbnail_fs.put(data.encode(file_decode), filename=key,
+                              metadata={'sources': sources})
+
+    def delete_cached_thumbnails(self, oids: list) -> None:
+        """
+        ファイルのサムネイルのキャッシュを削除する
+
+        :param list oids: 元ファイルのoidのリスト
+        :return:
+        """
+        for grid_out in self.thumbnail_fs.find(
+                {'metadata.sources': {'$in': oids}}):
+            self.thumbnail_fs.delete(grid_out._id)
+
+    @staticmethod
+    def read_representative_frame(path: str, max_frames=30,
+                                  min_brightness=16.0):
+        """
+        動画の先頭から代表フレームを取得する
+        真っ黒なフレームを避けるため、先頭max_framesのうち
+        平均輝度がmin_brightness以上の最初のフレームを選ぶ
+
+        :param str path:
+        :param int max_frames: default 30
+        :param float min_brightness: default 16.0
+        :return: BGRのフレーム 読み込めない場合はNone
+        :rtype: np.ndarray or None
+        """
+        import cv2
+
+        capture = cv2.VideoCapture(path)
+        frame = None
+        try:
+            if not capture.isOpened():
+                return None
+            for _ in range(max_frames):
+                ok, current = capture.read()
+                if not ok:
+                    break
+                frame = current
+                if frame[::8, ::8].mean() >= min_brightness:
+                    break
+        finally:
+            capture.release()
+        return frame
+
+    def generate_video_thumbnail(self, oid: Union[ObjectId, str], ext: str,
+                                 thumbnail_size: tuple[int, int],
+                                 file_decode='utf-8', output_format='jpeg',
+                                 read_routing: Optional[ReadRouting] = None
+                                 ) -> str:
+        """
+        動画の代表フレームからサムネイル画像をbase64で作成
+        先頭video_head_bytesのみを一時ファイルに書き出して読み込み、
+        読み込めない形式(moovが末尾にあるmp4等)の場合のみ全体を書き出す
+
+        :param str or ObjectId oid:
+        :param str ext:
+        :param tuple thumbnail_size:
+        :param str file_decode: default 'utf-8'
+        :param str output_format: default 'jpeg'
+        :param ReadRouting or None read_routing: 読み込み先
+        :return:
+        :rtype: str
+        """
+        import cv2
+        from PIL import Image as PILImage
+
+        chunks = self.iter_file_chunks(oid, read_routing)
+        with tempfile.NamedTemporaryFile(suffix='.' + ext) as tmp:
+            with metrics.stage('generate_video_thumbnail.fetch') as st:
+                for chunk in chunks:
+                    tmp.write(chunk)
+                    if tmp.tell() >= self.video_head_bytes:
+                        break
+                tmp.flush()
+                st.add_bytes(tmp.tell())
+            with metrics.stage('generate_video_thumbnail.decode'):
+                frame = self.read_representative_frame(tmp.name)
+            if frame is None:
+                # 先頭だけでは読み込めない場合は残りも書き出す
+                with metrics.stage('generate_video_thumbnail.fetch') as st:
+                    start = tmp.tell()
+                    for chunk in chunks:
+                        tmp.write(chunk)
+                    tmp.flush()
+                    st.add_bytes(tmp.tell() - start)
+                with metrics.stage('generate_video_thumbnail.decode'):
+                    frame = self.read_representative_frame(tmp.name)
+        if frame is None:
+            raise EdmanInternalError('動画のフレームを読み込めませんでした')
+
+        with metrics.stage('generate_video_thumbnail.resize'):
+            height, width = frame.shape[:2]
+            scale = min(thumbnail_size[0] / width,
+                        thumbnail_size[1] / height, 1.0)
+            frame = cv2.resize(frame, (max(1, round(width * scale)),
+                                       max(1, round(height * scale))),
+                               interpolation=cv2.INTER_AREA)
+            img = PILImage.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        with metrics.stage('generate_video_thumbnail.encode') as st:
+            encoded = self.encode_thumbnail(
+                img, output_format,
+                **self.thumbnail_save_options(output_format))
+            st.add_bytes(len(encoded))
+        return base64.b64encode(encoded).decode(file_decode)
+
     def get_thumbnails_procedure(self, files: list, thumbnail_suffix: list,
                                  thumbnail_size=(100, 100),
-                                 method="pillow", quality=70) -> dict:
+                                 method="pillow", quality=70,
+                                 output_format=None, accept=None,
+                                 decode_policy=None, use_cache=False,
+                                 read_routing=None) -> dict:
         """
         データをDBから出してサムネイルを取得するラッパー
         画像を文字列データとして取得
+        動画は代表フレームから作成し、常にキャッシュする
 
         :param list files:
         :param list thumbnail_suffix:
         :param tuple[int, int] thumbnail_size: default (100, 100)
         :param str method: default pillow, opencv(jpeg only)
         :param int quality: default 70, jpeg quality
+        :param str or None output_format: 出力フォーマット
+            Noneの時は元の拡張子で出力
+        :param str or None accept: Acceptヘッダの値
+            output_formatがNoneの時、これを元に出力フォーマットを決定する
+        :param DecodePolicy or None decode_policy: デコードの上限
+            Noneの時はself.decode_policyを利用する
+        :param bool use_cache: default False
+            Trueの時は作成したサムネイルをキャッシュし、次回から再利用する
+        :param ReadRouting or None read_routing: 読み込み先
+            Noneの時はself.read_routingを利用する
         :return:
         :rtype: dict
         """
+        if output_format is None and accept is not None:
+            output_format = self.negotiate_thumbnail_format(accept)
+        if decode_policy is None:
+            decode_policy = self.decode_policy
+
         thumbnails = {}
-        for oid, ext in self.extract_thumb_list(files, thumbnail_suffix):
-            # contentを取得
-            try:
-                content, _, _ = self.file_download(oid)
-            except ValueError:
-                raise
-            try:
-                if method == 'opencv':
-                    # サムネイルを作成(jpgのみ)
-                    image_data = self.generate_thumbnail2(content, ext,
-                                                          thumbnail_size,
-                                                          quality=quality)
+        with metrics.stage('get_thumbnails_procedure'):
+            for oid, ext in self.extract_thumb_list(files, thumbnail_suffix):
+                is_video = ext.lower() in VIDEO_SUFFIXES
+                is_scientific = not is_video and self.is_scientific_file(
+                    oid, ext, read_routing)
+                if is_video:
+                    suffix = output_format or 'jpeg'
+                elif is_scientific:
+                    suffix = output_format or 'png'
+                else:
+                    suffix = output_format or ext
+
+                key = self.thumbnail_cache_key(oid, thumbnail_size, suffix,
+                                               quality, method)
+                if use_cache or is_video:
+                    if (image_data := self.get_cached_thumbnail(key)) \
+                            is not None:
+                        thumbnails.update(
+                            {oid: {'data': image_data, 'suffix': suffix}})
+                        continue
+
+                if is_video:
+                    # 動画は全体を取得せずに先頭から代表フレームを読む
+                    image_data = self.generate_video_thumbnail(
+                        oid, ext.lower(), thumbnail_size,
+                        output_format=suffix, read_routing=read_routing)
+                    self.put_cached_thumbnail(key, [oid], image_data)
+                    thumbnails.update(
+                        {oid: {'data': image_data, 'suffix': suffix}})
+                    continue
+
+                # contentを取得
+                try:
+                    content, _, _ = self.file_download(oid, read_routing)
+                except ValueError:
+                    raise
+                try:
+                    if is_scientific:
+                        # 科学データはコントラストを調整して作成
+                        image_data = self.generate_scientific_thumbnail(
+                            content, ext.lower(), thumbnail_size,
+                            output_format=suffix,
+                            decode_policy=decode_policy)
 
+                    elif method == 'opencv' and output_format in (
+                            None, 'jpg', 'jpeg', 'webp'):
+                        # サムネイルを作成(jpg, webpのみ)
+                        image_data = self.generate_thumbnail2(
+                            content, suffix, thumbnail_size, quality=quality,
+                            decode_policy=decode_policy)
+
+                    else:
+                        # サムネイルを作成
+                        image_data = self.generate_thumbnail(
+                            content, ext, thumbnail_size,
+                            output_format=output_format,
+                            decode_policy=decode_policy)
+                except Exception:
+                    raise
                 else:
-                    # サムネイルを作成
-                    image_data = self.generate_thumbnail(content, ext,
-                                                         thumbnail_size)
-            except Exception:
-                raise
-            else:
-                thumbnails.update({oid: {'data': image_data, 'suffix': ext}})
+                    if use_cache:
+                        self.put_cached_thumbnail(key, [oid], image_data)
+                    thumbnails.update(
+                        {oid: {'data': image_data, 'suffix': suffix}})
+
+        return thumbnails
+
+    def get_multi_thumbnails_procedure(self, files: list,
+                                       thumbnail_suffix: list,
+                                       thumbnail_sizes: list,
+                                       output_formats=None,
+                                       decode_policy=None,
+                                       read_routing=None) -> dict:
+        """
+        データをDBから出して複数サイズのサムネイルを取得するラッパー
+        ファイルの取得とデコードは1ファイルにつき1回のみ
+
+        :param list files:
+        :param list thumbnail_suffix:
+        :param list thumbnail_sizes: [(幅, 高さ), ...]
+        :param list or None output_formats: サイズ毎の出力フォーマット
+        :param DecodePolicy or None decode_policy: デコードの上限
+            Noneの時はself.decode_policyを利用する
+        :param ReadRouting or None read_routing: 読み込み先
+            Noneの時はself.read_routingを利用する
+        :return: {oid: {(幅, 高さ): {'data': str, 'suffix': str}}}
+        :rtype: dict
+        """
+        if decode_policy is None:
+            decode_policy = self.decode_policy
+
+        thumbnails = {}
+        with metrics.stage('get_multi_thumbnails_procedure'):
+            for oid, ext in self.extract_thumb_list(files, thumbnail_suffix):
+                # contentを取得
+                try:
+                    content, _, _ = self.file_download(oid, read_routing)
+                except ValueError:
+                    raise
+                thumbnails[oid] = self.generate_thumbnails(
+                    content, ext, thumbnail_sizes, output_formats,
+                    decode_policy=decode_policy)
 
         return thumbnails
 
+    @staticmethod
+    def sprite_cache_key(oids: list, thumbnail_size: tuple[int, int],
+                         output_format: str, columns: int, rows: int) -> str:
+        """
+        スプライトシートのキャッシュのキー
+        oidの並び順に依らないよう、ソートしたoidのリストとパラメータから作成する
+
+        :param list oids:
+        :param tuple thumbnail_size:
+        :param str output_format:
+        :param int columns:
+        :param int rows:
+        :return:
+        :rtype: str
+        """
+        source = json.dumps([sorted(str(oid) for oid in oids),
+                             list(thumbnail_size), output_format, columns,
+                             rows])
+        return 'sprite/' + hashlib.sha1(source.encode()).hexdigest()
+
+    @staticmethod
+    def build_sprite_sheet(images: list, cell_size: tuple[int, int],
+                           columns: int, channels=3
+                           ) -> tuple['np.ndarray', 'np.ndarray']:
+        """
+        サムネイルの配列を1枚のスプライトシートに配置する
+        キャンバスは(行, セル高さ, 列, セル幅, チャンネル)で確保し、
+        各サムネイルは1回のスライス代入で配置する(最後の変形はコピーなし)
+
+        :param list images: (高さ, 幅, channels)のuint8配列のリスト
+        :param tuple cell_size: (幅, 高さ) 各サムネイルはこれ以下のサイズ
+        :param int columns: 1行に並べる数
+        :param int channels: default 3
+        :return: (シート, 各サムネイルの(x, y)の配列)
+        :rtype: tuple
+        """
+        import numpy as np
+
+        cell_w, cell_h = cell_size
+        columns = max(1, min(columns, len(images)))
+        rows = -(-len(images) // columns)
+        # jpegは白背景、透過可能なフォーマットは透明
+        canvas = np.zeros((rows, cell_h, columns, cell_w, channels),
+                          dtype=np.uint8)
+        if channels == 3:
+            canvas.fill(255)
+        index = np.arange(len(images))
+        row, column = np.divmod(index, columns)
+        for i, arr in enumerate(images):
+            h, w = arr.shape[:2]
+            canvas[row[i], :h, column[i], :w] = arr
+        positions = np.stack([column * cell_w, row * cell_h], axis=1)
+        return canvas.reshape(rows * cell_h, columns * cell_w,
+                              channels), positions
+
+    def get_sprite_sheets_procedure(self, files: list, thumbnail_suffix: list,
+                                    thumbnail_size=(100, 100),
+                                    output_format='jpeg', columns=10,
+                                    rows=10, decode_policy=None,
+                                    use_cache=True, read_routing=None
+                                    ) -> dict:
+        """
+        サムネイルをスプライトシートにまとめて取得するラッパー
+        columns * rows 個毎に1枚のシートを作成する
+
+        :param list files:
+        :param list thumbnail_suffix:
+        :param tuple[int, int] thumbnail_size: default (100, 100) 1セルのサイズ
+        :param str output_format: default 'jpeg'
+        :param int columns: default 10
+        :param int rows: default 10
+        :param DecodePolicy or None decode_policy: デコードの上限
+            Noneの時はself.decode_policyを利用する
+        :param bool use_cache: default True
+        :param ReadRouting or None read_routing: 読み込み先
+            Noneの時はself.read_routingを利用する
+        :return: {'sheets': [{'data', 'suffix', 'width', 'height'}, ...],
+            'offsets': {oid: {'sheet', 'x', 'y', 'width', 'height'}}}
+        :rtype: dict
+        """
+        from PIL import Image as PILImage
+
+        if decode_policy is None:
+            decode_policy = self.decode_policy
+        targets = self.extract_thumb_list(files, thumbnail_suffix)
+        if not targets:
+            return {'sheets': [], 'offsets': {}}
+        thumbnail_size = tuple(thumbnail_size)
+        mode = 'RGB' if output_format in ('jpg', 'jpeg') else 'RGBA'
+
+        key = self.sprite_cache_key([oid for oid, _ in targets],
+                                    thumbnail_size, output_format, columns,
+                                    rows)
+        if use_cache and (cached := self.get_cached_thumbnail(key)):
+            result = json.loads(cached)
+            # キーを呼び出し側のoidに戻す
+            oids = {str(oid): oid for oid, _ in targets}
+            result['offsets'] = {oids[k]: v
+                                 for k, v in result['offsets'].items()}
+            return result
+
+        import numpy as np
+
+        images = []
+        with metrics.stage('get_sprite_sheets_procedure.thumbnails'):
+            for oid, ext in targets:
+                if ext.lower() in VIDEO_SUFFIXES + SCIENTIFIC_SUFFIXES:
+                    # 通常の画像以外は個別のサムネイルを作成して読み込む
+                    data = self.get_thumbnails_procedure(
+                        [(oid, f'{oid}.{ext}')], [ext], thumbnail_size,
+                        output_format='png', decode_policy=decode_policy,
+                        read_routing=read_routing)[oid]['data']
+                    img = PILImage.open(BytesIO(base64.b64decode(data)))
+                else:
+                    content, _, _ = self.file_download(oid, read_routing)
+                    try:
+                        img = self.open_image(content, thumbnail_size,
+                                              decode_policy)
+                        # JPEGはセルのサイズに合わせて縮小デコードする
+                        img.draft(img.mode, thumbnail_size)
+                        with self.decode_slot(decode_policy):
+                            img.thumbnail(size=thumbnail_size,
+                                          resample=PILImage.NEAREST)
+                    except (IOError, KeyError) as e:
+                        raise EdmanInternalError(
+                            f'サムネイルが生成できませんでした {e}')
+                images.append(np.asarray(img.convert(mode)))
+
+        sheets: list[dict] = []
+        offsets: dict[ObjectId, dict] = {}
+        capacity = columns * rows
+        for start in range(0, len(images), capacity):
+            with metrics.stage('get_sprite_sheets_procedure.place'):
+                sheet, positions = self.build_sprite_sheet(
+                    images[start:start + capacity], thumbnail_size, columns,
+                    channels=len(mode))
+            with metrics.stage('get_sprite_sheets_procedure.encode') as st:
+                encoded = self.encode_thumbnail(
+                    PILImage.fromarray(sheet), output_format,
+                    **self.thumbnail_save_options(output_format))
+                st.add_bytes(len(encoded))
+            for i, position in enumerate(positions):
+                x, y = int(position[0]), int(position[1])
+                h, w = images[start + i].shape[:2]
+                offsets[targets[start + i][0]] = {
+                    'sheet': len(sheets), 'x': x, 'y': y, 'width': w,
+                    'height': h}
+            sheets.append({'data': base64.b64encode(encoded).decode(),
+                           'suffix': output_format,
+                           'width': sheet.shape[1],
+                           'height': sheet.shape[0]})
+
+        result = {'sheets': sheets, 'offsets': offsets}
+        if use_cache:
+            self.put_cached_thumbnail(
+                key, [Utils.conv_objectid(oid) for oid, _ in targets],
+                json.dumps({'sheets': sheets,
+                            'offsets': {str(k): v
+                                        for k, v in offsets.items()}}))
+        return result
+
     def get_images_procedure(self, files: list, suffix: list,
-                             file_decode='utf-8') -> dict:
+                             file_decode='utf-8', read_routing=None) -> dict:
         """
         データをDBから取り出す取得するラッパー
         文字列データとして取得
@@ -319,21 +1819,27 @@ class FileManager(File):
         :param list files:
         :param list suffix:
         :param str file_decode: default 'utf-8'
+        :param ReadRouting or None read_routing: 読み込み先
+            Noneの時はself.read_routingを利用する
         :return:
         :rtype: dict
         """
         result = {}
-        for oid, ext in self.extract_thumb_list(files, suffix):
-            # contentを取得
-            try:
-                content, _, _ = self.file_download(oid)
-            except ValueError:
-                raise
-            try:
-                image_data = base64.b64encode(content).decode(file_decode)
-            except Exception:
-                raise
-            else:
-                result.update({oid: {'data': image_data, 'suffix': ext}})
+        with metrics.stage('get_images_procedure'):
+            for oid, ext in self.extract_thumb_list(files, suffix):
+                # contentを取得
+                try:
+                    content, _, _ = self.file_download(oid, read_routing)
+                except ValueError:
+                    raise
+                try:
+                    with metrics.stage('get_images_procedure.base64') as st:
+                        image_data = base64.b64encode(content).decode(
+                            file_decode)
+                        st.add_bytes(len(image_data))
+                except Exception:
+                    raise
+                else:
+                    result.update({oid: {'data': image_data, 'suffix': ext}})
 
         return result
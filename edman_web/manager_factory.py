@@ -0,0 +1,195 @@
+import os
+import threading
+import weakref
+from typing import Optional
+
+from edman import DB
+from edman.exceptions import EdmanInternalError
+
+from .file_manager import FileManager
+from .read_routing import ReadRouting
+from .search_manager import SearchManager
+
+# fork後に接続を作り直すファクトリ
+# 利用されなくなったファクトリを解放できるように弱参照で保持する
+_live_factories: 'weakref.WeakSet[ManagerFactory]' = weakref.WeakSet()
+
+
+def _reset_factories_after_fork() -> None:
+    """
+    fork後の子プロセスで全てのファクトリのロックと接続を作り直す
+    """
+    for factory in list(_live_factories):
+        factory._reset_after_fork()
+
+
+os.register_at_fork(after_in_child=_reset_factories_after_fork)
+
+
+class ManagerFactory:
+    """
+    FileManager, SearchManagerをプロセス内で共有するためのファクトリ
+    データベース毎に接続(コネクションプール)とマネージャを1つだけ作成し、
+    リクエスト毎の生成を不要にする
+    fork後の子プロセスでは接続を作り直す
+    """
+
+    def __init__(self, con: dict, max_pool_size=100, min_pool_size=0,
+                 wait_queue_timeout_ms: Optional[int] = None,
+                 connect_timeout_ms: Optional[int] = None,
+                 server_selection_timeout_ms: Optional[int] = None,
+                 read_routing: Optional[ReadRouting] = None):
+        """
+        :param dict con: edman.DBの接続情報
+        :param int max_pool_size: default 100
+        :param int min_pool_size: default 0
+        :param int or None wait_queue_timeout_ms: プールが空いていない時の待ち時間
+        :param int or None connect_timeout_ms:
+        :param int or None server_selection_timeout_ms:
+        :param ReadRouting or None read_routing: マネージャの読み込み先の既定値
+        """
+        self.con = con
+        self.pool_options = {
+            'maxPoolSize': max_pool_size,
+            'minPoolSize': min_pool_size,
+            'waitQueueTimeoutMS': wait_queue_timeout_ms,
+            'connectTimeoutMS': connect_timeout_ms,
+            'serverSelectionTimeoutMS': server_selection_timeout_ms,
+        }
+        self.read_routing = read_routing
+        self._lock = threading.Lock()
+        self._registry: dict[str, dict] = {}
+        self._pid = os.getpid()
+        # fork後の子プロセスではロックと接続を作り直す
+        _live_factories.add(self)
+
+    def _reset_after_fork(self) -> None:
+        """
+        fork後の子プロセスで呼ばれる
+        親プロセスの接続は子プロセスで利用できないので破棄する
+        """
+        self._lock = threading.Lock()
+        self._registry = {}
+        self._pid = os.getpid()
+
+    def _connection_info(self, database: str) -> dict:
+        """
+        プール設定を追加したedman.DBの接続情報を作成する
+
+        :param str database:
+        :return:
+        :rtype: dict
+        """
+        con = dict(self.con)
+        con['database'] = database
+        options = list(con.get('options') or [])
+        options.extend(f'{key}={value}' for key, value
+                       in self.pool_options.items() if value is not None)
+        con['options'] = options
+        return con
+
+    def _entry(self, database: Optional[str]) -> dict:
+        """
+        データベースの接続とマネージャを取得する
+        未作成の場合は作成する
+
+        :param str or None database: Noneの時は接続情報のデータベース
+        :return:
+        :rtype: dict
+        """
+        if self._pid != os.getpid():
+            self._reset_after_fork()
+        if database is None:
+            database = self.con.get('database')
+        if not database:
+            raise EdmanInternalError('データベースが指定されていません')
+
+        if (entry := self._registry.get(database)) is not None:
+            return entry
+        with self._lock:
+            if (entry := self._registry.get(database)) is None:
+                db = DB(self._connection_info(database))
+                entry = {
+                    'db': db,
+                    'file_manager': FileManager(db.get_db),
+                    'search_manager': SearchManager(db),
+                }
+                if self.read_routing is not None:
+                    entry['file_manager'].read_routing = self.read_routing
+                    entry['search_manager'].read_routing = self.read_routing
+                self._registry[database] = entry
+        return entry
+
+    def get_db(self, database: Optional[str] = None) -> DB:
+        """
+        共有しているedman.DBを取得する
+
+        :param str or None database:
+        :return:
+        :rtype: DB
+        """
+        return self._entry(database)['db']
+
+    def get_file_manager(self, database: Optional[str] = None
+                         ) -> FileManager:
+        """
+        共有しているFileManagerを取得する
+
+        :param str or None database:
+        :return:
+        :rtype: FileManager
+        """
+        return self._entry(database)['file_manager']
+
+    def get_search_manager(self, database: Optional[str] = None
+                           ) -> SearchManager:
+        """
+        共有しているSearchManagerを取得する
+
+        :param str or None database:
+        :return:
+        :rtype: SearchManager
+        """
+        return self._entry(database)['search_manager']
+
+    def close(self) -> None:
+        """
+        全ての接続を閉じる
+        """
+        with self._lock:
+            registry, self._registry = self._registry, {}
+        for entry in registry.values():
+            entry['db'].get_db.client.close()
+
+
+_factory: Optional[ManagerFactory] = None
+_factory_lock = threading.Lock()
+
+
+def configure(con: dict, **pool_options) -> ManagerFactory:
+    """
+    プロセス全体で共有するファクトリを設定する
+
+    :param dict con: edman.DBの接続情報
+    :param pool_options: ManagerFactoryのプール設定
+    :return:
+    :rtype: ManagerFactory
+    """
+    global _factory
+    with _factory_lock:
+        if _factory is not None:
+            _factory.close()
+        _factory = ManagerFactory(con, **pool_options)
+    return _factory
+
+
+def get_factory() -> ManagerFactory:
+    """
+    プロセス全体で共有するファクトリを取得する
+
+    :return:
+    :rtype: ManagerFactory
+    """
+    if _factory is None:
+        raise EdmanInternalError('ファクトリが設定されていません')
+    return _factory
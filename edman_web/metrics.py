@@ -0,0 +1,243 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+# InMemoryMetricsのヒストグラムの既定のバケット(秒)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class MetricsSink:
+    """
+    計測結果の出力先
+    既定では何もしない
+    """
+    enabled = False
+
+    def observe(self, stage: str, seconds: float, nbytes: int) -> None:
+        """
+        処理段階の計測結果を記録する
+
+        :param str stage: 処理段階の名前
+        :param float seconds: 処理時間
+        :param int nbytes: 処理したバイト数
+        """
+        pass
+
+
+class InMemoryMetrics(MetricsSink):
+    """
+    計測結果をメモリ上のヒストグラムに集計する
+    """
+    enabled = True
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._stages: dict[str, dict] = {}
+
+    def observe(self, stage: str, seconds: float, nbytes: int) -> None:
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            if (data := self._stages.get(stage)) is None:
+                data = {'count': 0, 'sum': 0.0, 'bytes': 0,
+                        'buckets': [0] * (len(self.buckets) + 1)}
+                self._stages[stage] = data
+            data['count'] += 1
+            data['sum'] += seconds
+            data['bytes'] += nbytes
+            data['buckets'][index] += 1
+
+    def snapshot(self) -> dict:
+        """
+        集計結果を取得する
+
+        :return: {処理段階: {'count', 'sum', 'bytes', 'buckets'}}
+            bucketsは各バケット以下の件数(累積ではない)で、最後は上限超え
+        :rtype: dict
+        """
+        with self._lock:
+            return {stage: {**data, 'buckets': list(data['buckets'])}
+                    for stage, data in self._stages.items()}
+
+    def reset(self) -> None:
+        """
+        集計結果を破棄する
+        """
+        with self._lock:
+            self._stages.clear()
+
+    def prometheus_text(self, prefix='edman_web') -> str:
+        """
+        集計結果をPrometheusのテキスト形式で出力する
+
+        :param str prefix: メトリクス名の接頭辞
+        :return:
+        :rtype: str
+        """
+        seconds = f'{prefix}_stage_seconds'
+        nbytes = f'{prefix}_stage_bytes_total'
+        lines = [f'# HELP {seconds} Time spent in each processing stage.',
+                 f'# TYPE {seconds} histogram']
+        snapshot = self.snapshot()
+        for stage, data in sorted(snapshot.items()):
+            cumulative = 0
+            for le, count in zip(self.buckets, data['buckets']):
+                cumulative += count
+                lines.append(
+                    f'{seconds}_bucket{{stage="{stage}",le="{le}"}} '
+                    f'{cumulative}')
+            lines.append(f'{seconds}_bucket{{stage="{stage}",le="+Inf"}} '
+                         f'{data["count"]}')
+            lines.append(f'{seconds}_sum{{stage="{stage}"}} {data["sum"]}')
+            lines.append(f'{seconds}_count{{stage="{stage}"}} '
+                         f'{data["count"]}')
+        lines.extend([f'# HELP {nbytes} Bytes processed in each stage.',
+                      f'# TYPE {nbytes} counter'])
+        for stage, data in sorted(snapshot.items()):
+            lines.append(f'{nbytes}{{stage="{stage}"}} {data["bytes"]}')
+        return '\n'.join(lines) + '\n'
+
+
+class Trace:
+    """
+    1リクエスト分の計測結果
+    """
+
+    def __init__(self):
+        self.records: list[tuple[str, float, int]] = []
+
+    def add(self, stage: str, seconds: float, nbytes: int) -> None:
+        self.records.append((stage, seconds, nbytes))
+
+    def summary(self) -> dict:
+        """
+        処理段階毎に集計する
+
+        :return: {処理段階: {'count', 'seconds', 'bytes'}}
+        :rtype: dict
+        """
+        result: dict[str, dict] = {}
+        for stage, seconds, nbytes in self.records:
+            data = result.setdefault(stage,
+                                     {'count': 0, 'seconds': 0.0, 'bytes': 0})
+            data['count'] += 1
+            data['seconds'] += seconds
+            data['bytes'] += nbytes
+        return result
+
+    def format(self) -> str:
+        """
+        ログ出力用の文字列にする
+
+        :return:
+        :rtype: str
+        """
+        return ' '.join(
+            f"{stage}={data['seconds'] * 1000:.1f}ms/{data['count']}"
+            f"/{data['bytes']}B"
+            for stage, data in self.summary().items())
+
+
+class _Stage:
+    """
+    処理段階の計測を行うコンテキストマネージャ
+    """
+    __slots__ = ('name', 'nbytes', 'trace', '_start')
+
+    def __init__(self, name: str, current_trace: Optional[Trace]):
+        self.name = name
+        self.nbytes = 0
+        self.trace = current_trace
+        self._start = 0.0
+
+    def add_bytes(self, nbytes: int) -> None:
+        self.nbytes += nbytes
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self._start
+        if _sink.enabled:
+            _sink.observe(self.name, seconds, self.nbytes)
+        if self.trace is not None:
+            self.trace.add(self.name, seconds, self.nbytes)
+        return False
+
+
+class _NullStage:
+    """
+    計測が無効な時に使う何もしないコンテキストマネージャ
+    """
+    __slots__ = ()
+
+    def add_bytes(self, nbytes: int) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+_sink: MetricsSink = MetricsSink()
+_trace: ContextVar[Optional[Trace]] = ContextVar('edman_web_trace',
+                                                 default=None)
+
+
+def set_sink(sink: Optional[MetricsSink]) -> None:
+    """
+    計測結果の出力先を設定する
+
+    :param MetricsSink or None sink: Noneの時は計測を無効にする
+    """
+    global _sink
+    _sink = sink if sink is not None else MetricsSink()
+
+
+def get_sink() -> MetricsSink:
+    """
+    計測結果の出力先を取得する
+
+    :return:
+    :rtype: MetricsSink
+    """
+    return _sink
+
+
+@contextmanager
+def trace() -> Iterator[Trace]:
+    """
+    ブロック内(1リクエスト分)の計測結果をTraceに記録する
+
+    :return:
+    :rtype: Iterator
+    """
+    current = Trace()
+    token = _trace.set(current)
+    try:
+        yield current
+    finally:
+        _trace.reset(token)
+
+
+def stage(name: str):
+    """
+    処理段階を計測するコンテキストマネージャを取得する
+    出力先もTraceも無い場合は何もしない
+
+    :param str name: 処理段階の名前
+    :return:
+    :rtype: _Stage or _NullStage
+    """
+    current_trace = _trace.get()
+    if not _sink.enabled and current_trace is None:
+        return _NULL_STAGE
+    return _Stage(name, current_trace)
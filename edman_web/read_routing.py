@@ -0,0 +1,143 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, Iterator, Optional
+
+from pymongo import read_preferences
+
+if TYPE_CHECKING:
+    from pymongo.client_session import ClientSession
+    from pymongo.database import Database
+
+# MongoDBが受け付けるmaxStalenessSecondsの最小値
+MIN_MAX_STALENESS_SECONDS = 90
+
+_MODES = {
+    'primary': read_preferences.Primary,
+    'primaryPreferred': read_preferences.PrimaryPreferred,
+    'secondary': read_preferences.Secondary,
+    'secondaryPreferred': read_preferences.SecondaryPreferred,
+    'nearest': read_preferences.Nearest,
+}
+
+
+class ReadRouting:
+    """
+    読み込み専用の処理を送るレプリカセットのメンバーの指定
+    """
+
+    def __init__(self, mode='secondaryPreferred',
+                 max_staleness_seconds: Optional[int] = None,
+                 tag_sets: Optional[list] = None):
+        """
+        :param str mode: default 'secondaryPreferred'
+            'primary', 'primaryPreferred', 'secondary',
+            'secondaryPreferred', 'nearest'
+        :param int or None max_staleness_seconds: プライマリからの遅れの上限
+            Noneの時は制限しない 90以上を指定する
+        :param list or None tag_sets: メンバーのタグ
+        """
+        if mode not in _MODES:
+            raise ValueError(f'不明なmodeです {mode}')
+        if max_staleness_seconds is not None:
+            if mode == 'primary':
+                raise ValueError(
+                    'primaryではmax_staleness_secondsを指定できません')
+            if max_staleness_seconds < MIN_MAX_STALENESS_SECONDS:
+                raise ValueError(
+                    'max_staleness_secondsは'
+                    f'{MIN_MAX_STALENESS_SECONDS}以上を指定してください')
+        self.mode = mode
+        self.max_staleness_seconds = max_staleness_seconds
+        self.tag_sets = tag_sets
+
+    @property
+    def key(self) -> tuple:
+        """
+        ルーティング先の設定を表すキー(接続のキャッシュに利用)
+
+        :return:
+        :rtype: tuple
+        """
+        return (self.mode, self.max_staleness_seconds,
+                repr(self.tag_sets) if self.tag_sets else None)
+
+    @property
+    def is_primary(self) -> bool:
+        return self.mode == 'primary'
+
+    def read_preference(self) -> read_preferences._ServerMode:
+        """
+        pymongoのread preferenceを作成する
+
+        :return:
+        :rtype: read_preferences._ServerMode
+        """
+        cls = _MODES[self.mode]
+        if self.mode == 'primary':
+            return cls()
+        return cls(tag_sets=self.tag_sets,
+                   max_staleness=self.max_staleness_seconds
+                   if self.max_staleness_seconds is not None else -1)
+
+    def apply(self, db: 'Database') -> 'Database':
+        """
+        read preferenceを設定したDatabaseを取得する
+
+        :param Database db:
+        :return:
+        :rtype: Database
+        """
+        return db.with_options(read_preference=self.read_preference())
+
+
+_session: ContextVar[Optional['ClientSession']] = ContextVar(
+    'edman_web_causal_session', default=None)
+
+
+def current_session() -> Optional['ClientSession']:
+    """
+    実行中のcausal_sessionを取得する
+
+    :return: causal_sessionの外ではNone
+    :rtype: ClientSession or None
+    """
+    return _session.get()
+
+
+@contextmanager
+def causal_session(db: 'Database', after: Optional[dict] = None
+                   ) -> Iterator['ClientSession']:
+    """
+    因果一貫性のあるセッションを開始する
+    ブロック内のFileManagerの書き込みと読み込みはこのセッションで行うので、
+    セカンダリからの読み込みでも書き込んだ内容が読める(read-your-writes)
+
+    :param Database db:
+    :param dict or None after: 前のセッションのsession_token()の結果
+        リクエストを跨いでread-your-writesを保つ時に指定する
+    :return:
+    :rtype: Iterator
+    """
+    with db.client.start_session(causal_consistency=True) as session:
+        if after:
+            session.advance_cluster_time(after['cluster_time'])
+            session.advance_operation_time(after['operation_time'])
+        token = _session.set(session)
+        try:
+            yield session
+        finally:
+            _session.reset(token)
+
+
+def session_token(session: 'ClientSession') -> Optional[dict]:
+    """
+    次のcausal_sessionに引き継ぐためのセッションの時刻を取得する
+
+    :param ClientSession session:
+    :return: 書き込みが無い場合やスタンドアロン構成ではNone
+    :rtype: dict or None
+    """
+    if session.operation_time is None or session.cluster_time is None:
+        return None
+    return {'cluster_time': session.cluster_time,
+            'operation_time': session.operation_time}
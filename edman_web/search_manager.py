@@ -1,25 +1,88 @@
-from typing import Union
+import base64
+import binascii
+import copy
+import json
+from typing import Any, Iterator, Optional, Union
 
-from bson import ObjectId
-from edman import Search
+from bson import DBRef, ObjectId
+from bson import errors as bson_errors
+from edman import Config, Search
+from edman.exceptions import EdmanDbProcessError
 from edman.json_manager import GetJsonStructure
+from pymongo import ASCENDING
+
+from . import metrics
+from .read_routing import ReadRouting, current_session
+from .zip_stream import ZipStream
 
 
 class SearchManager(Search):
+    # 子ドキュメントを$inでまとめて取得する件数
+    fetch_batch_size = 1000
+    # エクスポート時にJSONをzipへ書き込む単位
+    export_buffer_size = 64 * 1024
+    # 読み込み専用の処理の送り先 Noneの時はプライマリから読み込む
+    read_routing: Optional[ReadRouting] = None
+    # get_children_pageで1回に取得する子ドキュメントの件数
+    child_page_size = 100
+    # 子ドキュメントを制限した時に、続きを取得するカーソルを格納するキー
+    child_cursor_key = '_next_children'
+
     def __init__(self, db=None):
         super().__init__(db)
+        self._file_manager = None
+        self._routed: dict[tuple, 'SearchManager'] = {}
+
+    def with_read_routing(self, read_routing: Optional[ReadRouting] = None
+                          ) -> 'SearchManager':
+        """
+        読み込み先を変更したSearchManagerを取得する
+        edmanの検索処理はセッションを受け取れないため、causal_sessionの中では
+        read-your-writesを保つためにプライマリから読み込む
+
+        :param ReadRouting or None read_routing: 読み込み先
+            Noneの時はself.read_routingを利用する
+        :return:
+        :rtype: SearchManager
+        """
+        if read_routing is None:
+            read_routing = self.read_routing
+        if read_routing is None or read_routing.is_primary or \
+                current_session() is not None or self.db is None:
+            return self
+        if (manager := self._routed.get(read_routing.key)) is None:
+            database = read_routing.apply(self.connected_db)
+            # edman.DBは接続先のDatabaseだけを差し替えて共有する
+            edman_db = copy.copy(self.db)
+            edman_db.db = database
+            manager = copy.copy(self)
+            manager.db = edman_db
+            manager.connected_db = database
+            manager._file_manager = None
+            manager._routed = {}
+            self._routed[read_routing.key] = manager
+        return manager
 
     def get_documents(self, dl_select: int, collection_name: str,
                       oid: Union[ObjectId, str], parent_depth: int,
-                      child_depth: int, exclusion=None) -> dict:
+                      child_depth: int, exclusion=None,
+                      read_routing: Optional[ReadRouting] = None,
+                      child_limit: Optional[int] = None) -> dict:
         """
         指定したドキュメントをDBから取得する
+        child_limitを指定した場合、各ノードの子ドキュメントは_id順に最大
+        child_limit件までとし、続きがあるノードにはchild_cursor_keyで
+        カーソルを付加する 続きはget_children_page()で取得する
         :param int dl_select:
         :param str collection_name:
         :param ObjectId or str oid:
         :param int parent_depth:
         :param int child_depth:
         :param List or None exclusion:
+        :param ReadRouting or None read_routing: 読み込み先
+            Noneの時はself.read_routingを利用する
+        :param int or None child_limit: ノード毎の子ドキュメント数の上限
+            Noneの時は全て取得する
         :return: result
         :rtype: dict
         """
@@ -28,19 +91,479 @@ class SearchManager(Search):
                 oid = ObjectId(oid)
             else:
                 raise ValueError('ObjectIdに合致しません')
+        if child_limit is not None and child_limit < 1:
+            raise ValueError('child_limitは1以上を指定してください')
 
-        # 階層指定
-        if dl_select == GetJsonStructure.manual_select.value:
-            result = self.find(collection_name, {'_id': ObjectId(oid)},
-                               parent_depth=parent_depth,
-                               child_depth=child_depth, exclusion=exclusion)
-
-        # 自分が所属するツリー全て
-        elif dl_select == GetJsonStructure.all_doc.value:
-            result = self.get_tree(collection_name, ObjectId(oid), exclusion)
-        else:
-            # 単一のドキュメント
-            result = self.find(collection_name, {'_id': ObjectId(oid)},
-                               parent_depth=0, child_depth=0,
-                               exclusion=exclusion)
+        searcher = self.with_read_routing(read_routing)
+        with metrics.stage('get_documents'):
+            # 階層指定
+            if dl_select == GetJsonStructure.manual_select.value:
+                if child_limit is not None and child_depth > 0:
+                    result = searcher._get_limited_documents(
+                        collection_name, oid, parent_depth, child_depth,
+                        child_limit, exclusion)
+                else:
+                    result = searcher.find(collection_name,
+                                           {'_id': ObjectId(oid)},
+                                           parent_depth=parent_depth,
+                                           child_depth=child_depth,
+                                           exclusion=exclusion)
+
+            # 自分が所属するツリー全て
+            elif dl_select == GetJsonStructure.all_doc.value:
+                if child_limit is not None:
+                    root_ref = searcher.get_root_ref(collection_name, oid)
+                    result = searcher._get_limited_documents(
+                        root_ref.collection, root_ref.id, 0, None,
+                        child_limit, exclusion)
+                else:
+                    result = searcher.get_tree(collection_name, ObjectId(oid),
+                                               exclusion)
+            else:
+                # 単一のドキュメント
+                result = searcher.find(collection_name,
+                                       {'_id': ObjectId(oid)},
+                                       parent_depth=0, child_depth=0,
+                                       exclusion=exclusion)
         return result
+
+    def _get_limited_documents(self, collection: str, oid: ObjectId,
+                               parent_depth: int, child_depth: Optional[int],
+                               child_limit: int, exclusion=None) -> dict:
+        """
+        子ドキュメントの件数をノード毎に制限して、親 + 自分 + 子を取得する
+
+        :param str collection:
+        :param ObjectId oid:
+        :param int parent_depth:
+        :param int or None child_depth: Noneの時は末端まで取得する
+        :param int child_limit:
+        :param List or None exclusion:
+        :return:
+        :rtype: dict
+        """
+        self_result = self._get_self({'_id': oid}, collection)
+        if self_result is None:
+            raise EdmanDbProcessError('データを取得できませんでした')
+        self._expand_children(collection, self_result[collection],
+                              child_depth, child_limit)
+
+        result = self_result
+        if parent_depth > 0 and Config.parent in self_result[collection]:
+            if parent_result := self._get_parent(self_result, parent_depth):
+                result = self._merge_parent(parent_result, self_result)
+        return self.generate_json_dict(result, include=exclusion)
+
+    def _expand_children(self, collection: str, doc: dict,
+                         depth: Optional[int], limit: int) -> None:
+        """
+        ドキュメントに子ドキュメントを最大limit件ずつ追加する
+        続きがある場合はchild_cursor_keyにカーソルを追加する
+        depthの末端で子ドキュメントがある場合は最初のページのカーソルを追加する
+
+        :param str collection:
+        :param dict doc:
+        :param int or None depth: Noneの時は末端まで取得する
+        :param int limit:
+        """
+        collections = self._child_collections(doc)
+        if not collections:
+            return
+
+        parent_ref = DBRef(collection, doc['_id'])
+        if depth is not None and depth <= 0:
+            doc[self.child_cursor_key] = self._encode_child_cursor(
+                parent_ref, collections, None)
+            return
+        page, position = self._fetch_children_page(parent_ref, collections,
+                                                   None, limit)
+        next_depth = None if depth is None else depth - 1
+        for child_collection, children in page.items():
+            for child in children:
+                self._expand_children(child_collection, child, next_depth,
+                                      limit)
+        doc.update(page)
+        if position is not None:
+            doc[self.child_cursor_key] = self._encode_child_cursor(
+                parent_ref, *position)
+
+    @staticmethod
+    def _child_collections(doc: dict) -> list:
+        """
+        子ドキュメントのコレクションをリファレンスの順に重複なく取得する
+
+        :param dict doc:
+        :return:
+        :rtype: list
+        """
+        return list(dict.fromkeys(
+            ref.collection for ref in doc.get(Config.child, [])))
+
+    def _fetch_children_page(self, parent_ref: DBRef, collections: list,
+                             after: Optional[ObjectId], limit: int
+                             ) -> tuple[dict, Optional[tuple]]:
+        """
+        子ドキュメントをコレクション毎に_id順で最大limit件取得する
+        先頭のコレクションはafterより大きい_idから取得する
+
+        :param DBRef parent_ref: 親ドキュメント
+        :param list collections: 子ドキュメントのコレクション
+        :param ObjectId or None after:
+        :param int limit:
+        :return: ({コレクション名: ドキュメントのリスト},
+            続きの位置(コレクションのリスト, after) 続きが無い時はNone)
+        :rtype: tuple
+        """
+        page: dict[str, list[dict]] = {}
+        remaining = limit
+        for i, collection in enumerate(collections):
+            query: dict = {Config.parent: parent_ref}
+            if i == 0 and after is not None:
+                query['_id'] = {'$gt': after}
+            # 1件多く取得して続きの有無を判定する
+            docs = list(self.connected_db[collection].find(query).sort(
+                '_id', ASCENDING).limit(remaining + 1))
+            if len(docs) > remaining:
+                page[collection] = docs[:remaining]
+                return page, (collections[i:], docs[remaining - 1]['_id'])
+            if docs:
+                page[collection] = docs
+                remaining -= len(docs)
+            if remaining == 0 and i + 1 < len(collections):
+                return page, (collections[i + 1:], None)
+        return page, None
+
+    @staticmethod
+    def _encode_child_cursor(parent_ref: DBRef, collections: list,
+                             after: Optional[ObjectId]) -> str:
+        """
+        子ドキュメントの続きの位置をカーソル文字列にする
+
+        :param DBRef parent_ref:
+        :param list collections:
+        :param ObjectId or None after:
+        :return:
+        :rtype: str
+        """
+        data = {'collection': parent_ref.collection,
+                'oid': str(parent_ref.id),
+                'collections': collections,
+                'after': str(after) if after is not None else None}
+        return base64.urlsafe_b64encode(
+            json.dumps(data, separators=(',', ':')).encode()).decode()
+
+    @staticmethod
+    def _decode_child_cursor(cursor: str) -> tuple[DBRef, list,
+                                                   Optional[ObjectId]]:
+        """
+        カーソル文字列を読み込む
+
+        :param str cursor:
+        :return: (親ドキュメント, コレクションのリスト, after)
+        :rtype: tuple
+        """
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            parent_ref = DBRef(data['collection'], ObjectId(data['oid']))
+            collections = [str(i) for i in data['collections']]
+            after = ObjectId(data['after']) \
+                if data['after'] is not None else None
+        except (binascii.Error, UnicodeError, ValueError, TypeError,
+                KeyError, bson_errors.InvalidId):
+            raise ValueError('カーソルが不正です')
+        if not collections:
+            raise ValueError('カーソルが不正です')
+        return parent_ref, collections, after
+
+    def get_children_page(self, cursor: Optional[str] = None,
+                          collection: Optional[str] = None,
+                          oid: Union[ObjectId, str, None] = None,
+                          limit: Optional[int] = None, child_depth=1,
+                          exclusion=None,
+                          read_routing: Optional[ReadRouting] = None
+                          ) -> dict:
+        """
+        ノードの子ドキュメントを1ページ分取得する
+        cursorにはget_documents()や前回の結果のカーソルを指定する
+        cursorがNoneの時はcollection, oidのノードの最初のページを取得する
+        子ドキュメントは_idの範囲で取得するので、ページの位置に関わらず
+        処理時間は一定になる(子のコレクションの{_ed_parent, _id}の
+        インデックスはcreate_child_index()で作成する)
+
+        :param str or None cursor:
+        :param str or None collection:
+        :param ObjectId or str or None oid:
+        :param int or None limit: 取得する件数
+            Noneの時はself.child_page_sizeを利用する
+        :param int child_depth: 取得する階層 default 1
+            2以上の時は孫以降もノード毎にlimit件まで取得する
+        :param List or None exclusion:
+        :param ReadRouting or None read_routing: 読み込み先
+            Noneの時はself.read_routingを利用する
+        :return: {'children': {コレクション名: ドキュメントのリスト},
+            'cursor': 続きのカーソル 続きが無い時はNone}
+        :rtype: dict
+        """
+        if limit is None:
+            limit = self.child_page_size
+        if limit < 1:
+            raise ValueError('limitは1以上を指定してください')
+        if child_depth < 1:
+            raise ValueError('child_depthは1以上を指定してください')
+
+        searcher = self.with_read_routing(read_routing)
+        with metrics.stage('get_children_page'):
+            if cursor is not None:
+                parent_ref, collections, after = self._decode_child_cursor(
+                    cursor)
+                if (collection is not None and
+                        collection != parent_ref.collection) or \
+                        (oid is not None and
+                         str(oid) != str(parent_ref.id)):
+                    raise ValueError('カーソルのノードと一致しません')
+            else:
+                if collection is None or oid is None:
+                    raise ValueError(
+                        'cursorかcollectionとoidを指定してください')
+                if not isinstance(oid, ObjectId):
+                    if ObjectId.is_valid(oid):
+                        oid = ObjectId(oid)
+                    else:
+                        raise ValueError('ObjectIdに合致しません')
+                parent_ref = DBRef(collection, oid)
+                after = None
+
+            if (doc := searcher.connected_db[parent_ref.collection].find_one(
+                    {'_id': parent_ref.id}, {Config.child: 1})) is None:
+                raise EdmanDbProcessError('対象のドキュメントが存在しません')
+            child_collections = self._child_collections(doc)
+            if cursor is None:
+                collections = child_collections
+            elif not set(collections) <= set(child_collections):
+                # カーソルは署名していないので、親の子ドキュメントの
+                # コレクション以外は読ませない
+                raise ValueError('カーソルが不正です')
+
+            page: dict[str, list[dict]] = {}
+            position = None
+            if collections:
+                page, position = searcher._fetch_children_page(
+                    parent_ref, collections, after, limit)
+            for child_collection, docs in page.items():
+                for child in docs:
+                    searcher._expand_children(child_collection, child,
+                                              child_depth - 1, limit)
+            children = self.generate_json_dict(page, include=exclusion)
+        return {'children': children,
+                'cursor': self._encode_child_cursor(parent_ref, *position)
+                if position is not None else None}
+
+    def create_child_index(self, collection: str) -> str:
+        """
+        get_children_page()で利用する{_ed_parent, _id}のインデックスを
+        子ドキュメントのコレクションに作成する
+
+        :param str collection:
+        :return: インデックス名
+        :rtype: str
+        """
+        return self.connected_db[collection].create_index(
+            [(Config.parent, ASCENDING), ('_id', ASCENDING)])
+
+    @property
+    def file_manager(self):
+        """
+        添付ファイル取得用のFileManager
+
+        :return:
+        :rtype: FileManager
+        """
+        if self._file_manager is None:
+            from .file_manager import FileManager
+            self._file_manager = FileManager(self.connected_db)
+        return self._file_manager
+
+    def get_root_ref(self, collection: str,
+                     oid: Union[ObjectId, str]) -> DBRef:
+        """
+        ドキュメントが所属するツリーのルートを親を辿って取得する
+
+        :param str collection:
+        :param ObjectId or str oid:
+        :return:
+        :rtype: DBRef
+        """
+        if not isinstance(oid, ObjectId):
+            if ObjectId.is_valid(oid):
+                oid = ObjectId(oid)
+            else:
+                raise ValueError('ObjectIdに合致しません')
+
+        ref = DBRef(collection, oid)
+        while True:
+            if (doc := self.connected_db[ref.collection].find_one(
+                    {'_id': ref.id}, {Config.parent: 1})) is None:
+                raise EdmanDbProcessError('対象のドキュメントが存在しません')
+            if (parent := doc.get(Config.parent)) is None:
+                return ref
+            ref = parent
+
+    def iter_children(self, doc: dict) -> Iterator[tuple[str, list[dict]]]:
+        """
+        子ドキュメントをコレクション毎に取得する
+        リファレンスの順序を保ったまま、fetch_batch_size件ずつ取得する
+
+        :param dict doc:
+        :return: (コレクション名, ドキュメントのリスト)
+        :rtype: Iterator
+        """
+        grouped: dict[str, list[ObjectId]] = {}
+        for ref in doc.get(Config.child, []):
+            grouped.setdefault(ref.collection, []).append(ref.id)
+
+        for collection, oids in grouped.items():
+            coll = self.connected_db[collection]
+            for i in range(0, len(oids), self.fetch_batch_size):
+                batch = oids[i:i + self.fetch_batch_size]
+                docs = {d['_id']: d for d in coll.find(
+                    {'_id': {'$in': batch}})}
+                yield collection, [docs[o] for o in batch if o in docs]
+
+    @staticmethod
+    def _json_default(value: Any) -> Any:
+        """
+        json.dumpsで変換できない値の変換
+        日付はgenerate_json_dict()で変換済み
+
+        :param Any value:
+        :return:
+        :rtype: Any
+        """
+        if isinstance(value, ObjectId):
+            return str(value)
+        if isinstance(value, DBRef):
+            return {'collection': value.collection, 'id': str(value.id)}
+        raise TypeError(f'{type(value)} はJSONに変換できません')
+
+    def _iter_node_json(self, collection: str, doc: dict,
+                        exclusion: Optional[list], file_refs: Optional[list]
+                        ) -> Iterator[str]:
+        """
+        ノード(と子孫)のJSONを断片ごとに生成する
+        ノードはgenerate_json_dict()で変換するので、get_documents()と同じ
+        形式になる
+
+        :param str collection:
+        :param dict doc:
+        :param list or None exclusion: generate_json_dict()のinclude
+        :param list or None file_refs: 添付ファイルの(パス, oid)を追加するリスト
+        :return:
+        :rtype: Iterator
+        """
+        node = dict(doc)
+        if Config.file in node and file_refs is not None:
+            # 添付ファイルはアーカイブ内のパスに置き換える
+            prefix = f"files/{collection}/{doc['_id']}"
+            node[Config.file] = [f'{prefix}/{file_oid}'
+                                 for file_oid in doc[Config.file]]
+            file_refs.extend(zip(node[Config.file], doc[Config.file]))
+        node = self.generate_json_dict({collection: node},
+                                       include=exclusion)[collection]
+        fields = [json.dumps(key, ensure_ascii=False) + ':' +
+                  json.dumps(value, default=self._json_default,
+                             ensure_ascii=False)
+                  for key, value in node.items()]
+        yield '{' + ','.join(fields)
+
+        separator = ',' if fields else ''
+        current = None
+        for child_collection, children in self.iter_children(doc):
+            for child in children:
+                if child_collection != current:
+                    if current is not None:
+                        yield ']'
+                    yield separator + json.dumps(
+                        child_collection, ensure_ascii=False) + ':['
+                    separator = ','
+                    current = child_collection
+                    first = True
+                if not first:
+                    yield ','
+                first = False
+                yield from self._iter_node_json(child_collection, child,
+                                                exclusion, file_refs)
+        if current is not None:
+            yield ']'
+        yield '}'
+
+    def iter_tree_json(self, collection: str, oid: Union[ObjectId, str],
+                       exclusion=None, file_refs=None) -> Iterator[str]:
+        """
+        ドキュメントが所属するツリー全体のJSONを断片ごとに生成する
+        ノードは辿りながら取得するため、ツリー全体をメモリに展開しない
+
+        :param str collection:
+        :param ObjectId or str oid:
+        :param list or None exclusion: 出力するedmanの項目
+            get_documents()のexclusionと同じ
+        :param list or None file_refs: 添付ファイルの(パス, oid)を追加するリスト
+        :return:
+        :rtype: Iterator
+        """
+        root_ref = self.get_root_ref(collection, oid)
+        if (root := self.connected_db[root_ref.collection].find_one(
+                {'_id': root_ref.id})) is None:
+            raise EdmanDbProcessError('対象のドキュメントが存在しません')
+        yield '{' + json.dumps(root_ref.collection, ensure_ascii=False) + ':'
+        yield from self._iter_node_json(root_ref.collection, root, exclusion,
+                                        file_refs)
+        yield '}'
+
+    def export_tree_stream(self, collection: str, oid: Union[ObjectId, str],
+                           exclusion=None, json_name='tree.json'
+                           ) -> Iterator[bytes]:
+        """
+        ツリー全体のJSONと添付ファイルを1つのZIPとしてストリームで出力する
+        添付ファイルは files/<コレクション>/<ドキュメントoid>/<ファイルoid>/<ファイル名>
+        に格納し、JSON内の添付ファイルはそのパスに置き換える
+
+        :param str collection:
+        :param ObjectId or str oid:
+        :param list or None exclusion: 出力するedmanの項目
+            get_documents()のexclusionと同じ 添付ファイルは常に出力する
+        :param str json_name: default 'tree.json'
+        :return:
+        :rtype: Iterator
+        """
+        zip_stream = ZipStream()
+        file_refs: list[tuple[str, ObjectId]] = []
+        exclusion = list(dict.fromkeys((exclusion or []) + [Config.file]))
+        yield from zip_stream.write_entry(
+            json_name,
+            self._buffered(self.iter_tree_json(collection, oid, exclusion,
+                                               file_refs)))
+
+        for path, file_oid in file_refs:
+            yield from self.file_manager.write_zip_entry(zip_stream, file_oid,
+                                                         prefix=path + '/')
+        yield from zip_stream.close()
+
+    def _buffered(self, fragments: Iterator[str]) -> Iterator[bytes]:
+        """
+        JSONの断片をexport_buffer_size毎にまとめてバイト列にする
+
+        :param Iterator fragments:
+        :return:
+        :rtype: Iterator
+        """
+        buffer: list[str] = []
+        size = 0
+        for fragment in fragments:
+            buffer.append(fragment)
+            size += len(fragment)
+            if size >= self.export_buffer_size:
+                yield ''.join(buffer).encode()
+                buffer.clear()
+                size = 0
+        if buffer:
+            yield ''.join(buffer).encode()
@@ -0,0 +1,440 @@
+import math
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from typing import TYPE_CHECKING, Any, Optional, Union
+
+import gridfs
+from bson import ObjectId
+from edman.exceptions import EdmanDbProcessError, EdmanInternalError
+from edman.utils import Utils
+from pymongo import errors as py_errors
+
+from . import metrics
+from .decode_policy import DecodePolicy
+from .exceptions import EdmanImageTooLargeError
+from .file_manager import FileManager
+
+if TYPE_CHECKING:
+    from PIL import Image as PILImage
+
+# PILの画素数の上限(プロセス全体の設定)を一時的に変更する間のロック
+_pil_limit_lock = threading.Lock()
+
+
+class TileManager(FileManager):
+    """
+    大きな画像のDeep Zoom(DZI)タイルピラミッドの作成と取得
+    タイルはGridFSの別バケットに保存し、マニフェストをコレクションに保存する
+    """
+    # タイルを保存するGridFSのバケット
+    tile_bucket = 'tiles'
+    # マニフェストを保存するコレクション
+    tile_manifest_collection = 'tiles.manifest'
+    tile_size = 256
+    tile_overlap = 1
+    tile_format = 'jpeg'
+    tile_quality = 85
+    # 作成中のマニフェストがこの時間更新されなければ作成を引き継げる
+    tile_build_timeout = timedelta(minutes=10)
+    # 他のリクエストが作成中の場合に完了を待つ秒数
+    tile_build_wait = 30.0
+    tile_build_poll_interval = 0.5
+    # タイルを作成できる元画像の最大ピクセル数
+    # サムネイル用のDecodePolicy.max_pixelsとは別に指定する
+    tile_max_pixels = 32768 * 32768
+
+    def __init__(self, db=None):
+        super().__init__(db)
+        if db is not None:
+            self.tile_fs = gridfs.GridFS(self.db, self.tile_bucket)
+
+    @staticmethod
+    def tile_filename(oid: ObjectId, level: int, x: int, y: int,
+                      tile_format: str) -> str:
+        """
+        タイルのGridFS上のファイル名
+
+        :param ObjectId oid: 元画像のoid
+        :param int level:
+        :param int x:
+        :param int y:
+        :param str tile_format:
+        :return:
+        :rtype: str
+        """
+        return f'{oid}/{level}/{x}_{y}.{tile_format}'
+
+    @staticmethod
+    def level_size(manifest: dict, level: int) -> tuple[int, int]:
+        """
+        レベルの画像サイズを取得する
+        最大レベルが元画像のサイズで、レベルが1下がる毎に1/2になる
+
+        :param dict manifest:
+        :param int level:
+        :return: (幅, 高さ)
+        :rtype: tuple
+        """
+        scale = 2 ** (manifest['max_level'] - level)
+        return (math.ceil(manifest['width'] / scale),
+                math.ceil(manifest['height'] / scale))
+
+    def get_tile_manifest(self, oid: Union[str, ObjectId]) -> Optional[dict]:
+        """
+        作成済みのタイルピラミッドのマニフェストを取得する
+
+        :param str or ObjectId oid: 元画像のoid
+        :return: 作成されていない場合はNone
+        :rtype: dict or None
+        """
+        return self.db[self.tile_manifest_collection].find_one(
+            {'_id': Utils.conv_objectid(oid), 'status': 'ready'})
+
+    def _claim_tile_build(self, oid: ObjectId, build_id: ObjectId) -> None:
+        """
+        タイルピラミッドの作成権を取得する
+        マニフェストを作成中の状態でupsertし、他のリクエストが作成中の間は
+        取得できない(作成中のまま更新されなくなった場合は取得できる)
+
+        :param ObjectId oid: 元画像のoid
+        :param ObjectId build_id: 作成権の識別子
+        :return:
+        """
+        now = datetime.now(timezone.utc)
+        try:
+            self.db[self.tile_manifest_collection].find_one_and_update(
+                {'_id': oid,
+                 '$or': [{'status': {'$ne': 'building'}},
+                         {'created': {'$lt': now - self.tile_build_timeout}}]},
+                {'$set': {'status': 'building', 'build_id': build_id,
+                          'created': now}},
+                projection={'_id': 1}, upsert=True)
+        except py_errors.DuplicateKeyError:
+            # 他のリクエストが作成中
+            raise EdmanDbProcessError(
+                'タイルを作成中です. しばらくしてから再度アクセスしてください')
+
+    def _fail_tile_build(self, oid: ObjectId, build_id: ObjectId,
+                         error: str) -> None:
+        """
+        作成できない画像の場合にマニフェストを失敗の状態にする
+        get_tile(), get_dzi()は失敗の状態の間は作成を繰り返さない
+
+        :param ObjectId oid: 元画像のoid
+        :param ObjectId build_id:
+        :param str error:
+        :return:
+        """
+        result = self.db[self.tile_manifest_collection].update_one(
+            {'_id': oid, 'build_id': build_id},
+            {'$set': {'status': 'failed', 'error': error,
+                      'created': datetime.now(timezone.utc)}})
+        if result.matched_count == 1:
+            # 失敗の状態ではどのタイルも参照されない
+            self._delete_tiles({'metadata.source': oid})
+        else:
+            self._delete_tiles({'metadata.source': oid,
+                                'metadata.build_id': build_id})
+
+    def _release_tile_build(self, oid: ObjectId, build_id: ObjectId) -> None:
+        """
+        作成に失敗した場合に作成権と作成途中のタイルを削除する
+
+        :param ObjectId oid: 元画像のoid
+        :param ObjectId build_id:
+        :return:
+        """
+        self.db[self.tile_manifest_collection].delete_one(
+            {'_id': oid, 'build_id': build_id, 'status': 'building'})
+        self._delete_tiles({'metadata.source': oid,
+                            'metadata.build_id': build_id})
+
+    def _delete_tiles(self, query: dict) -> None:
+        """
+        条件に一致するタイルを削除する
+
+        :param dict query: タイルのfilesコレクションに対する条件
+        :return:
+        """
+        for grid_out in self.tile_fs.find(query):
+            self.tile_fs.delete(grid_out._id)
+
+    def build_tile_pyramid(self, oid: Union[str, ObjectId],
+                           decode_policy: Optional[DecodePolicy] = None
+                           ) -> dict:
+        """
+        画像のタイルピラミッドを作成してGridFSに保存する
+        元画像は1回だけデコードし、レベル毎に前のレベルを1/2に縮小する
+        他のリクエストが作成中の場合はEdmanDbProcessError
+        作成できない画像の場合はマニフェストを失敗の状態にしてEdmanInternalError
+
+        :param str or ObjectId oid: 元画像のoid
+        :param DecodePolicy or None decode_policy: デコードの上限
+        :return: マニフェスト
+        :rtype: dict
+        """
+        oid = Utils.conv_objectid(oid)
+        build_id = ObjectId()
+        self._claim_tile_build(oid, build_id)
+        try:
+            manifest = self._build_tile_pyramid(oid, build_id, decode_policy)
+        except EdmanInternalError as e:
+            self._fail_tile_build(oid, build_id, str(e))
+            raise
+        except BaseException:
+            self._release_tile_build(oid, build_id)
+            raise
+
+        # 作成権を保持している場合のみ完了にする
+        result = self.db[self.tile_manifest_collection].update_one(
+            {'_id': oid, 'build_id': build_id},
+            {'$set': manifest})
+        if result.matched_count != 1:
+            self._delete_tiles({'metadata.source': oid,
+                                'metadata.build_id': build_id})
+            raise EdmanDbProcessError(
+                'タイルの作成が他のリクエストに引き継がれました')
+        # 作り直しの場合は以前のタイルを削除する
+        self._delete_tiles({'metadata.source': oid,
+                            'metadata.build_id': {'$ne': build_id}})
+        return manifest
+
+    def _build_tile_pyramid(self, oid: ObjectId, build_id: ObjectId,
+                            decode_policy: Optional[DecodePolicy] = None
+                            ) -> dict:
+        """
+        タイルを作成してGridFSに保存する
+
+        :param ObjectId oid: 元画像のoid
+        :param ObjectId build_id: タイルのmetadataに記録する作成権の識別子
+        :param DecodePolicy or None decode_policy: デコードの上限
+            バイト数と同時実行数のみ適用し、ピクセル数はtile_max_pixelsで確認する
+        :return: 完了状態のマニフェスト
+        :rtype: dict
+        """
+        from PIL import Image as PILImage
+
+        content, _, _ = self.file_download(oid)
+        if decode_policy is not None:
+            decode_policy.check_bytes(content)
+        with self.decode_slot(decode_policy):
+            try:
+                # タイルは元の解像度が必要なので縮小デコードしない
+                img = self._open_tile_source(content)
+                width, height = img.size
+                if width * height > self.tile_max_pixels:
+                    raise EdmanImageTooLargeError(
+                        f'画像が大きすぎます {width}x{height} '
+                        f'(上限 {self.tile_max_pixels} ピクセル)')
+                with metrics.stage('build_tile_pyramid.decode') as st:
+                    img.load()
+                    st.add_bytes(len(content))
+            except (IOError, KeyError, PILImage.DecompressionBombError) as e:
+                raise EdmanInternalError(f'画像を読み込めませんでした {e}')
+            del content
+
+            tile_format = self.tile_format
+            if img.mode in ('I', 'F') or img.mode.startswith('I;16'):
+                # 16bit、浮動小数点の検出器の画像はコントラストを調整する
+                import numpy as np
+
+                img = PILImage.fromarray(self.scale_to_uint8(np.asarray(img)))
+            elif 'A' in img.mode or 'transparency' in img.info:
+                img = img.convert('RGBA')
+                tile_format = 'png'
+            elif img.mode not in ('L', 'RGB'):
+                img = img.convert('RGB')
+
+            width, height = img.size
+            manifest: dict[str, Any] = {
+                '_id': oid,
+                'width': width,
+                'height': height,
+                'tile_size': self.tile_size,
+                'overlap': self.tile_overlap,
+                'format': tile_format,
+                'max_level': math.ceil(math.log2(max(width, height, 1))),
+                'build_id': build_id,
+            }
+
+            for level in range(manifest['max_level'], -1, -1):
+                size = self.level_size(manifest, level)
+                if img.size != size:
+                    with metrics.stage('build_tile_pyramid.resize'):
+                        img = img.resize(size, PILImage.Resampling.BOX)
+                with metrics.stage('build_tile_pyramid.tiles') as st:
+                    st.add_bytes(self._put_level_tiles(manifest, level, img))
+
+        self.db[f'{self.tile_bucket}.files'].create_index('metadata.source')
+        manifest['status'] = 'ready'
+        manifest['created'] = datetime.now(timezone.utc)
+        return manifest
+
+    def _open_tile_source(self, content: bytes) -> 'PILImage.Image':
+        """
+        タイルの元画像をPILで開く(デコードはまだ行わない)
+        PILの画素数の上限はサムネイル向けなので、開く間だけ
+        tile_max_pixelsまで引き上げる
+
+        :param bytes content:
+        :return:
+        :rtype: PILImage.Image
+        """
+        from PIL import Image as PILImage
+
+        with _pil_limit_lock:
+            limit = PILImage.MAX_IMAGE_PIXELS
+            if limit is not None and limit < self.tile_max_pixels:
+                PILImage.MAX_IMAGE_PIXELS = self.tile_max_pixels
+            try:
+                return PILImage.open(BytesIO(content))
+            finally:
+                PILImage.MAX_IMAGE_PIXELS = limit
+
+    def _put_level_tiles(self, manifest: dict, level: int,
+                         img: 'PILImage.Image') -> int:
+        """
+        1レベル分のタイルを切り出してGridFSに保存する
+
+        :param dict manifest:
+        :param int level:
+        :param PILImage.Image img: レベルのサイズに縮小済みの画像
+        :return: 保存したバイト数
+        :rtype: int
+        """
+        tile_size = manifest['tile_size']
+        overlap = manifest['overlap']
+        width, height = img.size
+        save_options = self.thumbnail_save_options(manifest['format'])
+        if manifest['format'] == 'jpeg':
+            save_options['quality'] = self.tile_quality
+        nbytes = 0
+        for y in range(math.ceil(height / tile_size)):
+            for x in range(math.ceil(width / tile_size)):
+                # 隣接するタイルとoverlapピクセルずつ重ねる
+                box = (max(x * tile_size - overlap, 0),
+                       max(y * tile_size - overlap, 0),
+                       min((x + 1) * tile_size + overlap, width),
+                       min((y + 1) * tile_size + overlap, height))
+                data = self.encode_thumbnail(img.crop(box),
+                                             manifest['format'],
+                                             **save_options)
+                self.tile_fs.put(
+                    data,
+                    filename=self.tile_filename(manifest['_id'], level, x, y,
+                                                manifest['format']),
+                    metadata={'source': manifest['_id'],
+                              'build_id': manifest['build_id'],
+                              'level': level, 'x': x, 'y': y})
+                nbytes += len(data)
+        return nbytes
+
+    def _ensure_tile_manifest(self, oid: ObjectId, build: bool) -> dict:
+        """
+        作成済みのマニフェストを取得する 未作成の場合はbuild=Trueの時に作成する
+        他のリクエストが作成中の場合はtile_build_waitの間完了を待ち、
+        完了しなければEdmanDbProcessError(時間をおいて再試行できる)
+
+        :param ObjectId oid: 元画像のoid
+        :param bool build:
+        :return: マニフェスト
+        :rtype: dict
+        """
+        if (manifest := self.get_tile_manifest(oid)) is not None:
+            return manifest
+        if (failed := self.db[self.tile_manifest_collection].find_one(
+                {'_id': oid, 'status': 'failed'})) is not None:
+            raise EdmanInternalError(
+                f"タイルを作成できませんでした {failed.get('error')}")
+        if not build:
+            raise ValueError('タイルが作成されていません')
+        try:
+            return self.build_tile_pyramid(oid)
+        except EdmanDbProcessError:
+            deadline = time.monotonic() + self.tile_build_wait
+            while time.monotonic() < deadline:
+                time.sleep(self.tile_build_poll_interval)
+                if (manifest := self.get_tile_manifest(oid)) is not None:
+                    return manifest
+            raise
+
+    def get_tile(self, oid: Union[str, ObjectId], level: int, x: int,
+                 y: int, build=True) -> tuple[bytes, str]:
+        """
+        タイルを取得する
+        タイルピラミッドが未作成の場合はbuild=Trueの時に作成する
+
+        :param str or ObjectId oid: 元画像のoid
+        :param int level:
+        :param int x:
+        :param int y:
+        :param bool build: default True
+        :return: (タイルのデータ, mimetype)
+        :rtype: tuple
+        """
+        oid = Utils.conv_objectid(oid)
+        manifest = self._ensure_tile_manifest(oid, build)
+
+        if not 0 <= level <= manifest['max_level']:
+            raise ValueError('レベルが範囲外です')
+        width, height = self.level_size(manifest, level)
+        if not (0 <= x < math.ceil(width / manifest['tile_size']) and
+                0 <= y < math.ceil(height / manifest['tile_size'])):
+            raise ValueError('タイルの位置が範囲外です')
+
+        try:
+            with metrics.stage('get_tile') as st:
+                data = self.tile_fs.get_last_version(
+                    self.tile_filename(oid, level, x, y, manifest['format']),
+                    **{'metadata.build_id': manifest['build_id']}).read()
+                st.add_bytes(len(data))
+        except gridfs.errors.NoFile:
+            raise ValueError('タイルが存在しません')
+        return data, f"image/{manifest['format']}"
+
+    def get_dzi(self, oid: Union[str, ObjectId], build=True) -> str:
+        """
+        Deep Zoomのディスクリプタ(.dzi)を取得する
+
+        :param str or ObjectId oid: 元画像のoid
+        :param bool build: default True
+        :return:
+        :rtype: str
+        """
+        manifest = self._ensure_tile_manifest(Utils.conv_objectid(oid), build)
+        tile_format = 'jpg' if manifest['format'] == 'jpeg' \
+            else manifest['format']
+        return ('<?xml version="1.0" encoding="UTF-8"?>'
+                '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+                f'TileSize="{manifest["tile_size"]}" '
+                f'Overlap="{manifest["overlap"]}" Format="{tile_format}">'
+                f'<Size Width="{manifest["width"]}" '
+                f'Height="{manifest["height"]}"/></Image>')
+
+    def delete_tile_pyramid(self, oid: Union[str, ObjectId]) -> None:
+        """
+        タイルピラミッドを削除する
+
+        :param str or ObjectId oid: 元画像のoid
+        :return:
+        """
+        oid = Utils.conv_objectid(oid)
+        self._delete_tiles({'metadata.source': oid})
+        self.db[self.tile_manifest_collection].delete_one({'_id': oid})
+
+    def file_delete(self, collection: str, oid: Union[str, ObjectId],
+                    delete_list: list):
+        """
+        edmanからファイルを削除する
+        ファイルのタイルピラミッドも削除する
+
+        :param str collection:
+        :param str or ObjectId oid:
+        :param list delete_list:
+        :return:
+        """
+        super().file_delete(collection, oid, delete_list)
+        for file_oid in delete_list:
+            self.delete_tile_pyramid(file_oid)
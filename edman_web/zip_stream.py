@@ -0,0 +1,132 @@
+import zipfile
+from datetime import datetime
+from typing import Iterable, Iterator, Optional
+
+# 既に圧縮済みでdeflateしても縮まない拡張子
+STORED_SUFFIXES = frozenset({
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'avif', 'heic', 'jp2',
+    'gz', 'tgz', 'bz2', 'xz', 'zst', 'zip', '7z', 'rar', 'lz4',
+    'mp4', 'm4v', 'mov', 'avi', 'mkv', 'webm', 'mp3', 'm4a', 'ogg',
+    'flac', 'pdf', 'h5', 'hdf5', 'nxs',
+})
+
+# ZIP64を強制する閾値(deflateで膨らむ分の余裕を持たせる)
+ZIP64_THRESHOLD = zipfile.ZIP64_LIMIT // 2
+
+
+class _StreamBuffer:
+    """
+    ZipFileの書き込み先
+    tell()を持たないためZipFileはシーク不可として扱い、データディスクリプタを使う
+    """
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+
+    def write(self, data) -> int:
+        if data:
+            self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ZipStream:
+    """
+    ZIPアーカイブを少しずつ生成するストリーム
+    各メソッドはジェネレータで、書き出されたバイト列を順次yieldする
+    """
+
+    def __init__(self, compresslevel=6):
+        self._buffer = _StreamBuffer()
+        self._zip = zipfile.ZipFile(self._buffer, mode='w',
+                                    compression=zipfile.ZIP_DEFLATED,
+                                    compresslevel=compresslevel)
+        self._names: set[str] = set()
+
+    @staticmethod
+    def is_stored(filename: str) -> bool:
+        """
+        無圧縮で格納するファイルか否か
+
+        :param str filename:
+        :return:
+        :rtype: bool
+        """
+        suffix = filename.rsplit('.', 1)[-1].lower() if '.' in filename \
+            else ''
+        return suffix in STORED_SUFFIXES
+
+    def unique_name(self, arcname: str) -> str:
+        """
+        アーカイブ内で重複しないエントリ名を返す
+
+        :param str arcname:
+        :return:
+        :rtype: str
+        """
+        if arcname not in self._names:
+            self._names.add(arcname)
+            return arcname
+        stem, dot, suffix = arcname.rpartition('.')
+        if not dot or '/' in suffix:
+            stem, suffix = arcname, ''
+        i = 1
+        while True:
+            candidate = f'{stem} ({i}).{suffix}' if suffix \
+                else f'{stem} ({i})'
+            if candidate not in self._names:
+                self._names.add(candidate)
+                return candidate
+            i += 1
+
+    def write_entry(self, arcname: str, chunks: Iterable[bytes],
+                    size_hint=0, stored=None,
+                    date_time: Optional[datetime] = None
+                    ) -> Iterator[bytes]:
+        """
+        エントリを1つ書き込む
+
+        :param str arcname:
+        :param Iterable chunks: エントリの中身
+        :param int size_hint: 想定サイズ ZIP64の判定に利用
+        :param bool or None stored: Noneの時は拡張子から判定
+        :param datetime or None date_time: エントリの更新日時
+        :return:
+        :rtype: Iterator
+        """
+        if stored is None:
+            stored = self.is_stored(arcname)
+        if date_time is None:
+            date_time = datetime.now()
+        info = zipfile.ZipInfo(self.unique_name(arcname),
+                               date_time=date_time.timetuple()[:6])
+        info.compress_type = zipfile.ZIP_STORED if stored \
+            else zipfile.ZIP_DEFLATED
+        # 外部属性に通常ファイルのパーミッションを設定
+        info.external_attr = 0o644 << 16
+        with self._zip.open(info, mode='w',
+                            force_zip64=size_hint >= ZIP64_THRESHOLD) as w:
+            for chunk in chunks:
+                w.write(chunk)
+                if data := self._buffer.drain():
+                    yield data
+        if data := self._buffer.drain():
+            yield data
+
+    def close(self) -> Iterator[bytes]:
+        """
+        セントラルディレクトリを書き込んでアーカイブを閉じる
+
+        :return:
+        :rtype: Iterator
+        """
+        self._zip.close()
+        if data := self._buffer.drain():
+            yield data
@@ -0,0 +1,79 @@
+import configparser
+from pathlib import Path
+from unittest import TestCase
+
+from edman import DB
+from pymongo import MongoClient
+from pymongo import errors as py_errors
+
+
+class DBTestCase(TestCase):
+    """
+    テスト用のDBとユーザを作成するテストケースの基底クラス
+    DBサーバに接続できない時はdb_server_connectがFalseになる
+    """
+    db_server_connect = False
+    test_ini: dict = {}
+    client = None
+    con: dict = {}
+
+    @classmethod
+    def setUpClass(cls):
+        # 設定読み込み
+        settings = configparser.ConfigParser()
+        settings.read(Path.cwd() / 'ini' / 'test_db.ini')
+        cls.test_ini = dict(settings.items('DB'))
+        cls.test_ini['port'] = int(cls.test_ini['port'])
+
+        # DB作成のため、pymongoから接続
+        cls.client = MongoClient(cls.test_ini['host'], cls.test_ini['port'])
+
+        # 接続確認
+        try:
+            cls.client.admin.command('hello')
+            cls.db_server_connect = True
+            print('Use DB.')
+        except py_errors.ConnectionFailure:
+            print('Do not use DB.')
+
+        if cls.db_server_connect:
+            # adminで認証
+            cls.client = MongoClient(
+                username=cls.test_ini['admin_user'],
+                password=cls.test_ini['admin_password'])
+            # DB作成
+            cls.client[cls.test_ini['db']].command(
+                "createUser",
+                cls.test_ini['user'],
+                pwd=cls.test_ini['password'],
+                roles=[
+                    {
+                        'role': 'dbOwner',
+                        'db': cls.test_ini['db'],
+                    },
+                ],
+            )
+            cls.con = {
+                'host': cls.test_ini['host'],
+                'port': cls.test_ini['port'],
+                'user': cls.test_ini['user'],
+                'password': cls.test_ini['password'],
+                'database': cls.test_ini['db'],
+                'options': [f"authSource={cls.test_ini['db']}"]
+            }
+            cls.edman_db = DB(cls.con)
+            cls.testdb = cls.edman_db.get_db
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.db_server_connect:
+            cls.client[cls.test_ini['db']].command(
+                "dropUser", cls.test_ini['user'])
+            cls.client.drop_database(cls.test_ini['db'])
+
+    def tearDown(self):
+        if self.db_server_connect:
+            # システムログ以外のコレクションを削除
+            for collection in self.testdb.list_collection_names():
+                if collection != 'system.profile':
+                    self.testdb.drop_collection(collection)
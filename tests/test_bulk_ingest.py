@@ -0,0 +1,145 @@
+import io
+import json
+import os
+import tarfile
+import tempfile
+import zipfile
+
+from bson import ObjectId
+from edman import Config
+from edman.exceptions import EdmanInternalError
+
+from edman_web.bulk_ingest import BulkIngest
+from edman_web.file_manager import FileManager
+
+from .db_test_case import DBTestCase
+
+
+class TestBulkIngest(DBTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        if cls.db_server_connect:
+            cls.file_manager = FileManager(cls.testdb)
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+    def test_split_member(self):
+        ingest = BulkIngest(None, 'col')
+        oid = str(ObjectId())
+        self.assertTupleEqual((oid, 'a.txt'),
+                              ingest._split_member(f'./{oid}/sub/a.txt'))
+        with self.assertRaises(EdmanInternalError):
+            ingest._split_member('a.txt')
+        with self.assertRaises(EdmanInternalError):
+            ingest._split_member('abc/a.txt')
+
+    def test_run_manifest(self):
+        if not self.db_server_connect:
+            return
+
+        doc_oids = [ObjectId() for _ in range(2)]
+        self.testdb['col'].insert_many(
+            [{'_id': oid, 'name': 'test'} for oid in doc_oids])
+        manifest = {}
+        for i, oid in enumerate(doc_oids):
+            manifest[str(oid)] = []
+            for j in range(5):
+                name = f'{i}_{j}.txt'
+                with open(os.path.join(self.tmpdir.name, name), 'wb') as f:
+                    f.write(name.encode())
+                manifest[str(oid)].append(name)
+        manifest_path = os.path.join(self.tmpdir.name, 'manifest.json')
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+        checkpoint = os.path.join(self.tmpdir.name, 'checkpoint')
+
+        progress = []
+        ingest = BulkIngest(self.file_manager, 'col', workers=3,
+                            batch_size=2, checkpoint=checkpoint,
+                            progress=progress.append)
+        result = ingest.run(ingest.iter_manifest(
+            ingest.load_manifest(manifest_path)))
+        self.assertEqual(10, result['files'])
+        self.assertEqual(70, result['bytes'])
+        self.assertListEqual([], result['errors'])
+        # 5件をbatch_size=2で添付するので、ドキュメント毎に3回更新する
+        self.assertEqual(6, result['documents_updated'])
+        self.assertTrue(progress)
+        for i, oid in enumerate(doc_oids):
+            doc = self.testdb['col'].find_one({'_id': oid})
+            names = sorted(self.file_manager.fs.get(file_oid).filename
+                           for file_oid in doc[Config.file])
+            self.assertListEqual([f'{i}_{j}.txt' for j in range(5)], names)
+
+        # 再実行時はチェックポイントから添付済みのファイルを読み飛ばす
+        result = ingest.run(ingest.iter_manifest(
+            ingest.load_manifest(manifest_path)))
+        self.assertEqual(0, result['files'])
+        self.assertEqual(10, result['skipped'])
+
+        # チェックポイントが無くても、登録済みのファイルは再利用する
+        os.remove(checkpoint)
+        result = ingest.run(ingest.iter_manifest(
+            ingest.load_manifest(manifest_path)))
+        self.assertEqual(0, result['files'])
+        self.assertEqual(10, result['recovered'])
+        self.assertEqual(10, self.testdb['fs.files'].count_documents({}))
+        for oid in doc_oids:
+            doc = self.testdb['col'].find_one({'_id': oid})
+            self.assertEqual(5, len(doc[Config.file]))
+
+    def test_run_archive(self):
+        if not self.db_server_connect:
+            return
+
+        oid = ObjectId()
+        self.testdb['col'].insert_one({'_id': oid, 'name': 'test'})
+        missing = ObjectId()
+        path = os.path.join(self.tmpdir.name, 'files.tar.gz')
+        with tarfile.open(path, mode='w:gz') as tf:
+            for doc_oid, name in [(oid, 'a.txt'), (oid, 'b.txt'),
+                                  (missing, 'c.txt')]:
+                info = tarfile.TarInfo(f'{doc_oid}/{name}')
+                info.size = 3
+                tf.addfile(info, io.BytesIO(b'abc'))
+
+        ingest = BulkIngest(self.file_manager, 'col')
+        result = ingest.run(ingest.iter_archive(path))
+        self.assertEqual(2, result['files'])
+        self.assertEqual(1, result['documents_updated'])
+        # 存在しないドキュメントのファイルはアップロードしない
+        self.assertEqual(1, len(result['errors']))
+        self.assertEqual(2, self.testdb['fs.files'].count_documents({}))
+        doc = self.testdb['col'].find_one({'_id': oid})
+        self.assertEqual(2, len(doc[Config.file]))
+
+    def test_run_zip(self):
+        if not self.db_server_connect:
+            return
+
+        oid = ObjectId()
+        self.testdb['col'].insert_one({'_id': oid, 'name': 'test'})
+        path = os.path.join(self.tmpdir.name, 'files.zip')
+        data = {f'{i}.bin': os.urandom(1024 * (i + 1)) for i in range(8)}
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for name, content in data.items():
+                zf.writestr(f'{oid}/{name}', content)
+
+        # メンバはワーカーで展開しながら登録される
+        ingest = BulkIngest(self.file_manager, 'col', workers=4,
+                            batch_size=3)
+        result = ingest.run(ingest.iter_archive(path))
+        self.assertEqual(8, result['files'])
+        self.assertEqual(sum(len(i) for i in data.values()), result['bytes'])
+        self.assertListEqual([], result['errors'])
+        for name, content in data.items():
+            self.assertEqual(content,
+                             self.file_manager.fs.find_one(
+                                 {'filename': name}).read())
@@ -0,0 +1,69 @@
+from io import BytesIO
+from unittest import TestCase
+
+from edman.exceptions import EdmanInternalError
+from PIL import Image
+
+from edman_web.decode_policy import DecodePolicy
+from edman_web.exceptions import EdmanImageTooLargeError
+from edman_web.file_manager import FileManager
+
+
+class TestDecodePolicy(TestCase):
+
+    @staticmethod
+    def make_image(size, image_format):
+        img = BytesIO()
+        Image.new("RGB", size, (0, 128, 255)).save(img, image_format)
+        return img.getvalue()
+
+    def test_reduce_factor(self):
+        policy = DecodePolicy(max_pixels=1000 * 1000)
+        self.assertEqual(1, policy.reduce_factor(1000, 1000, 'JPEG'))
+        self.assertEqual(2, policy.reduce_factor(2000, 2000, 'JPEG'))
+        self.assertEqual(8, policy.reduce_factor(8000, 8000, 'JPEG'))
+        # JPEG以外は縮小デコードできない
+        with self.assertRaises(EdmanImageTooLargeError):
+            policy.reduce_factor(2000, 2000, 'PNG')
+        # JPEGでも1/8で収まらない
+        with self.assertRaises(EdmanImageTooLargeError):
+            policy.reduce_factor(10000, 10000, 'JPEG')
+
+    def test_open(self):
+        policy = DecodePolicy(max_pixels=500 * 500)
+        content = self.make_image((2000, 1500), 'jpeg')
+        self.assertTupleEqual((2000, 1500, 4), policy.inspect(content))
+        img = policy.open(content)
+        img.load()
+        self.assertLessEqual(img.size[0] * img.size[1], policy.max_pixels)
+
+        # バイト数の上限
+        policy = DecodePolicy(max_bytes=100)
+        with self.assertRaises(EdmanImageTooLargeError):
+            policy.open(content)
+
+    def test_generate_thumbnail(self):
+        policy = DecodePolicy(max_pixels=500 * 500, max_concurrent=2)
+        content = self.make_image((2000, 1500), 'jpeg')
+        for method in (FileManager.generate_thumbnail,
+                       FileManager.generate_thumbnail2,
+                       FileManager.generate_thumbnail3):
+            self.assertTrue(method(content, 'jpg', (100, 100),
+                                   decode_policy=policy))
+        result = FileManager.generate_thumbnails(
+            content, 'jpg', [(100, 100), (50, 50)], decode_policy=policy)
+        self.assertSetEqual({(100, 100), (50, 50)}, set(result))
+
+        # 画像でないデータは他のサムネイル作成と同じエラー
+        for method in (FileManager.generate_thumbnail,
+                       FileManager.generate_thumbnail2):
+            with self.assertRaises(EdmanInternalError) as cm:
+                method(b'not an image', 'jpg', (100, 100),
+                       decode_policy=policy)
+            self.assertNotIsInstance(cm.exception, EdmanImageTooLargeError)
+
+        # 縮小デコードできない画像
+        content = self.make_image((2000, 1500), 'png')
+        with self.assertRaises(EdmanImageTooLargeError):
+            FileManager.generate_thumbnail(content, 'png', (100, 100),
+                                           decode_policy=policy)
@@ -0,0 +1,135 @@
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from edman.exceptions import EdmanInternalError
+
+from edman_web.disk_cache import DiskCache
+
+
+class TestDiskCache(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.directory = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_put_read(self):
+        cache = DiskCache(self.directory, max_bytes=1024)
+        self.assertIsNone(cache.read('abc'))
+        path = cache.put('abc', iter([b'test', b'data']))
+        self.assertEqual(os.path.join(self.directory, 'abc'), path)
+        self.assertIn('abc', cache)
+        self.assertEqual(b'testdata', cache.read('abc'))
+        cache.put('empty', iter([]))
+        self.assertEqual(b'', cache.read('empty'))
+        with cache.open('abc') as f:
+            self.assertEqual(b'testdata', f.read())
+        # 一時ファイルは残らない
+        self.assertListEqual(['abc', 'empty'],
+                             sorted(os.listdir(self.directory)))
+
+    def test_put_error(self):
+        cache = DiskCache(self.directory, max_bytes=1024)
+
+        def chunks():
+            yield b'test'
+            raise IOError('error')
+
+        with self.assertRaises(IOError):
+            cache.put('abc', chunks())
+        self.assertNotIn('abc', cache)
+        self.assertListEqual([], os.listdir(self.directory))
+
+    def test_invalid_key(self):
+        cache = DiskCache(self.directory, max_bytes=1024)
+        for key in ('', '../abc', '.tmp-abc', 'a/b'):
+            with self.assertRaises(EdmanInternalError):
+                cache.put(key, iter([b'test']))
+
+    def test_evict(self):
+        cache = DiskCache(self.directory, max_bytes=250)
+        now = time.time()
+        for i, key in enumerate(('a', 'b', 'c')):
+            cache.put(key, iter([b'x' * 100]))
+            os.utime(cache.path(key), (now - 100 + i, now - 100 + i))
+        # 'a'が最も古いので削除される
+        self.assertNotIn('a', cache)
+        cache.read('b')
+        cache.put('d', iter([b'x' * 100]))
+        # 'b'は読み込まれたので'c'が削除される
+        self.assertIn('b', cache)
+        self.assertNotIn('c', cache)
+        self.assertIn('d', cache)
+
+    def test_put_too_large(self):
+        cache = DiskCache(self.directory, max_bytes=250)
+        cache.put('a', iter([b'x' * 100]))
+        # 容量の上限より大きいものは書き込まず、他のキャッシュも残す
+        self.assertIsNone(cache.put('b', iter([b'x' * 200, b'x' * 100])))
+        self.assertNotIn('b', cache)
+        self.assertIn('a', cache)
+        self.assertListEqual(['a'], os.listdir(self.directory))
+
+    def test_evict_removed_by_other_process(self):
+        cache = DiskCache(self.directory, max_bytes=250)
+        cache.put('a', iter([b'x' * 100]))
+        cache.put('b', iter([b'x' * 100]))
+        # 他のプロセスが削除した場合は一覧を読み直す
+        os.unlink(cache.path('a'))
+        cache.put('c', iter([b'x' * 100]))
+        cache.put('d', iter([b'x' * 100]))
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+        self.assertIn('d', cache)
+
+    def test_restart(self):
+        cache = DiskCache(self.directory, max_bytes=250)
+        cache.put('a', iter([b'x' * 100]))
+        cache.put('b', iter([b'x' * 100]))
+        now = time.time()
+        os.utime(cache.path('a'), (now - 10, now - 10))
+
+        # 再起動後も内容と順序を引き継ぐ
+        cache = DiskCache(self.directory, max_bytes=250)
+        self.assertEqual(b'x' * 100, cache.read('b'))
+        cache.put('c', iter([b'x' * 100]))
+        self.assertNotIn('a', cache)
+        self.assertIn('b', cache)
+
+    def test_delete(self):
+        cache = DiskCache(self.directory, max_bytes=1024)
+        cache.put('abc', iter([b'test']))
+        cache.delete('abc')
+        cache.delete('abc')
+        self.assertIsNone(cache.open('abc'))
+
+    def test_meta(self):
+        cache = DiskCache(self.directory, max_bytes=250)
+        self.assertIsNone(cache.read_meta('a'))
+        cache.put('a', iter([b'x' * 100]), meta={'filename': 'テスト.txt'})
+        self.assertDictEqual({'filename': 'テスト.txt'}, cache.read_meta('a'))
+        # メタデータは容量に含めず、キャッシュの一覧にも現れない
+        cache = DiskCache(self.directory, max_bytes=250)
+        self.assertEqual(100, cache._total)
+        self.assertListEqual(['a'], list(cache._entries))
+
+        # メタデータ無しで書き直すと古いメタデータは削除される
+        cache.put('a', iter([b'x' * 100]))
+        self.assertIsNone(cache.read_meta('a'))
+
+        # 削除、追い出し時にメタデータも削除される
+        cache.put('a', iter([b'x' * 100]), meta={'filename': 'a.txt'})
+        cache.put('b', iter([b'x' * 100]), meta={'filename': 'b.txt'})
+        cache.delete('b')
+        self.assertIsNone(cache.read_meta('b'))
+        now = time.time()
+        os.utime(cache.path('a'), (now - 100, now - 100))
+        cache.put('c', iter([b'x' * 100]))
+        cache.put('d', iter([b'x' * 100]))
+        self.assertNotIn('a', cache)
+        self.assertIsNone(cache.read_meta('a'))
+        self.assertListEqual(['c', 'd'], sorted(os.listdir(self.directory)))
@@ -4,7 +4,11 @@ import gzip
 import mimetypes
 import os
 import tempfile
+import threading
 import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from io import BytesIO
 # from logging import getLogger,  FileHandler, ERROR
 from logging import ERROR, StreamHandler, getLogger
@@ -12,14 +16,18 @@ from pathlib import Path
 from unittest import TestCase
 
 import gridfs
+import numpy as np
 from bson import DBRef, ObjectId
 from edman import DB, Config
+from edman.exceptions import EdmanDbProcessError, EdmanInternalError
 from PIL import Image
 from pymongo import MongoClient
 from pymongo import errors as py_errors
 from werkzeug.datastructures import FileStorage
 
+from edman_web.disk_cache import DiskCache
 from edman_web.file_manager import FileManager
+from edman_web.read_routing import ReadRouting, session_token
 
 
 class TestSearchManager(TestCase):
@@ -530,3 +538,514 @@ class TestSearchManager(TestCase):
         actual = thumb_raw.size
         expected = img_size
         self.assertTupleEqual(expected, actual)
+
+    def test_zip_stream(self):
+        if not self.db_server_connect:
+            return
+
+        # gridfsにファイルを入れる(1つはgzip圧縮)
+        self.fs = gridfs.GridFS(self.testdb)
+        text = b'test' * 100000
+        img = BytesIO()
+        Image.new("L", (200, 200)).save(img, 'png')
+        files_oid = [
+            self.fs.put(text, filename='a.txt'),
+            self.fs.put(gzip.compress(img.getvalue()), filename='b.png'),
+            self.fs.put(b'dup', filename='a.txt'),
+        ]
+        doc_id = ObjectId()
+        doc_col = 'doc_col'
+        self.testdb[doc_col].insert_one(
+            {'_id': doc_id, 'name': 'doc', Config.file: files_oid})
+
+        out = BytesIO()
+        for data in self.file_manager.zip_stream(doc_col, doc_id):
+            out.write(data)
+
+        with zipfile.ZipFile(out) as zf:
+            self.assertListEqual(['a.txt', 'b.png', 'a (1).txt'],
+                                 zf.namelist())
+            self.assertEqual(text, zf.read('a.txt'))
+            self.assertEqual(img.getvalue(), zf.read('b.png'))
+            self.assertEqual(b'dup', zf.read('a (1).txt'))
+            self.assertEqual(zipfile.ZIP_STORED,
+                             zf.getinfo('b.png').compress_type)
+
+        # file_oidsで指定
+        out = BytesIO()
+        for data in self.file_manager.zip_stream(file_oids=files_oid[:1]):
+            out.write(data)
+        with zipfile.ZipFile(out) as zf:
+            self.assertListEqual(['a.txt'], zf.namelist())
+
+    def test_generate_thumbnails(self):
+        if not self.db_server_connect:
+            return
+
+        # 正常系
+        content = Image.new("RGB", (1280, 960), (0, 128, 255))
+        img = BytesIO()
+        content.save(img, 'jpeg')
+        sizes = [(64, 64), (320, 320), (100, 100)]
+        result = self.file_manager.generate_thumbnails(
+            img.getvalue(), 'jpg', sizes, output_formats=[None, 'png', None])
+
+        expected = {(64, 64): ((64, 48), 'jpg'),
+                    (320, 320): ((320, 240), 'png'),
+                    (100, 100): ((100, 75), 'jpg')}
+        actual = {}
+        for size, thumb in result.items():
+            thumb_raw = Image.open(BytesIO(base64.b64decode(thumb['data'])))
+            actual[size] = (thumb_raw.size, thumb['suffix'])
+        self.assertDictEqual(expected, actual)
+
+        # サイズとフォーマットの数が異なる
+        with self.assertRaises(EdmanInternalError):
+            self.file_manager.generate_thumbnails(
+                img.getvalue(), 'jpg', sizes, output_formats=['png'])
+
+    def test_get_multi_thumbnails_procedure(self):
+        if not self.db_server_connect:
+            return
+
+        content = Image.new("L", (200, 200))
+        img = BytesIO()
+        content.save(img, 'png')
+        self.fs = gridfs.GridFS(self.testdb)
+        put_result = self.fs.put(gzip.compress(img.getvalue()),
+                                 filename='test.png')
+
+        files = [(put_result, 'test.png')]
+        result = self.file_manager.get_multi_thumbnails_procedure(
+            files, ['jpg', 'jpeg', 'gif', 'png'], [(100, 100), (50, 50)])
+        actual = {size: Image.open(
+            BytesIO(base64.b64decode(thumb['data']))).size
+            for size, thumb in result[put_result].items()}
+        expected = {(100, 100): (100, 100), (50, 50): (50, 50)}
+        self.assertDictEqual(expected, actual)
+
+    def test_negotiate_thumbnail_format(self):
+        if not self.db_server_connect:
+            return
+
+        supported = self.file_manager.supported_thumbnail_formats()
+
+        # webpを受け付ける場合
+        accept = 'image/webp,image/apng,image/*,*/*;q=0.8'
+        expected = 'webp' if 'webp' in supported else 'jpeg'
+        actual = self.file_manager.negotiate_thumbnail_format(accept)
+        self.assertEqual(expected, actual)
+
+        # avifを受け付ける場合
+        accept = 'image/avif,image/webp,*/*;q=0.8'
+        if 'avif' in supported:
+            expected = 'avif'
+        actual = self.file_manager.negotiate_thumbnail_format(accept)
+        self.assertEqual(expected, actual)
+
+        # q=0で拒否している場合、ヘッダが無い場合
+        accept = 'image/webp;q=0,image/avif;q=0'
+        self.assertEqual(
+            'jpeg', self.file_manager.negotiate_thumbnail_format(accept))
+        self.assertEqual(
+            'jpeg', self.file_manager.negotiate_thumbnail_format(None))
+
+    def test_generate_thumbnail_output_format(self):
+        if not self.db_server_connect:
+            return
+
+        content = Image.new("RGBA", (400, 300), (0, 128, 255, 128))
+        img = BytesIO()
+        content.save(img, 'png')
+        for output_format in ('jpeg', 'webp'):
+            result = self.file_manager.generate_thumbnail(
+                img.getvalue(), 'png', (100, 100),
+                output_format=output_format)
+            thumb_raw = Image.open(BytesIO(base64.b64decode(result)))
+            self.assertEqual(output_format.upper(), thumb_raw.format)
+            self.assertTupleEqual((100, 75), thumb_raw.size)
+
+    def test_resumable_upload(self):
+        if not self.db_server_connect:
+            return
+
+        doc_id = ObjectId()
+        doc_col = 'doc_col'
+        self.testdb[doc_col].insert_one({'_id': doc_id, 'name': 'doc'})
+        content = os.urandom(1000)
+
+        file_oid = self.file_manager.upload_init(doc_col, doc_id, 'a.bin',
+                                                 chunk_size=64)
+        offset = self.file_manager.upload_append(file_oid, 0, content[:100])
+        self.assertEqual(100, offset)
+        # 再送(受信済みの範囲を含む)
+        offset = self.file_manager.upload_append(file_oid, 50,
+                                                 content[50:300])
+        self.assertEqual(300, offset)
+        self.assertEqual(300, self.file_manager.upload_offset(file_oid))
+        # 不正なオフセット
+        with self.assertRaises(EdmanInternalError):
+            self.file_manager.upload_append(file_oid, 500, content[500:])
+        with self.assertRaises(EdmanInternalError):
+            self.file_manager.upload_append(file_oid, -10, content[290:])
+        self.assertEqual(300, self.file_manager.upload_offset(file_oid))
+        offset = self.file_manager.upload_append(file_oid, 300,
+                                                 BytesIO(content[300:]))
+        self.assertEqual(len(content), offset)
+
+        actual_oid = self.file_manager.upload_finalize(file_oid)
+        self.assertEqual(file_oid, actual_oid)
+        d = self.testdb[doc_col].find_one({'_id': doc_id})
+        self.assertListEqual([file_oid], d[Config.file])
+        fs = gridfs.GridFS(self.testdb)
+        self.assertEqual(content, fs.get(file_oid).read())
+        self.assertEqual(0, self.testdb[
+            self.file_manager.pending_upload_collection].count_documents({}))
+
+        # 中止と期限切れの削除
+        file_oid = self.file_manager.upload_init(doc_col, doc_id, 'b.bin',
+                                                 chunk_size=64)
+        self.file_manager.upload_append(file_oid, 0, content)
+        self.file_manager.upload_abort(file_oid)
+        self.assertEqual(0, self.testdb['fs.chunks'].count_documents(
+            {'files_id': file_oid}))
+
+        file_oid = self.file_manager.upload_init(doc_col, doc_id, 'c.bin',
+                                                 chunk_size=64)
+        self.file_manager.upload_append(file_oid, 0, content)
+        self.assertEqual(0, self.file_manager.sweep_pending_uploads())
+        self.assertEqual(1, self.file_manager.sweep_pending_uploads(
+            max_age=timedelta(seconds=-1)))
+        self.assertEqual(0, self.testdb['fs.chunks'].count_documents(
+            {'files_id': file_oid}))
+
+    def test_resumable_upload_conflict(self):
+        if not self.db_server_connect:
+            return
+
+        doc_id = ObjectId()
+        doc_col = 'doc_col'
+        self.testdb[doc_col].insert_one({'_id': doc_id, 'name': 'doc'})
+        content = os.urandom(1000)
+        other = os.urandom(1000)
+        file_oid = self.file_manager.upload_init(doc_col, doc_id, 'a.bin',
+                                                 chunk_size=64)
+
+        # 2回目の読み込みで止まるストリーム(書き込み権の取得後に止まる)
+        reading = threading.Event()
+        release = threading.Event()
+
+        class BlockingStream(BytesIO):
+            calls = 0
+
+            def read(self, size=-1):
+                self.calls += 1
+                if self.calls == 2:
+                    reading.set()
+                    release.wait(10)
+                return super().read(size)
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(self.file_manager.upload_append,
+                                     file_oid, 0, BlockingStream(content))
+            self.assertTrue(reading.wait(10))
+            # 同じオフセットへの追記は、チャンクを書き込む前に失敗する
+            with self.assertRaises(EdmanDbProcessError):
+                self.file_manager.upload_append(file_oid, 0, other)
+            self.assertEqual(0, self.testdb['fs.chunks'].count_documents(
+                {'files_id': file_oid}))
+            with self.assertRaises(EdmanDbProcessError):
+                self.file_manager.upload_finalize(file_oid)
+            release.set()
+            self.assertEqual(len(content), future.result(10))
+
+        self.file_manager.upload_finalize(file_oid)
+        fs = gridfs.GridFS(self.testdb)
+        self.assertEqual(content, fs.get(file_oid).read())
+        # 完了後の追記はチャンクを書き込まない
+        with self.assertRaises(EdmanDbProcessError):
+            self.file_manager.upload_append(file_oid, len(content) - 10,
+                                            other)
+        self.assertEqual(content, fs.get(file_oid).read())
+        # チャンクの一意インデックスが作成されている
+        self.assertIn({'files_id': 1, 'n': 1},
+                      [dict(i['key']) for i in
+                       self.testdb['fs.chunks'].list_indexes()])
+
+    def test_get_thumbnails_procedure_scientific(self):
+        if not self.db_server_connect:
+            return
+
+        arr = np.linspace(0, 60000, 200 * 200).reshape(200, 200)
+        f = BytesIO()
+        np.save(f, arr.astype(np.uint16))
+        self.fs = gridfs.GridFS(self.testdb)
+        put_result = self.fs.put(f.getvalue(), filename='frame.npy')
+
+        files = [(put_result, 'frame.npy')]
+        result = self.file_manager.get_thumbnails_procedure(
+            files, ['png', 'npy'])
+        self.assertEqual('png', result[put_result]['suffix'])
+        thumb_raw = Image.open(
+            BytesIO(base64.b64decode(result[put_result]['data'])))
+        self.assertTupleEqual((100, 100), thumb_raw.size)
+
+    def test_get_thumbnails_procedure_video(self):
+        if not self.db_server_connect:
+            return
+
+        import cv2
+
+        # 先頭が真っ黒で、その後に明るいフレームが続く動画を作成
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'movie.avi')
+            writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'),
+                                     10, (320, 240))
+            for i in range(10):
+                value = 0 if i < 3 else 200
+                writer.write(np.full((240, 320, 3), value, dtype=np.uint8))
+            writer.release()
+            with open(path, 'rb') as f:
+                data = f.read()
+
+        self.fs = gridfs.GridFS(self.testdb)
+        put_result = self.fs.put(data, filename='movie.avi')
+        files = [(put_result, 'movie.avi')]
+        result = self.file_manager.get_thumbnails_procedure(
+            files, ['avi'], thumbnail_size=(100, 100))
+        self.assertEqual('jpeg', result[put_result]['suffix'])
+        thumb_raw = Image.open(
+            BytesIO(base64.b64decode(result[put_result]['data'])))
+        self.assertTupleEqual((100, 75), thumb_raw.size)
+        # 黒いフレームは代表フレームに選ばれない
+        self.assertGreater(np.asarray(thumb_raw).mean(), 100)
+
+        # 2回目はキャッシュから取得する
+        key = self.file_manager.thumbnail_cache_key(put_result, (100, 100),
+                                                    'jpeg')
+        self.assertEqual(result[put_result]['data'],
+                         self.file_manager.get_cached_thumbnail(key))
+        self.assertDictEqual(
+            result, self.file_manager.get_thumbnails_procedure(
+                files, ['avi'], thumbnail_size=(100, 100)))
+
+        # ファイル削除時にキャッシュも削除される
+        insert_result = self.testdb['video'].insert_one(
+            {'name': 'test', Config.file: [put_result]})
+        self.file_manager.file_delete('video', insert_result.inserted_id,
+                                      [str(put_result)])
+        self.assertIsNone(self.file_manager.get_cached_thumbnail(key))
+
+    def test_is_scientific_image(self):
+        def tiff(img, **kwargs):
+            f = BytesIO()
+            img.save(f, format='TIFF', **kwargs)
+            return f.getvalue()
+
+        rgb = Image.new('RGB', (20, 30), (10, 20, 30))
+        uint16 = Image.fromarray(np.zeros((20, 30), dtype=np.uint16))
+        self.assertFalse(FileManager.is_scientific_image(tiff(rgb), 'tif'))
+        self.assertTrue(FileManager.is_scientific_image(tiff(uint16), 'tif'))
+        # マルチページは8bitでも代表ページを選ぶため対象
+        self.assertTrue(FileManager.is_scientific_image(
+            tiff(rgb, save_all=True, append_images=[rgb]), 'tiff'))
+        self.assertTrue(FileManager.is_scientific_image(b'', 'npy'))
+        self.assertFalse(FileManager.is_scientific_image(b'', 'png'))
+
+    def test_get_thumbnails_procedure_rgb_tiff(self):
+        if not self.db_server_connect:
+            return
+
+        f = BytesIO()
+        Image.new('RGB', (200, 200), (10, 20, 30)).save(f, format='TIFF')
+        self.fs = gridfs.GridFS(self.testdb)
+        put_result = self.fs.put(gzip.compress(f.getvalue()),
+                                 filename='photo.tif')
+
+        # 8bitのTIFFは指定の出力形式で作成される
+        files = [(put_result, 'photo.tif')]
+        result = self.file_manager.get_thumbnails_procedure(
+            files, ['tif'], output_format='webp', use_cache=True)
+        self.assertEqual('webp', result[put_result]['suffix'])
+        thumb_raw = Image.open(
+            BytesIO(base64.b64decode(result[put_result]['data'])))
+        self.assertEqual('WEBP', thumb_raw.format)
+        key = self.file_manager.thumbnail_cache_key(put_result, (100, 100),
+                                                    'webp')
+        self.assertEqual(result[put_result]['data'],
+                         self.file_manager.get_cached_thumbnail(key))
+
+        # 品質が異なる場合は別のキャッシュになる
+        key = self.file_manager.thumbnail_cache_key(put_result, (100, 100),
+                                                    'webp', quality=30)
+        self.assertIsNone(self.file_manager.get_cached_thumbnail(key))
+        result = self.file_manager.get_thumbnails_procedure(
+            files, ['tif'], output_format='webp', quality=30, use_cache=True)
+        self.assertEqual(result[put_result]['data'],
+                         self.file_manager.get_cached_thumbnail(key))
+
+    def test_load_scientific_array_multipage(self):
+        pages = [Image.fromarray(np.full((20, 30), i * 1000, dtype=np.uint16))
+                 for i in range(3)]
+        f = BytesIO()
+        pages[0].save(f, format='TIFF', save_all=True,
+                      append_images=pages[1:])
+        arr = FileManager.load_scientific_array(f.getvalue(), 'tiff')
+        # 中央のページを代表とする
+        self.assertTupleEqual((20, 30), arr.shape)
+        self.assertEqual(1000, int(arr[0, 0]))
+
+    def test_disk_cache(self):
+        if not self.db_server_connect:
+            return
+
+        self.fs = gridfs.GridFS(self.testdb)
+        data = b'reference data' * 100
+        put_result = self.fs.put(gzip.compress(data), filename='ref.txt')
+        insert_result = self.testdb['cached'].insert_one(
+            {'name': 'test', Config.file: [put_result]})
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file_manager = FileManager(self.testdb)
+            file_manager.disk_cache = DiskCache(tmpdir)
+            content, filename, _ = file_manager.file_download(put_result)
+            self.assertEqual(data, content)
+            # 解凍済みのデータがキャッシュされる
+            self.assertEqual(data, file_manager.disk_cache.read(put_result))
+            self.assertEqual((data, filename, 'text/plain'),
+                             file_manager.file_download(put_result))
+            self.assertDictEqual(
+                {'filename': 'ref.txt'},
+                file_manager.disk_cache.read_meta(put_result))
+
+            # キャッシュにある場合はGridFSを参照しない
+            read_fs = file_manager.read_fs
+            file_manager.read_fs = None
+            try:
+                self.assertEqual((data, 'ref.txt', 'text/plain'),
+                                 file_manager.file_download(put_result))
+                f, filename, mimetype = file_manager.file_open(put_result)
+                with f:
+                    self.assertEqual(data, f.read())
+                self.assertEqual(('ref.txt', 'text/plain'),
+                                 (filename, mimetype))
+            finally:
+                file_manager.read_fs = read_fs
+            f, _, mimetype = file_manager.file_open(put_result)
+            with f:
+                self.assertEqual(data, f.read())
+                self.assertEqual('text/plain', mimetype)
+
+            # ファイル削除時にキャッシュも削除される
+            file_manager.file_delete('cached', insert_result.inserted_id,
+                                     [str(put_result)])
+            self.assertNotIn(put_result, file_manager.disk_cache)
+
+        # 解凍後に容量の上限を超えるファイルはキャッシュせず、
+        # 既存のキャッシュも削除しない
+        large = b'x' * 4096
+        large_oid = self.fs.put(gzip.compress(large), filename='large.txt')
+        self.assertEqual(len(large), FileManager.stored_file_size(
+            self.fs.get(large_oid)))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file_manager = FileManager(self.testdb)
+            file_manager.disk_cache = DiskCache(tmpdir, max_bytes=2048)
+            file_manager.disk_cache.put('other', iter([b'other']))
+            self.assertEqual(large, file_manager.file_download(large_oid)[0])
+            f, _, _ = file_manager.file_open(large_oid)
+            with f:
+                self.assertEqual(large, f.read())
+            self.assertNotIn(large_oid, file_manager.disk_cache)
+            self.assertIn('other', file_manager.disk_cache)
+
+    def test_build_sprite_sheet(self):
+        images = [np.full((10, 20, 3), 10, dtype=np.uint8),
+                  np.full((20, 5, 3), 20, dtype=np.uint8),
+                  np.full((20, 20, 3), 30, dtype=np.uint8)]
+        sheet, positions = FileManager.build_sprite_sheet(images, (20, 20),
+                                                          columns=2)
+        self.assertTupleEqual((40, 40, 3), sheet.shape)
+        self.assertListEqual([[0, 0], [20, 0], [0, 20]], positions.tolist())
+        for (x, y), arr in zip(positions.tolist(), images):
+            h, w = arr.shape[:2]
+            np.testing.assert_array_equal(arr, sheet[y:y + h, x:x + w])
+        # 空いている部分は白
+        self.assertEqual(255, int(sheet[15, 0].min()))
+        self.assertEqual(255, int(sheet[39, 39].min()))
+
+    def test_get_sprite_sheets_procedure(self):
+        if not self.db_server_connect:
+            return
+
+        self.fs = gridfs.GridFS(self.testdb)
+        files = []
+        for i, size in enumerate([(200, 100), (100, 200), (300, 300)]):
+            f = BytesIO()
+            Image.new('RGB', size, (i * 100, 0, 0)).save(f, 'jpeg')
+            files.append((self.fs.put(f.getvalue(), filename=f'{i}.jpg'),
+                          f'{i}.jpg'))
+
+        result = self.file_manager.get_sprite_sheets_procedure(
+            files, ['jpg'], thumbnail_size=(50, 50), columns=2, rows=1)
+        self.assertEqual(2, len(result['sheets']))
+        self.assertDictEqual(
+            {'sheet': 0, 'x': 50, 'y': 0, 'width': 25, 'height': 50},
+            result['offsets'][files[1][0]])
+        self.assertDictEqual(
+            {'sheet': 1, 'x': 0, 'y': 0, 'width': 50, 'height': 50},
+            result['offsets'][files[2][0]])
+        sheet = Image.open(
+            BytesIO(base64.b64decode(result['sheets'][0]['data'])))
+        self.assertTupleEqual((100, 50), sheet.size)
+        self.assertGreater(sheet.getpixel((60, 25))[0], 80)
+
+        # oidの順序が違っても同じキャッシュを利用する
+        key = self.file_manager.sprite_cache_key(
+            [oid for oid, _ in files], (50, 50), 'jpeg', 2, 1)
+        self.assertIsNotNone(self.file_manager.get_cached_thumbnail(key))
+        self.assertDictEqual(
+            result, self.file_manager.get_sprite_sheets_procedure(
+                list(reversed(files)), ['jpg'], thumbnail_size=(50, 50),
+                columns=2, rows=1))
+
+        # ファイル削除時にキャッシュも削除される
+        insert_result = self.testdb['sprite'].insert_one(
+            {'name': 'test', Config.file: [oid for oid, _ in files]})
+        self.file_manager.file_delete('sprite', insert_result.inserted_id,
+                                      [str(files[0][0])])
+        self.assertIsNone(self.file_manager.get_cached_thumbnail(key))
+
+    def test_read_routing(self):
+        if not self.db_server_connect:
+            return
+
+        insert_result = self.testdb['routing'].insert_one({'name': 'test'})
+        routing = ReadRouting('secondaryPreferred', max_staleness_seconds=90)
+        # 単一ホストのレプリカセットではプライマリから読み込まれる
+        self.assertIs(self.file_manager.read_fs(routing),
+                      self.file_manager.read_fs(routing))
+        self.assertIs(self.file_manager.fs,
+                      self.file_manager.read_fs(ReadRouting('primary')))
+
+        with self.file_manager.causal_session() as session:
+            self.file_manager.web_upload(
+                'routing', insert_result.inserted_id,
+                FileStorage(stream=BytesIO(b'routing'),
+                            filename='routing.txt'))
+            doc = self.testdb['routing'].find_one(
+                {'_id': insert_result.inserted_id})
+            file_oid = doc[Config.file][0]
+            # アップロード直後でもセカンダリ指定で読み込める
+            content, filename, _ = self.file_manager.file_download(
+                file_oid, read_routing=ReadRouting('nearest'))
+            self.assertEqual(b'routing', content)
+            self.assertEqual('routing.txt', filename)
+            token = session_token(session)
+
+        is_replica_set = 'setName' in self.client.admin.command('hello')
+        if is_replica_set:
+            self.assertIsNotNone(token)
+        with self.file_manager.causal_session(after=token):
+            content, _, _ = self.file_manager.file_download(
+                file_oid, read_routing=routing)
+            self.assertEqual(b'routing', content)
@@ -0,0 +1,35 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+from unittest import TestCase
+
+# 画像処理関連の重いライブラリ
+IMAGING_MODULES = ('cv2', 'numpy', 'imutils', 'PIL')
+
+
+class TestImport(TestCase):
+
+    @staticmethod
+    def loaded_modules(code: str) -> set:
+        # 新しいインタプリタで実行し、読み込まれたモジュールを取得する
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [str(Path(__file__).resolve().parents[1]),
+             env.get('PYTHONPATH', '')])
+        result = subprocess.run(
+            [sys.executable, '-c',
+             code + '\nimport sys\nprint(" ".join(sys.modules))'],
+            env=env, capture_output=True, text=True, check=True)
+        return set(result.stdout.split())
+
+    def test_search_manager_import(self):
+        modules = self.loaded_modules('from edman_web import SearchManager')
+        for name in IMAGING_MODULES:
+            self.assertNotIn(name, modules)
+
+    def test_file_manager_import(self):
+        # サムネイル作成まで画像処理ライブラリは読み込まない
+        modules = self.loaded_modules('from edman_web import FileManager')
+        for name in IMAGING_MODULES:
+            self.assertNotIn(name, modules)
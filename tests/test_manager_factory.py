@@ -0,0 +1,86 @@
+import gc
+import json
+import os
+import subprocess
+import sys
+import textwrap
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from edman_web import FileManager, SearchManager
+from edman_web import manager_factory
+from edman_web.manager_factory import ManagerFactory
+
+from .db_test_case import DBTestCase
+
+
+class TestManagerFactory(DBTestCase):
+
+    def test_get_managers(self):
+        if not self.db_server_connect:
+            return
+
+        factory = ManagerFactory(self.con, max_pool_size=10,
+                                 wait_queue_timeout_ms=1000)
+        try:
+            file_manager = factory.get_file_manager()
+            search_manager = factory.get_search_manager()
+            self.assertIsInstance(file_manager, FileManager)
+            self.assertIsInstance(search_manager, SearchManager)
+
+            # 同じインスタンスが返ること(複数スレッドから取得しても同じ)
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                actual = set(map(id, executor.map(
+                    lambda _: factory.get_file_manager(), range(32))))
+            self.assertSetEqual({id(file_manager)}, actual)
+            self.assertIs(search_manager, factory.get_search_manager())
+
+            # プール設定が接続に反映されていること
+            client = factory.get_db().get_db.client
+            self.assertEqual(10, client.options.pool_options.max_pool_size)
+        finally:
+            factory.close()
+
+    def test_reset_after_fork(self):
+        if not self.db_server_connect:
+            return
+
+        # pytestのプロセスはスレッドを持つので、forkは別のインタプリタで行う
+        script = textwrap.dedent("""
+            import json, os, sys
+            from edman_web.manager_factory import ManagerFactory
+
+            factory = ManagerFactory(json.loads(sys.argv[1]))
+            file_manager = factory.get_file_manager()
+            pid = os.fork()
+            if pid == 0:
+                # register_at_forkのフックで接続が破棄されていること
+                ok = (not factory._registry and
+                      factory._pid == os.getpid() and
+                      factory.get_file_manager() is not file_manager)
+                factory.close()
+                os._exit(0 if ok else 1)
+            _, status = os.waitpid(pid, 0)
+            # 親プロセスの接続はそのまま使えること
+            ok = factory.get_file_manager() is file_manager
+            factory.close()
+            sys.exit(os.waitstatus_to_exitcode(status) or (0 if ok else 2))
+        """)
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [str(Path(__file__).resolve().parents[1]),
+             env.get('PYTHONPATH', '')])
+        result = subprocess.run(
+            [sys.executable, '-c', script, json.dumps(self.con)],
+            env=env, capture_output=True, text=True, timeout=60)
+        self.assertEqual(0, result.returncode, result.stderr)
+
+    def test_release_factory(self):
+        # forkのフックはファクトリを保持しないので、不要になれば解放される
+        factory = ManagerFactory({'database': 'test'})
+        self.assertIn(factory, manager_factory._live_factories)
+        ref = weakref.ref(factory)
+        del factory
+        gc.collect()
+        self.assertIsNone(ref())
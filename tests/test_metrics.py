@@ -0,0 +1,62 @@
+from unittest import TestCase
+
+from edman_web import metrics
+
+
+class TestMetrics(TestCase):
+
+    def tearDown(self):
+        metrics.set_sink(None)
+
+    def test_stage_disabled(self):
+        # 出力先もTraceも無い場合は何もしない
+        self.assertIs(metrics._NULL_STAGE, metrics.stage('test'))
+        with metrics.stage('test') as st:
+            st.add_bytes(10)
+
+    def test_in_memory_metrics(self):
+        sink = metrics.InMemoryMetrics(buckets=(0.1, 1.0))
+        metrics.set_sink(sink)
+        with metrics.stage('fetch') as st:
+            st.add_bytes(100)
+        with metrics.stage('fetch') as st:
+            st.add_bytes(50)
+        sink.observe('encode', 5.0, 10)
+
+        snapshot = sink.snapshot()
+        self.assertEqual(2, snapshot['fetch']['count'])
+        self.assertEqual(150, snapshot['fetch']['bytes'])
+        self.assertListEqual([2, 0, 0], snapshot['fetch']['buckets'])
+        self.assertListEqual([0, 0, 1], snapshot['encode']['buckets'])
+
+        text = sink.prometheus_text()
+        self.assertIn('# TYPE edman_web_stage_seconds histogram', text)
+        self.assertIn(
+            'edman_web_stage_seconds_bucket{stage="encode",le="1.0"} 0',
+            text)
+        self.assertIn(
+            'edman_web_stage_seconds_bucket{stage="encode",le="+Inf"} 1',
+            text)
+        self.assertIn('edman_web_stage_seconds_count{stage="fetch"} 2', text)
+        self.assertIn('edman_web_stage_bytes_total{stage="fetch"} 150', text)
+
+        sink.reset()
+        self.assertDictEqual({}, sink.snapshot())
+
+    def test_trace(self):
+        # 出力先が無くてもTraceには記録される
+        with metrics.trace() as trace:
+            with metrics.stage('fetch') as st:
+                st.add_bytes(100)
+            with metrics.stage('fetch'):
+                pass
+            with metrics.stage('encode'):
+                pass
+        summary = trace.summary()
+        self.assertEqual(2, summary['fetch']['count'])
+        self.assertEqual(100, summary['fetch']['bytes'])
+        self.assertEqual(1, summary['encode']['count'])
+        self.assertIn('fetch=', trace.format())
+
+        # ブロックを抜けた後は記録しない
+        self.assertIs(metrics._NULL_STAGE, metrics.stage('fetch'))
@@ -0,0 +1,41 @@
+from unittest import TestCase
+
+from pymongo import read_preferences
+
+from edman_web.read_routing import ReadRouting, current_session
+
+
+class TestReadRouting(TestCase):
+
+    def test_read_preference(self):
+        routing = ReadRouting('secondaryPreferred', max_staleness_seconds=90)
+        preference = routing.read_preference()
+        self.assertIsInstance(preference, read_preferences.SecondaryPreferred)
+        self.assertEqual(90, preference.max_staleness)
+        self.assertFalse(routing.is_primary)
+
+        preference = ReadRouting('nearest').read_preference()
+        self.assertIsInstance(preference, read_preferences.Nearest)
+        self.assertEqual(-1, preference.max_staleness)
+
+        routing = ReadRouting('primary')
+        self.assertIsInstance(routing.read_preference(),
+                              read_preferences.Primary)
+        self.assertTrue(routing.is_primary)
+
+    def test_key(self):
+        self.assertEqual(ReadRouting('nearest', 120).key,
+                         ReadRouting('nearest', 120).key)
+        self.assertNotEqual(ReadRouting('nearest').key,
+                            ReadRouting('nearest', 120).key)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            ReadRouting('secondary_preferred')
+        with self.assertRaises(ValueError):
+            ReadRouting('nearest', max_staleness_seconds=10)
+        with self.assertRaises(ValueError):
+            ReadRouting('primary', max_staleness_seconds=90)
+
+    def test_current_session(self):
+        self.assertIsNone(current_session())
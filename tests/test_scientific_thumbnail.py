@@ -0,0 +1,80 @@
+import base64
+from io import BytesIO
+from unittest import TestCase
+
+import numpy as np
+from PIL import Image
+
+from edman_web.file_manager import FileManager
+
+
+class TestScientificThumbnail(TestCase):
+
+    @staticmethod
+    def to_npy(arr):
+        f = BytesIO()
+        np.save(f, arr)
+        return f.getvalue()
+
+    @staticmethod
+    def decode(data):
+        return Image.open(BytesIO(base64.b64decode(data)))
+
+    def test_load_scientific_array(self):
+        arr = np.arange(12, dtype=np.float32).reshape(3, 4)
+        actual = FileManager.load_scientific_array(self.to_npy(arr), 'npy')
+        np.testing.assert_array_equal(arr, actual)
+
+        # Fortran順
+        arr = np.asfortranarray(arr)
+        actual = FileManager.load_scientific_array(self.to_npy(arr), 'npy')
+        np.testing.assert_array_equal(arr, actual)
+
+        # 16bit TIFF
+        arr = np.arange(12, dtype=np.uint16).reshape(3, 4) * 1000
+        f = BytesIO()
+        Image.fromarray(arr).save(f, 'tiff')
+        actual = FileManager.load_scientific_array(f.getvalue(), 'tiff')
+        np.testing.assert_array_equal(arr, actual)
+
+    def test_scale_to_uint8(self):
+        arr = np.linspace(0, 1000, 10000, dtype=np.float32).reshape(100, 100)
+        actual = FileManager.scale_to_uint8(arr, percentiles=(0, 100))
+        self.assertEqual(np.uint8, actual.dtype)
+        self.assertEqual(0, actual.min())
+        self.assertEqual(255, actual.max())
+
+        actual = FileManager.scale_to_uint8(arr, scaling='log')
+        self.assertEqual(255, actual.max())
+
+        # NaNと一定値
+        arr[0, 0] = np.nan
+        self.assertEqual(0, FileManager.scale_to_uint8(arr)[0, 0])
+        flat = np.full((10, 10), 5, dtype=np.uint16)
+        self.assertEqual(0, FileManager.scale_to_uint8(flat).max())
+
+    def test_generate_scientific_thumbnail(self):
+        # 16bitの値域が小さい画像が黒くならないこと
+        arr = np.random.default_rng(0).integers(
+            1000, 1200, size=(2000, 1500), dtype=np.uint16)
+        content = self.to_npy(arr)
+        result = FileManager.generate_scientific_thumbnail(
+            content, 'npy', (100, 100))
+        thumb = self.decode(result)
+        self.assertEqual('PNG', thumb.format)
+        self.assertTupleEqual((75, 100), thumb.size)
+        self.assertGreater(np.asarray(thumb).mean(), 64)
+
+        # 浮動小数点TIFF
+        f = BytesIO()
+        Image.fromarray(arr.astype(np.float32)).save(f, 'tiff')
+        result = FileManager.generate_scientific_thumbnail(
+            f.getvalue(), 'tiff', (100, 100), output_format='jpeg',
+            scaling='log')
+        self.assertEqual('JPEG', self.decode(result).format)
+
+        # 3次元(スタック)は先頭のフレーム
+        stack = np.stack([arr[:100, :100]] * 3, axis=0)
+        result = FileManager.generate_scientific_thumbnail(
+            self.to_npy(stack), 'npy', (50, 50))
+        self.assertTupleEqual((50, 50), self.decode(result).size)
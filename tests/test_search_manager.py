@@ -1,14 +1,20 @@
 import configparser
+import json
+import zipfile
+from datetime import datetime
+from io import BytesIO
 # from logging import getLogger,  FileHandler, ERROR
 from logging import ERROR, StreamHandler, getLogger
 from pathlib import Path
 from unittest import TestCase
 
+import gridfs
 from bson import DBRef, ObjectId
 from edman import DB, Config
 from pymongo import MongoClient
 from pymongo import errors as py_errors
 
+from edman_web.read_routing import ReadRouting
 from edman_web.search_manager import SearchManager
 
 
@@ -161,3 +167,206 @@ class TestSearchManager(TestCase):
             }
         }
         self.assertDictEqual(expected, all_docs)
+
+        # セカンダリ指定でも同じ結果になる(単一ホストではプライマリから読み込む)
+        routing = ReadRouting('secondaryPreferred', max_staleness_seconds=90)
+        self.assertDictEqual(expected, self.search_manager.get_documents(
+            2, doc_col, doc_id, parent_depth=0, child_depth=0,
+            read_routing=routing))
+        routed = self.search_manager.with_read_routing(routing)
+        self.assertIs(routed, self.search_manager.with_read_routing(routing))
+        self.assertIsNot(self.search_manager, routed)
+
+    def test_export_tree_stream(self):
+        if not self.db_server_connect:
+            return
+
+        # docをDBに入れる
+        fs = gridfs.GridFS(self.testdb)
+        file_oid = fs.put(b'test' * 1000, filename='a.txt')
+        parent_id = ObjectId()
+        doc_id = ObjectId()
+        child_id = ObjectId()
+        parent_col = 'parent_col'
+        doc_col = 'doc_col'
+        child_col = 'child_col'
+        self.testdb[parent_col].insert_one({
+            '_id': parent_id,
+            'name': 'parent',
+            Config.child: [DBRef(doc_col, doc_id)]})
+        self.testdb[doc_col].insert_one({
+            '_id': doc_id,
+            'name': 'doc',
+            Config.file: [file_oid],
+            Config.parent: DBRef(parent_col, parent_id),
+            Config.child: [DBRef(child_col, child_id)]})
+        self.testdb[child_col].insert_one({
+            '_id': child_id,
+            'name': 'child',
+            Config.parent: DBRef(doc_col, doc_id)})
+
+        out = BytesIO()
+        for data in self.search_manager.export_tree_stream(child_col,
+                                                           child_id):
+            out.write(data)
+
+        file_dir = f'files/{doc_col}/{doc_id}/{file_oid}'
+        with zipfile.ZipFile(out) as zf:
+            actual = json.loads(zf.read('tree.json'))
+            expected = {
+                parent_col: {
+                    'name': 'parent',
+                    doc_col: [{
+                        'name': 'doc',
+                        Config.file: [file_dir],
+                        child_col: [{'name': 'child'}]
+                    }]
+                }
+            }
+            self.assertDictEqual(expected, actual)
+            self.assertEqual(b'test' * 1000, zf.read(file_dir + '/a.txt'))
+
+    def test_iter_tree_json(self):
+        if not self.db_server_connect:
+            return
+
+        # 日付を含むツリー
+        parent_id = ObjectId()
+        doc_id = ObjectId()
+        child_ids = [ObjectId(), ObjectId()]
+        self.testdb['parent_col'].insert_one({
+            '_id': parent_id,
+            'name': 'parent',
+            'created': datetime(2024, 1, 2, 3, 4, 5),
+            Config.child: [DBRef('doc_col', doc_id)]})
+        self.testdb['doc_col'].insert_one({
+            '_id': doc_id,
+            'name': 'doc',
+            'dates': [datetime(2024, 5, 6)],
+            'nest': {'at': datetime(2024, 7, 8, 9, 10, 11)},
+            Config.parent: DBRef('parent_col', parent_id),
+            Config.child: [DBRef('child_col', i) for i in child_ids]})
+        self.testdb['child_col'].insert_many([
+            {'_id': i, 'name': f'child{n}',
+             Config.parent: DBRef('doc_col', doc_id)}
+            for n, i in enumerate(child_ids)])
+
+        # ストリームでもget_documents()と同じJSONになる
+        for exclusion in (None, ['_id']):
+            expected = self.search_manager.get_documents(
+                2, 'child_col', child_ids[0], parent_depth=0, child_depth=0,
+                exclusion=exclusion)
+            actual = json.loads(''.join(self.search_manager.iter_tree_json(
+                'child_col', child_ids[0], exclusion)))
+            self.assertEqual(
+                json.loads(json.dumps(expected, default=str)), actual)
+        self.assertEqual({Config.date: '2024-01-02 03:04:05'},
+                         actual['parent_col']['created'])
+
+    def test_get_children_page(self):
+        if not self.db_server_connect:
+            return
+
+        # 子ドキュメントが多いツリーをDBに入れる
+        parent_id = ObjectId()
+        doc_id = ObjectId()
+        child_ids = [ObjectId() for _ in range(5)]
+        other_ids = [ObjectId() for _ in range(2)]
+        parent_col = 'parent_col'
+        doc_col = 'doc_col'
+        child_col = 'child_col'
+        other_col = 'other_col'
+        self.testdb[parent_col].insert_one({
+            '_id': parent_id,
+            'name': 'parent',
+            Config.child: [DBRef(doc_col, doc_id)]})
+        self.testdb[doc_col].insert_one({
+            '_id': doc_id,
+            'name': 'doc',
+            Config.parent: DBRef(parent_col, parent_id),
+            Config.child: [DBRef(child_col, i) for i in child_ids] +
+                          [DBRef(other_col, i) for i in other_ids]})
+        self.testdb[child_col].insert_many([
+            {'_id': i, 'name': f'child{n}',
+             Config.parent: DBRef(doc_col, doc_id)}
+            for n, i in enumerate(child_ids)])
+        self.testdb[other_col].insert_many([
+            {'_id': i, 'name': f'other{n}',
+             Config.parent: DBRef(doc_col, doc_id)}
+            for n, i in enumerate(other_ids)])
+        self.search_manager.create_child_index(child_col)
+
+        # 階層指定 子は_id順にchild_limit件まで
+        result = self.search_manager.get_documents(
+            1, doc_col, doc_id, parent_depth=1, child_depth=1,
+            child_limit=2)
+        doc = result[parent_col][doc_col]
+        self.assertEqual([{'name': 'child0'}, {'name': 'child1'}],
+                         doc[child_col])
+        self.assertNotIn(other_col, doc)
+        cursor = doc[self.search_manager.child_cursor_key]
+
+        # カーソルで続きを取得する コレクションを跨いで取得できる
+        names = [i['name'] for i in doc[child_col]]
+        while cursor is not None:
+            page = self.search_manager.get_children_page(cursor, limit=2)
+            for children in page['children'].values():
+                self.assertLessEqual(len(children), 2)
+                names.extend(i['name'] for i in children)
+            cursor = page['cursor']
+        self.assertEqual([f'child{i}' for i in range(5)] +
+                         [f'other{i}' for i in range(2)], names)
+
+        # ツリー全て
+        result = self.search_manager.get_documents(
+            2, child_col, child_ids[0], parent_depth=0, child_depth=0,
+            child_limit=3)
+        doc = result[parent_col][doc_col][0]
+        self.assertEqual(3, len(doc[child_col]))
+        self.assertIn(self.search_manager.child_cursor_key, doc)
+
+        # 最初のページはノードを指定して取得する
+        page = self.search_manager.get_children_page(
+            collection=doc_col, oid=str(doc_id), limit=5)
+        self.assertEqual({child_col: [{'name': f'child{i}'}
+                                      for i in range(5)]},
+                         page['children'])
+        page = self.search_manager.get_children_page(page['cursor'])
+        self.assertEqual({other_col: [{'name': 'other0'},
+                                      {'name': 'other1'}]},
+                         page['children'])
+        self.assertIsNone(page['cursor'])
+
+        with self.assertRaises(ValueError):
+            self.search_manager.get_children_page('invalid')
+        # 親の子ドキュメント以外のコレクションを指定したカーソル
+        with self.assertRaises(ValueError):
+            self.search_manager.get_children_page(
+                self.search_manager._encode_child_cursor(
+                    DBRef(doc_col, doc_id), [parent_col], None))
+
+        # child_depthの末端のノードにも最初のページのカーソルが付き、
+        # 孫を辿れる
+        grand_id = ObjectId()
+        self.testdb[child_col].update_one(
+            {'_id': child_ids[0]},
+            {'$set': {Config.child: [DBRef('grand_col', grand_id)]}})
+        self.testdb['grand_col'].insert_one(
+            {'_id': grand_id, 'name': 'grand',
+             Config.parent: DBRef(child_col, child_ids[0])})
+        result = self.search_manager.get_documents(
+            1, doc_col, doc_id, parent_depth=0, child_depth=1,
+            child_limit=2)
+        child = result[doc_col][child_col][0]
+        self.assertNotIn('grand_col', child)
+        page = self.search_manager.get_children_page(
+            child[self.search_manager.child_cursor_key])
+        self.assertEqual({'grand_col': [{'name': 'grand'}]},
+                         page['children'])
+        self.assertIsNone(page['cursor'])
+        self.assertNotIn(self.search_manager.child_cursor_key,
+                         result[doc_col][child_col][1])
+        with self.assertRaises(ValueError):
+            self.search_manager.get_documents(
+                1, doc_col, doc_id, parent_depth=0, child_depth=1,
+                child_limit=0)
@@ -0,0 +1,168 @@
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from xml.etree import ElementTree
+
+import gridfs
+from bson import ObjectId
+from edman import Config
+import numpy as np
+from edman.exceptions import EdmanDbProcessError, EdmanInternalError
+from PIL import Image
+
+from edman_web.decode_policy import DecodePolicy
+from edman_web.exceptions import EdmanImageTooLargeError
+from edman_web.tile_manager import TileManager
+
+from .db_test_case import DBTestCase
+
+
+class TestTileManager(DBTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        if cls.db_server_connect:
+            cls.tile_manager = TileManager(cls.testdb)
+
+    def test_get_tile(self):
+        if not self.db_server_connect:
+            return
+
+        content = Image.new("RGB", (600, 400), (0, 128, 255))
+        img = BytesIO()
+        content.save(img, 'png')
+        fs = gridfs.GridFS(self.testdb)
+        oid = fs.put(img.getvalue(), filename='large.png')
+
+        # 未作成でbuild=Falseの場合
+        with self.assertRaises(ValueError):
+            self.tile_manager.get_tile(oid, 0, 0, 0, build=False)
+
+        # 初回アクセスで作成される
+        data, mimetype = self.tile_manager.get_tile(oid, 10, 2, 1)
+        self.assertEqual('image/jpeg', mimetype)
+        # 右下のタイルは端まで(overlap分だけ左上に広がる)
+        self.assertTupleEqual((89, 145), Image.open(BytesIO(data)).size)
+
+        manifest = self.tile_manager.get_tile_manifest(oid)
+        self.assertEqual(10, manifest['max_level'])
+        tiles = self.testdb[f'{TileManager.tile_bucket}.files']
+        # レベル10: 3x2, 9: 2x1, 8以下: 1x1
+        self.assertEqual(6 + 2 + 9, tiles.count_documents({}))
+
+        data, _ = self.tile_manager.get_tile(oid, 0, 0, 0)
+        self.assertTupleEqual((1, 1), Image.open(BytesIO(data)).size)
+
+        # 範囲外
+        with self.assertRaises(ValueError):
+            self.tile_manager.get_tile(oid, 10, 3, 0)
+        with self.assertRaises(ValueError):
+            self.tile_manager.get_tile(oid, 11, 0, 0)
+
+        dzi = ElementTree.fromstring(self.tile_manager.get_dzi(oid))
+        self.assertEqual('256', dzi.get('TileSize'))
+        self.assertEqual('600', dzi[0].get('Width'))
+
+        # ファイル削除でタイルも削除される
+        doc_id = ObjectId()
+        self.testdb['doc_col'].insert_one(
+            {'_id': doc_id, Config.file: [oid, ObjectId()]})
+        self.tile_manager.file_delete('doc_col', doc_id, [oid])
+        self.assertIsNone(self.tile_manager.get_tile_manifest(oid))
+        self.assertEqual(0, tiles.count_documents({}))
+
+    def test_build_tile_pyramid_claim(self):
+        if not self.db_server_connect:
+            return
+
+        content = Image.new("RGB", (300, 200), (0, 128, 255))
+        img = BytesIO()
+        content.save(img, 'png')
+        fs = gridfs.GridFS(self.testdb)
+        oid = fs.put(img.getvalue(), filename='large.png')
+        manifests = self.testdb[TileManager.tile_manifest_collection]
+        tiles = self.testdb[f'{TileManager.tile_bucket}.files']
+
+        # 他のリクエストが作成中の場合は待った後にエラー
+        tile_manager = TileManager(self.testdb)
+        tile_manager.tile_build_wait = 0.2
+        tile_manager.tile_build_poll_interval = 0.05
+        manifests.insert_one({'_id': oid, 'status': 'building',
+                              'build_id': ObjectId(),
+                              'created': datetime.now(timezone.utc)})
+        with self.assertRaises(EdmanDbProcessError):
+            tile_manager.get_tile(oid, 0, 0, 0)
+        self.assertEqual(0, tiles.count_documents({}))
+
+        # 作成中のまま更新されない場合は引き継ぐ
+        manifests.update_one({'_id': oid}, {'$set': {
+            'created': datetime.now(timezone.utc) - timedelta(hours=1)}})
+        data, _ = tile_manager.get_tile(oid, 0, 0, 0)
+        self.assertTupleEqual((1, 1), Image.open(BytesIO(data)).size)
+        count = tiles.count_documents({})
+
+        # 作り直すと以前のタイルは削除される
+        manifest = tile_manager.build_tile_pyramid(oid)
+        self.assertEqual(count, tiles.count_documents({}))
+        self.assertEqual(count, tiles.count_documents(
+            {'metadata.build_id': manifest['build_id']}))
+        self.assertEqual('ready',
+                         tile_manager.get_tile_manifest(oid)['status'])
+
+    def test_build_tile_pyramid_large(self):
+        if not self.db_server_connect:
+            return
+
+        content = Image.new("RGB", (300, 200), (0, 128, 255))
+        img = BytesIO()
+        content.save(img, 'png')
+        fs = gridfs.GridFS(self.testdb)
+        oid = fs.put(img.getvalue(), filename='large.png')
+
+        # PILの上限やサムネイル用の上限を超えていてもタイルは作成できる
+        # (PILは上限の2倍を超えるとエラー タイルの切り出しは上限内に収める)
+        limit = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = 27000
+        try:
+            manifest = self.tile_manager.build_tile_pyramid(
+                oid, decode_policy=DecodePolicy(max_pixels=10000))
+        finally:
+            Image.MAX_IMAGE_PIXELS = limit
+        self.assertEqual('ready', manifest['status'])
+
+        # タイルの上限を超える画像は失敗の状態になり、作成を繰り返さない
+        tile_manager = TileManager(self.testdb)
+        tile_manager.tile_max_pixels = 10000
+        with self.assertRaises(EdmanImageTooLargeError):
+            tile_manager.build_tile_pyramid(oid)
+        manifests = self.testdb[TileManager.tile_manifest_collection]
+        self.assertEqual('failed', manifests.find_one({'_id': oid})['status'])
+        self.assertEqual(0, self.testdb[
+            f'{TileManager.tile_bucket}.files'].count_documents({}))
+        with self.assertRaises(EdmanInternalError):
+            tile_manager.get_tile(oid, 0, 0, 0)
+
+        # 画像でないデータも失敗の状態になる
+        oid = fs.put(b'not an image', filename='broken.png')
+        with self.assertRaises(EdmanInternalError):
+            self.tile_manager.get_dzi(oid)
+        self.assertEqual('failed', manifests.find_one({'_id': oid})['status'])
+
+    def test_build_tile_pyramid_uint16(self):
+        if not self.db_server_connect:
+            return
+
+        # 16bitの検出器の画像は白く飽和させずにコントラストを調整する
+        arr = np.linspace(0, 4000, 300 * 200).reshape(200, 300)
+        img = BytesIO()
+        Image.fromarray(arr.astype(np.uint16)).save(img, 'png')
+        fs = gridfs.GridFS(self.testdb)
+        oid = fs.put(img.getvalue(), filename='detector.png')
+
+        manifest = self.tile_manager.build_tile_pyramid(oid)
+        data, mimetype = self.tile_manager.get_tile(
+            oid, manifest['max_level'], 0, 0)
+        self.assertEqual('image/jpeg', mimetype)
+        tile = np.asarray(Image.open(BytesIO(data)).convert('L'))
+        self.assertLess((tile == 255).mean(), 0.1)
+        self.assertLess(tile[:, :10].mean(), tile[:, -10:].mean())
@@ -0,0 +1,62 @@
+import zipfile
+from io import BytesIO
+from unittest import TestCase
+
+from edman_web.zip_stream import ZipStream
+
+
+class TestZipStream(TestCase):
+
+    def test_is_stored(self):
+        self.assertTrue(ZipStream.is_stored('abc.JPG'))
+        self.assertTrue(ZipStream.is_stored('data.tar.gz'))
+        self.assertFalse(ZipStream.is_stored('abc.txt'))
+        self.assertFalse(ZipStream.is_stored('noext'))
+
+    def test_unique_name(self):
+        zip_stream = ZipStream()
+        self.assertEqual('a.txt', zip_stream.unique_name('a.txt'))
+        self.assertEqual('a (1).txt', zip_stream.unique_name('a.txt'))
+        self.assertEqual('a (2).txt', zip_stream.unique_name('a.txt'))
+        self.assertEqual('dir.d/b', zip_stream.unique_name('dir.d/b'))
+        self.assertEqual('dir.d/b (1)', zip_stream.unique_name('dir.d/b'))
+
+    def test_write_entry(self):
+        zip_stream = ZipStream()
+        text_chunks = [b'test' * 1000, b'data' * 1000]
+        image_chunks = [b'\xff\xd8' + bytes(range(256)) * 10]
+        out = BytesIO()
+        for data in zip_stream.write_entry('a.txt', iter(text_chunks)):
+            out.write(data)
+        for data in zip_stream.write_entry('b.jpg', iter(image_chunks)):
+            out.write(data)
+        for data in zip_stream.write_entry('a.txt', iter([b'dup'])):
+            out.write(data)
+        for data in zip_stream.close():
+            out.write(data)
+
+        with zipfile.ZipFile(out) as zf:
+            self.assertIsNone(zf.testzip())
+            infos = {i.filename: i for i in zf.infolist()}
+            self.assertListEqual(['a.txt', 'b.jpg', 'a (1).txt'],
+                                 zf.namelist())
+            self.assertEqual(b''.join(text_chunks), zf.read('a.txt'))
+            self.assertEqual(b''.join(image_chunks), zf.read('b.jpg'))
+            self.assertEqual(b'dup', zf.read('a (1).txt'))
+            self.assertEqual(zipfile.ZIP_DEFLATED,
+                             infos['a.txt'].compress_type)
+            self.assertEqual(zipfile.ZIP_STORED,
+                             infos['b.jpg'].compress_type)
+            # シーク不可のストリームなのでデータディスクリプタが使われる
+            self.assertTrue(infos['a.txt'].flag_bits & 0x08)
+
+    def test_write_entry_zip64(self):
+        zip_stream = ZipStream()
+        out = BytesIO()
+        for data in zip_stream.write_entry('big.bin', iter([b'x' * 10]),
+                                           size_hint=1 << 40):
+            out.write(data)
+        for data in zip_stream.close():
+            out.write(data)
+        with zipfile.ZipFile(out) as zf:
+            self.assertEqual(b'x' * 10, zf.read('big.bin'))